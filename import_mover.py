@@ -1,51 +1,441 @@
 import argparse
-# import ast
 import libcst as cst
 import logging
 from pathlib import Path
-from typing import Dict, List, Set, Optional, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Sequence, Set, Optional, Tuple, Union
 from dataclasses import dataclass, field
 import sys
+import os
+import glob
+import hashlib
+import json
+import tempfile
+import subprocess
+import ast
+import builtins
+import importlib.util
+import shutil
+import time
 # from rich.traceback import install
 from collections import defaultdict
+from contextlib import contextmanager
 # import libcst.metadata as meta
 # from libcst.metadata import ScopeProvider
 import re
+import fnmatch
+from collections import OrderedDict
 
 # install(show_locals=True)
 
+__version__ = "0.3.0"
+
+DEFAULT_CACHE_DIR = ".import_mover_cache"
+DEFAULT_CACHE_SIZE_MB = 256
+
 @dataclass
 class ImportInfo:
     """Store information about imports and their usage."""
     node: cst.Import | cst.ImportFrom
     names: Set[str] = field(default_factory=set)
+    # Functions the import is used in, by ``__qualname__`` (``A.run`` and ``B.run`` are distinct)
     used_in_functions: Dict[str, bool] = field(default_factory=dict)
     is_used: bool = False
+    line: int = 0
+    scope: Optional[cst.metadata.Scope] = None
+    unused_names: Set[str] = field(default_factory=set)
+    # Referencing nodes by imported name
+    references: Dict[str, List[cst.CSTNode]] = field(default_factory=dict)
+    # Functions the import is used in, with references from comprehensions and lambdas
+    # attributed to the enclosing function
+    function_scopes: List[cst.metadata.FunctionScope] = field(default_factory=list)
+    # Referenced where code runs at import time (module or class body, decorators, bases)
+    used_at_module_level: bool = False
+    # Referencing nodes inside type annotations
+    annotation_references: List[cst.CSTNode] = field(default_factory=list)
+
+    @property
+    def annotation_only(self) -> bool:
+        """Whether the import is only referenced in type annotations."""
+        return self.is_used and len(self.annotation_references) == sum(map(len, self.references.values()))
+
+@dataclass
+class ImportIndex:
+    """Everything the analysis needs to know about the imports of a module, computed once.
+
+    ``imports`` maps each import statement to its names, position and referencing
+    scopes; ``by_name`` maps ``(scope, name)`` to the import defining that name.
+    """
+    imports: Dict[Union[cst.Import, cst.ImportFrom], ImportInfo] = field(default_factory=dict)
+    by_name: Dict[Tuple[cst.metadata.Scope, str], Union[cst.Import, cst.ImportFrom]] = field(default_factory=dict)
+
+    def lookup(self, scope: cst.metadata.Scope, name: str) -> Optional[Union[cst.Import, cst.ImportFrom]]:
+        """The import defining ``name`` (or its longest dotted prefix) in ``scope``, if any."""
+        while name:
+            node = self.by_name.get((scope, name))
+            if node is not None:
+                return node
+            name = name.rpartition('.')[0]
+        return None
+
+    def global_imports(self) -> List[ImportInfo]:
+        return [info for info in self.imports.values() if isinstance(info.scope, cst.metadata.GlobalScope)]
+
+class _LazyCode:
+    """The code of a node for log messages, only rendered if the message is emitted."""
+    __slots__ = ('module', 'node')
+
+    def __init__(self, module: cst.Module, node: cst.CSTNode) -> None:
+        self.module = module
+        self.node = node
+
+    def __str__(self) -> str:
+        return self.module.code_for_node(self.node).strip()
+
+def _enclosing_function_scope(scope: cst.metadata.Scope) -> Optional[cst.metadata.FunctionScope]:
+    """The function whose body a reference in ``scope`` executes in; None for module/class level code."""
+    while isinstance(scope, cst.metadata.ComprehensionScope) or (
+            isinstance(scope, cst.metadata.FunctionScope) and isinstance(scope.node, cst.Lambda)):
+        scope = scope.parent
+    return scope if isinstance(scope, cst.metadata.FunctionScope) else None
+
+def qualified_scope_name(scope: cst.metadata.Scope) -> str:
+    """``__qualname__`` style name of a function scope, e.g. ``Class.method.<locals>.helper``."""
+    parts = []
+    while scope is not None and not isinstance(scope, cst.metadata.GlobalScope):
+        if isinstance(scope, cst.metadata.FunctionScope):
+            if parts:
+                parts.append('<locals>')
+            parts.append(scope.name)
+        elif isinstance(scope, cst.metadata.ClassScope):
+            parts.append(scope.name)
+        scope = scope.parent
+    return '.'.join(reversed(parts))
+
+def _enclosing_functions(scope: cst.metadata.FunctionScope) -> List[cst.metadata.FunctionScope]:
+    """The function scopes enclosing ``scope``, outermost first, ``scope`` included."""
+    chain = []
+    while not isinstance(scope, cst.metadata.GlobalScope):
+        if isinstance(scope, cst.metadata.FunctionScope):
+            chain.append(scope)
+        scope = scope.parent
+    return chain[::-1]
+
+def placement_scopes(
+    function_scopes: Iterable[cst.metadata.FunctionScope],
+    hoist: bool = False,
+    enclosing: Callable = _enclosing_functions,
+) -> List[cst.metadata.FunctionScope]:
+    """The functions to put an import used in ``function_scopes`` into.
+
+    Functions nested in another one getting the import see it through the closure, so they
+    don't get their own copy. With ``hoist``, the functions below the same top level function
+    share one import in their lowest common enclosing function. ``enclosing`` gives the chain
+    of functions around a scope, outermost first (``AstScope.functions`` for the ast backend).
+    """
+    chains = [enclosing(scope) for scope in function_scopes]
+    if hoist:
+        groups: Dict[cst.metadata.FunctionScope, List[List[cst.metadata.FunctionScope]]] = defaultdict(list)
+        for chain in chains:
+            groups[chain[0]].append(chain)
+        chains = []
+        for group in groups.values():
+            common = []
+            for scopes in zip(*group):
+                if any(scope is not scopes[0] for scope in scopes):
+                    break
+                common.append(scopes[0])
+            chains.append(common)
+    targets = {chain[-1] for chain in chains}
+    placed = []
+    for chain in chains:
+        if chain[-1] not in placed and not any(scope in targets for scope in chain[:-1]):
+            placed.append(chain[-1])
+    return placed
+
+def build_import_index(wrapper: cst.metadata.MetadataWrapper) -> ImportIndex:
+    """Resolve scope and position metadata once and index every import assignment of the module."""
+    scopes = set(wrapper.resolve(cst.metadata.ScopeProvider).values())
+    positions = wrapper.resolve(cst.metadata.PositionProvider)
+    index = ImportIndex()
+    for scope in scopes:
+        if scope is None:
+            continue
+        for assignment in scope.assignments:
+            node = assignment.node
+            if not (isinstance(assignment, cst.metadata.Assignment) and
+                    isinstance(node, (cst.Import, cst.ImportFrom))):
+                continue
+            if (isinstance(node, cst.ImportFrom) and node.module is not None and
+                    cst.helpers.get_full_name_for_node(node.module) == '__future__'):
+                continue  # compiler directives, never moved or removed
+            info = index.imports.get(node)
+            if info is None:
+                info = index.imports[node] = ImportInfo(node=node, line=positions[node].start.line, scope=scope)
+            info.names.add(assignment.name)
+            index.by_name[(scope, assignment.name)] = node
+            if not assignment.references:
+                info.unused_names.add(assignment.name)
+            info.references[assignment.name] = [ref.node for ref in assignment.references]
+            for ref in assignment.references:
+                info.is_used = True
+                if ref.is_annotation:
+                    info.annotation_references.append(ref.node)
+                function_scope = _enclosing_function_scope(ref.scope)
+                if function_scope is None:
+                    info.used_at_module_level = True
+                elif function_scope not in info.function_scopes:
+                    info.function_scopes.append(function_scope)
+                    info.used_in_functions[qualified_scope_name(function_scope)] = True
+
+    # ``import a.b`` binds both ``a`` and ``a.b``; the package name is used whenever the dotted one is
+    for info in index.imports.values():
+        used = info.names - info.unused_names
+        info.unused_names = {
+            name for name in info.unused_names
+            if not any(other.startswith(f"{name}.") for other in used)
+        }
+    return index
+
+@dataclass
+class FileResult:
+    """Outcome of processing a single file, small enough to send back from a worker process."""
+    source_path: str
+    output_path: Optional[str] = None
+    unused_imports: List[str] = field(default_factory=list)
+    moved_imports: Dict[str, List[str]] = field(default_factory=dict)
+    lazy_imports: List[str] = field(default_factory=list)
+    type_checking_imports: List[str] = field(default_factory=list)
+    # Module level constants computed on first use instead, and the reasons others aren't
+    deferred_constants: List[str] = field(default_factory=list)
+    kept_constants: Dict[str, str] = field(default_factory=dict)
+    # click subcommands imported on first use ("group command"), and the registrations left alone
+    lazy_subcommands: List[str] = field(default_factory=list)
+    kept_subcommands: Dict[str, str] = field(default_factory=dict)
+    # Global import statements no longer executed when the module is imported
+    deferred_imports: List[str] = field(default_factory=list)
+    # Global imports left at module level, with the reason why
+    kept_imports: Dict[str, str] = field(default_factory=dict)
+    # First line of each global import statement by code, and of the import of each unused name
+    import_lines: Dict[str, int] = field(default_factory=dict)
+    unused_lines: Dict[str, int] = field(default_factory=dict)
+    skipped: Optional[str] = None
+    error: Optional[str] = None
+    cached: bool = False
+    # Seconds spent in each phase of processing (see PhaseTimer)
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Unified diff of the changes, when asked for
+    diff: Optional[str] = None
+    # Source before the rewrite, kept for changed files when asked for (see verify_rewrites)
+    original_code: Optional[str] = None
+    # Rewritten code, when asked for
+    output_code: Optional[str] = None
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.unused_imports or self.moved_imports or self.lazy_imports or
+                    self.type_checking_imports or self.deferred_constants or self.lazy_subcommands)
+
+class PhaseTimer:
+    """Wall time spent in named phases, accumulated over repeated entries."""
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+def _file_fingerprint(path: Path) -> Optional[str]:
+    """Hash of a file's content, None if it doesn't exist."""
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+class ResultCache:
+    """On-disk cache of processing results, keyed by source hash, tool version and options.
+
+    Each entry is a small JSON file holding the FileResult fields and the rewritten code.
+    Other files the output depends on (submodules told from attributes, click command
+    definitions) are stored with their fingerprints; an entry whose files changed, appeared
+    or went away is a miss. Entries are written atomically, so several worker processes can share one cache
+    directory. ``prune`` evicts least recently used entries once the directory grows
+    beyond ``max_size`` bytes.
+    """
+    def __init__(self, cache_dir: Union[str, Path] = DEFAULT_CACHE_DIR, max_size: int = DEFAULT_CACHE_SIZE_MB * 2**20):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(source_code: str, options: Dict) -> str:
+        hasher = hashlib.sha256()
+        hasher.update(__version__.encode())
+        hasher.update(json.dumps(options, sort_keys=True, default=sorted).encode())
+        hasher.update(source_code.encode())
+        return hasher.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._entry_path(key)
+        try:
+            entry = json.loads(path.read_text())
+            os.utime(path)  # mark as recently used for eviction
+        except (OSError, ValueError):
+            return None
+        for dependency, fingerprint in entry.get("dependencies", {}).items():
+            if _file_fingerprint(Path(dependency)) != fingerprint:
+                logging.debug("Cache entry %s is stale: %s changed", key, dependency)
+                return None
+        return entry
+
+    def put(self, key: str, result: FileResult, output_code: str, dependencies: Iterable[Path] = ()) -> None:
+        path = self._entry_path(key)
+        entry = {
+            "unused_imports": result.unused_imports,
+            "moved_imports": result.moved_imports,
+            "lazy_imports": result.lazy_imports,
+            "type_checking_imports": result.type_checking_imports,
+            "deferred_constants": result.deferred_constants,
+            "kept_constants": result.kept_constants,
+            "lazy_subcommands": result.lazy_subcommands,
+            "kept_subcommands": result.kept_subcommands,
+            "deferred_imports": result.deferred_imports,
+            "kept_imports": result.kept_imports,
+            "import_lines": result.import_lines,
+            "unused_lines": result.unused_lines,
+            "output_code": output_code,
+            "dependencies": {str(dependency): _file_fingerprint(dependency) for dependency in sorted(dependencies)},
+        }
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _write_atomic(path, json.dumps(entry))
+        except OSError as e:
+            logging.warning("Could not write cache entry %s: %s", path, e)
+
+    def prune(self) -> int:
+        """Evict least recently used entries until the cache fits in ``max_size``. Returns the number evicted."""
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*/*.json"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        evicted = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logging.debug("Evicted %s cache entries from %s", evicted, self.cache_dir)
+        return evicted
+
+class ParsedModuleCache:
+    """In-memory LRU of parsed modules, with their scope and position metadata resolved.
+
+    Keyed by the hash of the parsed code, so any options can reuse an entry. Used by the
+    long-running server (see ``ImportMoverServer``), which handles one request at a time.
+    """
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, cst.metadata.MetadataWrapper]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(code: str) -> str:
+        return hashlib.sha256(code.encode()).hexdigest()
+
+    def get(self, code: str) -> Optional[cst.metadata.MetadataWrapper]:
+        wrapper = self.entries.get(self.key(code))
+        if wrapper is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(self.key(code))
+        return wrapper
+
+    def put(self, code: str, wrapper: cst.metadata.MetadataWrapper) -> None:
+        self.entries[self.key(code)] = wrapper
+        self.entries.move_to_end(self.key(code))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+def _write_atomic(path: Path, text: str) -> None:
+    """Write ``text`` to ``path`` through a temporary file in the same directory and rename it into place."""
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
 
 class MoveImportsTransformer(cst.CSTTransformer):
-    """Transformer that moves imports into the functions where they are used."""
+    """Transformer that moves imports into the functions where they are used.
+
+    ``imports_by_function`` is keyed by qualified function name (see ``qualified_scope_name``).
+    """
     def __init__(self, imports_by_function: Dict[str, List[cst.CSTNode]], module: cst.Module):
         self.imports_by_function = imports_by_function
+        # Qualified names of the enclosing classes and functions, and whether each is a function
+        self.scope_stack: List[Tuple[str, bool]] = []
         self.function_stack: List[str] = []
         self.module = module
         self.processed_imports: Dict[str, Set[str]] = defaultdict(set)
         super().__init__()
 
+    def _qualified_name(self, name: str) -> str:
+        if not self.scope_stack:
+            return name
+        parent, is_function = self.scope_stack[-1]
+        return f"{parent}.<locals>.{name}" if is_function else f"{parent}.{name}"
+
+    def visit_ClassDef(self, node: cst.ClassDef) -> bool:
+        self.scope_stack.append((self._qualified_name(node.name.value), False))
+        return True
+
+    def leave_ClassDef(self, original_node: cst.ClassDef, updated_node: cst.ClassDef) -> cst.ClassDef:
+        self.scope_stack.pop()
+        return updated_node
+
     def visit_FunctionDef(self, node: cst.FunctionDef) -> bool:
-        self.function_stack.append(node.name.value)
-        logging.debug(f"Visiting function: {node.name.value} (stack: {self.function_stack})")
+        qualified_name = self._qualified_name(node.name.value)
+        self.scope_stack.append((qualified_name, True))
+        self.function_stack.append(qualified_name)
+        logging.debug("Visiting function: %s", qualified_name)
         return True
 
     def leave_FunctionDef(
         self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef
     ) -> cst.FunctionDef:
         current_function = self.function_stack[-1]
-        logging.debug(f"Processing function: {current_function} (stack: {self.function_stack})")
+        logging.debug("Processing function: %s (stack: %s)", current_function, self.function_stack)
         
         if current_function in self.imports_by_function:
             imports = self.imports_by_function[current_function]
-            logging.debug(f"  Found {len(imports)} imports to move into {current_function}")
+            logging.debug("  Found %s imports to move into %s", len(imports), current_function)
             new_body = []
+
+            # One-line functions (``def f(): return x``) need an indented block to take the imports
+            if isinstance(updated_node.body, cst.SimpleStatementSuite):
+                updated_node = updated_node.with_changes(body=cst.IndentedBlock(
+                    body=[cst.SimpleStatementLine(body=updated_node.body.body)]
+                ))
             
             # Preserve docstring if it exists
             if (isinstance(updated_node.body.body[0], cst.SimpleStatementLine) and
@@ -58,17 +448,18 @@ class MoveImportsTransformer(cst.CSTTransformer):
                 start_idx = 0
                 
             # Add imports at the beginning (after docstring if exists)
+            new_imports = []
             for imp in imports:
                 # Skip if we've already added this import to this function
                 import_str = self.module.code_for_node(imp)
                 if import_str in self.processed_imports[current_function]:
-                    logging.debug(f"  Skipping duplicate import: {import_str}")
+                    logging.debug("  Skipping duplicate import: %s", import_str)
                     continue
                 
                 # Create a new import node based on the original
                 if isinstance(imp, cst.Import):
                     new_imp = cst.Import(names=imp.names)
-                    logging.debug(f"  Adding import: {self.module.code_for_node(new_imp)}")
+                    logging.debug("  Adding import: %s", _LazyCode(self.module, new_imp))
                 elif isinstance(imp, cst.ImportFrom):
                     new_imp = cst.ImportFrom(
                         module=imp.module,
@@ -77,344 +468,4269 @@ class MoveImportsTransformer(cst.CSTTransformer):
                         lpar=imp.lpar,
                         rpar=imp.rpar
                     )
-                    logging.debug(f"  Adding import from: {self.module.code_for_node(new_imp)}")
-                new_body.append(cst.SimpleStatementLine([new_imp]))
+                    logging.debug("  Adding import from: %s", _LazyCode(self.module, new_imp))
+                new_imports.append(new_imp)
                 self.processed_imports[current_function].add(import_str)
+            new_body.extend(cst.SimpleStatementLine([imp]) for imp in _merge_from_imports(new_imports, self.module))
             
             # Add rest of function body
             new_body.extend(updated_node.body.body[start_idx:])
             
             updated_body = updated_node.body.with_changes(body=new_body)
             updated_node = updated_node.with_changes(body=updated_body)
-            logging.debug(f"  Updated function body for {current_function}")
+            logging.debug("  Updated function body for %s", current_function)
         else:
-            logging.debug(f"  No imports to move into {current_function}")
+            logging.debug("  No imports to move into %s", current_function)
         
         self.function_stack.pop()
+        self.scope_stack.pop()
         return updated_node
 
-class RemoveUnusedImportTransformer(cst.CSTTransformer):
-    """Transformer that handles unused imports - either comments them out or removes them."""
+def _merge_from_imports(
+    imports: List[Union[cst.Import, cst.ImportFrom]],
+    module: cst.Module,
+) -> List[Union[cst.Import, cst.ImportFrom]]:
+    """Merge ``from x import a`` and ``from x import b`` into ``from x import a, b``, in first seen order."""
+    merged: List[Union[cst.Import, cst.ImportFrom]] = []
+    by_module: Dict[Tuple[int, str], int] = {}
+    for imp in imports:
+        if not isinstance(imp, cst.ImportFrom) or isinstance(imp.names, cst.ImportStar):
+            merged.append(imp)
+            continue
+        key = (len(imp.relative), module.code_for_node(imp.module) if imp.module else '')
+        if key not in by_module:
+            by_module[key] = len(merged)
+            merged.append(imp)
+            continue
+        first = merged[by_module[key]]
+        seen = {module.code_for_node(alias.with_changes(comma=cst.MaybeSentinel.DEFAULT)) for alias in first.names}
+        names = [*first.names, *(
+            alias for alias in imp.names
+            if module.code_for_node(alias.with_changes(comma=cst.MaybeSentinel.DEFAULT)) not in seen
+        )]
+        # One line, without the parentheses and line breaks of the originals
+        names = [
+            alias.with_changes(comma=cst.Comma(whitespace_after=cst.SimpleWhitespace(' '))
+                               if i < len(names) - 1 else cst.MaybeSentinel.DEFAULT)
+            for i, alias in enumerate(names)
+        ]
+        merged[by_module[key]] = first.with_changes(names=names, lpar=None, rpar=None)
+    return merged
+
+class ImportRewriteTransformer(MoveImportsTransformer):
+    """Single-pass rewrite: moves imports into functions and comments out (or removes) the original statements.
+
+    Comments are attached to the following statement as ``EmptyLine`` nodes, so the
+    whole rewrite happens on the CST and ``module.code`` is the final output.
+    Taken-out imports can be replaced by other statements (``replacements``), name
+    references can be swapped for other expressions (``replaced_names``), annotations
+    for quoted ones (``replaced_annotations``), and ``header``/``trailer`` statements
+    are added after the module docstring and ``__future__`` imports and at the end of
+    the module.
+    """
     def __init__(
-        self, 
-        unused_imports: Dict[Union[cst.Import, cst.ImportFrom], Set[str]],
+        self,
+        imports_by_function: Dict[str, List[cst.CSTNode]],
+        module: cst.Module,
+        removed_imports: Set[Union[cst.Import, cst.ImportFrom]],
         keep_old_imports: bool = True,
-        module: cst.Module = None
+        replacements: Optional[Dict[Union[cst.Import, cst.ImportFrom], List[cst.SimpleStatementLine]]] = None,
+        replaced_names: Optional[Dict[cst.Name, cst.BaseExpression]] = None,
+        replaced_annotations: Optional[Dict[cst.Annotation, cst.Annotation]] = None,
+        header: Sequence[cst.BaseStatement] = (),
+        trailer: Sequence[cst.BaseStatement] = (),
     ) -> None:
-        self.unused_imports = unused_imports
+        super().__init__(imports_by_function, module)
+        self.removed_imports = removed_imports
         self.keep_old_imports = keep_old_imports
-        self.module = module
-        super().__init__()
+        self.replacements = replacements or {}
+        self.replaced_names = replaced_names or {}
+        self.replaced_annotations = replaced_annotations or {}
+        self.header = list(header)
+        self.trailer = list(trailer)
 
-    def leave_SimpleStatementLine(
-        self, 
-        original_node: cst.SimpleStatementLine, 
-        updated_node: cst.SimpleStatementLine
-    ) -> Union[cst.SimpleStatementLine, cst.FlattenSentinel]:
-        # Only process nodes that contain imports
-        if not any(isinstance(stmt, (cst.Import, cst.ImportFrom)) for stmt in updated_node.body):
-            return updated_node
-            
-        new_statements = []
-        for stmt in updated_node.body:
-            if isinstance(stmt, (cst.Import, cst.ImportFrom)) and stmt in self.unused_imports:
-                if self.keep_old_imports:
-                    # Create a comment node
-                    import_str = self.module.code_for_node(stmt).strip()
-                    new_statements.append(cst.SimpleStatementLine([
-                        cst.Expr(cst.SimpleString(f'# {import_str}'))
-                    ]))
-                # If not keeping old imports, skip this statement
+    def _old_import_lines(self, stmt: cst.BaseSmallStatement) -> List[cst.EmptyLine]:
+        """The import statement as comment lines (empty if old imports are not kept)."""
+        if not self.keep_old_imports:
+            return []
+        code = self.module.code_for_node(stmt).strip().rstrip(';').strip()
+        return [cst.EmptyLine(comment=cst.Comment(f"# {line}".rstrip())) for line in code.splitlines()]
+
+    def _rewrite_body(
+        self,
+        original_body: Sequence[cst.BaseStatement],
+        updated_body: Sequence[cst.BaseStatement],
+    ) -> Tuple[List[cst.BaseStatement], List[cst.EmptyLine]]:
+        """Drop removed imports from a block; returns the new body and comment lines left over at its end."""
+        new_body = []
+        pending: List[cst.EmptyLine] = []
+
+        def emit(statement: cst.BaseStatement) -> None:
+            nonlocal pending
+            if pending:
+                statement = statement.with_changes(leading_lines=[*pending, *statement.leading_lines])
+                pending = []
+            new_body.append(statement)
+
+        for original, updated in zip(original_body, updated_body):
+            if not (isinstance(original, cst.SimpleStatementLine) and
+                    any(stmt in self.removed_imports for stmt in original.body)):
+                emit(updated)
+                continue
+
+            pending.extend(updated.leading_lines)
+            kept = []
+            for stmt, new_stmt in zip(original.body, updated.body):
+                if stmt not in self.removed_imports:
+                    kept.append(new_stmt)
+                    continue
+                logging.debug("Taking out import: %s", _LazyCode(self.module, stmt))
+                replacement = self.replacements.get(stmt, [])
+                if replacement and kept:
+                    # Flush what precedes the import on the same line to keep the statement order
+                    kept[-1] = kept[-1].with_changes(semicolon=cst.MaybeSentinel.DEFAULT)
+                    emit(updated.with_changes(body=kept, leading_lines=[]))
+                    kept = []
+                pending.extend(self._old_import_lines(stmt))
+                for statement in replacement:
+                    emit(statement)
+            if kept:
+                kept[-1] = kept[-1].with_changes(semicolon=cst.MaybeSentinel.DEFAULT)
+                emit(updated.with_changes(body=kept, leading_lines=[]))
+        return new_body, pending
+
+    def leave_IndentedBlock(
+        self, original_node: cst.IndentedBlock, updated_node: cst.IndentedBlock
+    ) -> cst.IndentedBlock:
+        body, pending = self._rewrite_body(original_node.body, updated_node.body)
+        if not body:
+            # A block can't be empty
+            body = [cst.SimpleStatementLine([cst.Pass()], leading_lines=pending)]
+            pending = []
+        return updated_node.with_changes(body=body, footer=[*pending, *updated_node.footer])
+
+    def leave_SimpleStatementSuite(
+        self, original_node: cst.SimpleStatementSuite, updated_node: cst.SimpleStatementSuite
+    ) -> cst.SimpleStatementSuite:
+        # One-line suites (``if x: import y``) have nowhere to put a comment
+        body = []
+        for stmt, new_stmt in zip(original_node.body, updated_node.body):
+            if stmt not in self.removed_imports:
+                body.append(new_stmt)
+            elif stmt in self.replacements:
+                body.extend(small for line in self.replacements[stmt] for small in line.body)
             else:
-                # Keep non-import statements or used imports
-                new_statements.append(cst.SimpleStatementLine([stmt]))
-                
-        if not new_statements:
-            return updated_node
-            
-        if len(new_statements) == 1:
-            return new_statements[0]
-            
-        return cst.FlattenSentinel(new_statements)
+                body.append(cst.Pass())
+        return updated_node.with_changes(body=body)
 
-    def leave_Import(
-        self, original_node: cst.Import, updated_node: cst.Import
-    ) -> cst.Import:
-        return updated_node
+    def leave_Name(self, original_node: cst.Name, updated_node: cst.Name) -> cst.BaseExpression:
+        return self.replaced_names.get(original_node, updated_node)
 
-    def leave_ImportFrom(
-        self, original_node: cst.ImportFrom, updated_node: cst.ImportFrom
-    ) -> cst.ImportFrom:
-        return updated_node
+    def leave_Annotation(self, original_node: cst.Annotation, updated_node: cst.Annotation) -> cst.Annotation:
+        return self.replaced_annotations.get(original_node, updated_node)
 
-def process_file(
+    def leave_Module(self, original_node: cst.Module, updated_node: cst.Module) -> cst.Module:
+        body, pending = self._rewrite_body(original_node.body, updated_node.body)
+        if self.header:
+            position = _module_header_position(body)
+            body[position:position] = self.header
+            following = position + len(self.header)
+            # Two blank lines after generated definitions
+            if following < len(body) and not isinstance(self.header[-1], cst.SimpleStatementLine):
+                body[following] = body[following].with_changes(
+                    leading_lines=[cst.EmptyLine(), cst.EmptyLine(), *body[following].leading_lines])
+        if self.trailer:
+            body.append(self.trailer[0].with_changes(
+                leading_lines=[cst.EmptyLine(), cst.EmptyLine(), *self.trailer[0].leading_lines]))
+            body.extend(self.trailer[1:])
+        return updated_node.with_changes(body=body, footer=[*pending, *updated_node.footer])
+
+def _module_header_position(body: Sequence[cst.BaseStatement]) -> int:
+    """Index after the module docstring and ``from __future__`` imports, where generated helpers go."""
+    position = 0
+    for i, statement in enumerate(body):
+        if not isinstance(statement, cst.SimpleStatementLine):
+            break
+        small = statement.body[0]
+        if i == 0 and isinstance(small, cst.Expr) and isinstance(small.value, (cst.SimpleString, cst.ConcatenatedString)):
+            position = 1
+        elif (isinstance(small, cst.ImportFrom) and small.module is not None and
+                cst.helpers.get_full_name_for_node(small.module) == '__future__'):
+            position = i + 1
+        else:
+            break
+    return position
+
+LAZY_IMPORT_HELPER = '''
+import importlib.util as _im_importlib_util
+import sys as _im_sys
+
+
+def _im_lazy_import(name, package=None):
+    """Return module ``name``, executing it only on first attribute access."""
+    name = _im_importlib_util.resolve_name(name, package)
+    if name in _im_sys.modules:
+        return _im_sys.modules[name]
+    spec = _im_importlib_util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+    loader = _im_importlib_util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = _im_importlib_util.module_from_spec(spec)
+    _im_sys.modules[name] = module
+    loader.exec_module(module)
+    # As the import system does, so that ``import a.b; a.b`` works elsewhere (find_spec imported ``a``)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(_im_sys.modules[parent], child, module)
+    return module
+'''
+
+LAZY_GETATTR_TEMPLATE = '''
+_IM_LAZY_ATTRS = {table}
+
+
+def __getattr__(name):
+    # Names of lazily imported objects, for code importing them from this module
+    if name in _IM_LAZY_ATTRS:
+        module_name, attr = _IM_LAZY_ATTRS[name]
+        value = getattr(_im_lazy_import(module_name, __package__), attr)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {{__name__!r}} has no attribute {{name!r}}")
+'''
+
+@dataclass
+class LazyImportPlan:
+    """How the ``lazy`` strategy rewrites a module's imports."""
+    replacements: Dict[Union[cst.Import, cst.ImportFrom], List[cst.SimpleStatementLine]] = field(default_factory=dict)
+    replaced_names: Dict[cst.Name, cst.BaseExpression] = field(default_factory=dict)
+    # Names imported with ``from module import attr``: name -> (module, attr)
+    lazy_attrs: Dict[str, Tuple[str, str]] = field(default_factory=dict)
+
+    def header(self) -> List[cst.BaseStatement]:
+        return list(cst.parse_module(LAZY_IMPORT_HELPER).body) if self.replacements else []
+
+    def trailer(self) -> List[cst.BaseStatement]:
+        if not self.lazy_attrs:
+            return []
+        table = "{" + ", ".join(f"{name!r}: {target!r}" for name, target in self.lazy_attrs.items()) + "}"
+        return list(cst.parse_module(LAZY_GETATTR_TEMPLATE.format(table=table)).body)
+
+def _is_submodule(
+    source_path: Path, module: str, level: int, name: str, dependencies: Optional[Set[Path]] = None,
+) -> bool:
+    """Whether ``from <module> import <name>`` imports a submodule rather than an attribute.
+
+    The files looked at are added to ``dependencies`` (see ``ResultCache``).
+    """
+    if level:
+        package_dir = source_path.resolve().parents[level - 1]
+        if module:
+            package_dir = package_dir.joinpath(*module.split('.'))
+        candidates = [package_dir / f"{name}.py", package_dir / name / "__init__.py"]
+        if dependencies is not None:
+            dependencies.update(candidates)
+        return any(candidate.exists() for candidate in candidates)
+    try:
+        spec = importlib.util.find_spec(f"{module}.{name}")
+    except (ImportError, ValueError):
+        return False
+    if spec is not None and spec.has_location and dependencies is not None:
+        dependencies.add(Path(spec.origin))
+    return spec is not None
+
+def _lazy_binding(name: str, module: str, package: bool = False) -> cst.SimpleStatementLine:
+    args = f"{module!r}, __package__" if package else repr(module)
+    return cst.parse_statement(f"{name} = _im_lazy_import({args})")
+
+def plan_lazy_imports(
+    index: ImportIndex,
+    candidates: Iterable[Union[cst.Import, cst.ImportFrom]],
+    module: cst.Module,
+    source_path: Path,
+    dependencies: Optional[Set[Path]] = None,
+) -> LazyImportPlan:
+    """Turn global imports into lazily loaded module bindings.
+
+    ``import x [as y]`` and ``from x import submodule`` become ``_im_lazy_import`` bindings.
+    Other ``from x import name`` imports bind ``x`` lazily instead and their references become
+    ``_im_x.name``; a module ``__getattr__`` keeps ``name`` importable from the module. Imports
+    that can't be made lazy (``import x.y`` without alias, references in strings, modules
+    defining their own ``__getattr__``) are left out of the plan. The files looked at to tell
+    submodules from attributes are added to ``dependencies``.
+    """
+    plan = LazyImportPlan()
+    has_getattr = any(
+        isinstance(statement, cst.FunctionDef) and statement.name.value == '__getattr__'
+        for statement in module.body
+    )
+    module_aliases: Set[str] = set()
+
+    for node in candidates:
+        info = index.imports[node]
+        if isinstance(node.names, cst.ImportStar):
+            continue
+        statements = []
+        replaced_names = {}
+        lazy_attrs = {}
+        new_aliases = set()
+        lazifiable = True
+        for alias in node.names:
+            imported = cst.helpers.get_full_name_for_node(alias.name)
+            bound = cst.helpers.get_full_name_for_node(alias.asname.name) if alias.asname else imported
+            if bound in info.unused_names:
+                continue
+            if isinstance(node, cst.Import):
+                if alias.asname is None and '.' in imported:
+                    lazifiable = False
+                    break
+                statements.append(_lazy_binding(bound, imported))
+                continue
+
+            from_module = cst.helpers.get_full_name_for_node(node.module) if node.module else ''
+            relative = '.' * len(node.relative)
+            if _is_submodule(source_path, from_module, len(node.relative), imported, dependencies):
+                target = f"{relative}{from_module}.{imported}" if from_module else f"{relative}{imported}"
+                statements.append(_lazy_binding(bound, target, package=bool(relative)))
+                continue
+            references = info.references.get(bound, [])
+            if has_getattr or not all(isinstance(ref, cst.Name) for ref in references):
+                lazifiable = False
+                break
+            module_alias = "_im_" + re.sub(r'\W', '_', f"{relative}{from_module}")
+            if module_alias not in module_aliases | new_aliases:
+                new_aliases.add(module_alias)
+                statements.append(_lazy_binding(module_alias, f"{relative}{from_module}", package=bool(relative)))
+            for ref in references:
+                replaced_names[ref] = cst.Attribute(value=cst.Name(module_alias), attr=cst.Name(imported))
+            lazy_attrs[bound] = (f"{relative}{from_module}", imported)
+
+        if not lazifiable:
+            logging.debug("Can't make import lazy: %s", _LazyCode(module, node))
+            continue
+        module_aliases |= new_aliases
+        plan.replacements[node] = statements
+        plan.replaced_names.update(replaced_names)
+        plan.lazy_attrs.update(lazy_attrs)
+    return plan
+
+def import_module_names(node: Union[cst.Import, cst.ImportFrom, ast.Import, ast.ImportFrom]) -> List[str]:
+    """Absolute module names an import statement may load (empty for relative imports).
+
+    ``from x import y`` lists both ``x`` and ``x.y``, since ``y`` may be a submodule.
+    Takes libcst as well as ``ast`` nodes.
+    """
+    if isinstance(node, ast.Import):
+        return [alias.name for alias in node.names]
+    if isinstance(node, ast.ImportFrom):
+        if node.level or node.module is None:
+            return []
+        return [node.module, *(f"{node.module}.{alias.name}" for alias in node.names if alias.name != '*')]
+    if isinstance(node, cst.Import):
+        return [cst.helpers.get_full_name_for_node(alias.name) for alias in node.names]
+    if node.relative or node.module is None:
+        return []
+    module = cst.helpers.get_full_name_for_node(node.module)
+    names = [module]
+    if not isinstance(node.names, cst.ImportStar):
+        names.extend(f"{module}.{cst.helpers.get_full_name_for_node(alias.name)}" for alias in node.names)
+    return names
+
+def import_cost(node: Union[cst.Import, cst.ImportFrom, ast.Import, ast.ImportFrom], import_costs: Dict[str, float]) -> Optional[float]:
+    """Measured cost in ms of an import statement, or None if none of its modules were profiled."""
+    costs = [import_costs[name] for name in import_module_names(node) if name in import_costs]
+    return max(costs) if costs else None
+
+# What a [tool.import_mover] rule can do with the imports of a module (see load_config).
+# When the modules of one statement have different rules, the first of these wins.
+IMPORT_RULE_ACTIONS = ("keep", "type-checking", "lazy", "defer")
+
+def import_rule(
+    node: Union[cst.Import, cst.ImportFrom, ast.Import, ast.ImportFrom],
+    import_rules: Dict[str, str],
+) -> Optional[Tuple[str, str]]:
+    """The (action, module) rule applying to an import statement, if any.
+
+    A rule for ``a.b`` applies to ``a.b`` and its submodules, not to ``a`` or ``a.bc``; the rule
+    of the longest matching name counts. Relative imports have no rules.
+    """
+    matches = []
+    for name in import_module_names(node):
+        while name and name not in import_rules:
+            name = name.rpartition('.')[0]
+        if name:
+            matches.append((IMPORT_RULE_ACTIONS.index(import_rules[name]), name))
+    if not matches:
+        return None
+    _, module = min(matches)
+    return import_rules[module], module
+
+def is_whitelisted(node: Union[cst.Import, cst.ImportFrom, ast.Import, ast.ImportFrom], whitelist_libs: Set[str]) -> bool:
+    """Whether an import statement loads a ``--whitelist`` module or a submodule of one (absolute imports only).
+
+    ``re`` whitelists ``import re`` and ``from re import x``, not ``import requests``.
+    """
+    return any(
+        name == lib or name.startswith(f"{lib}.")
+        for name in import_module_names(node) for lib in whitelist_libs
+    )
+
+def is_preloaded(node: Union[cst.Import, cst.ImportFrom, ast.Import, ast.ImportFrom], preloaded_modules: Set[str]) -> bool:
+    """Whether all modules an import statement loads are already loaded anyway (absolute imports only)."""
+    modules = import_module_names(node)
+    if isinstance(node, (ast.ImportFrom, cst.ImportFrom)):
+        modules = modules[:1]  # the imported names may be anything
+    return bool(modules) and all(module in preloaded_modules for module in modules)
+
+def _is_hot_function(
+    node: cst.CSTNode,
+    hot_functions: Iterable[Tuple[str, int]],
+    positions: Dict[cst.CSTNode, cst.metadata.CodeRange],
+) -> bool:
+    """Whether a profiled (name, line) pair falls in the function ``node`` (decorators included)."""
+    if not isinstance(node, cst.FunctionDef):
+        return False
+    code_range = positions[node]
+    return any(
+        name == node.name.value and code_range.start.line <= line <= code_range.end.line
+        for name, line in hot_functions
+    )
+
+TYPE_CHECKING_FALLBACK = "TYPE_CHECKING = False  # type checkers go by the name; saves importing typing"
+# For package ``__init__`` files, whose public names ``TYPE_CHECKING`` would join
+TYPE_CHECKING_ALIAS = "from typing import TYPE_CHECKING as _IM_TYPE_CHECKING"
+
+@dataclass
+class TypeCheckingPlan:
+    """Annotation-only imports moved into an ``if TYPE_CHECKING:`` block."""
+    imports: List[Union[cst.Import, cst.ImportFrom]] = field(default_factory=list)
+    # The block replaces the last of the moved imports
+    replacements: Dict[Union[cst.Import, cst.ImportFrom], List[cst.BaseStatement]] = field(default_factory=dict)
+    replaced_annotations: Dict[cst.Annotation, cst.Annotation] = field(default_factory=dict)
+    header: List[cst.BaseStatement] = field(default_factory=list)
+
+def _has_future_annotations(module: cst.Module) -> bool:
+    return any(
+        isinstance(small, cst.ImportFrom) and small.module is not None and
+        cst.helpers.get_full_name_for_node(small.module) == '__future__' and
+        not isinstance(small.names, cst.ImportStar) and
+        any(alias.name.value == 'annotations' for alias in small.names)
+        for statement in module.body[:_module_header_position(module.body)]
+        for small in statement.body
+    )
+
+def _quoted_annotation(annotation: cst.Annotation, module: cst.Module) -> Optional[cst.Annotation]:
+    """``annotation`` as a string annotation, or None if its code can't be put in quotes as is."""
+    code = module.code_for_node(annotation.annotation)
+    if '\n' in code or '\\' in code:
+        return None
+    for quote in ('"', "'"):
+        if quote not in code:
+            return annotation.with_changes(annotation=cst.SimpleString(f"{quote}{code}{quote}"))
+    return None
+
+def plan_type_checking_imports(
+    wrapper: cst.metadata.MetadataWrapper,
+    index: ImportIndex,
+    candidates: Iterable[Union[cst.Import, cst.ImportFrom]],
+    mode: str = "quote",
+) -> TypeCheckingPlan:
+    """Move global imports only referenced in annotations into an ``if TYPE_CHECKING:`` block.
+
+    Annotations evaluated at runtime (signatures, module level variables) must not reference
+    them anymore: with ``mode="future"`` the module gets ``from __future__ import annotations``,
+    with ``"quote"`` those annotations become strings. Imports with annotations that can't be
+    quoted, and imports used in class body annotations (which dataclasses and the like read),
+    are left out of the plan. Only statements directly in the module body are considered.
+    """
+    plan = TypeCheckingPlan()
+    module = wrapper.module
+    top_level = {small for statement in module.body if isinstance(statement, cst.SimpleStatementLine)
+                 for small in statement.body}
+    future = _has_future_annotations(module)
+    parents = wrapper.resolve(cst.metadata.ParentNodeProvider)
+    scopes = wrapper.resolve(cst.metadata.ScopeProvider)
+
+    for node in candidates:
+        info = index.imports[node]
+        if node not in top_level or isinstance(node.names, cst.ImportStar) or not info.annotation_only:
+            continue
+        annotations = {}
+        for ref in info.annotation_references:
+            annotation = ref
+            while annotation is not None and not isinstance(annotation, cst.Annotation):
+                annotation = parents.get(annotation)
+            annotations[ref] = annotation
+        # Class body annotations are read at runtime (dataclasses, NamedTuple, TypedDict, attrs,
+        # pydantic): ``ClassVar``, ``InitVar`` and the like must stay importable and unquoted
+        if any(annotation is not None and isinstance(parents[annotation], cst.AnnAssign) and
+               isinstance(scopes[parents[annotation]], cst.metadata.ClassScope) for annotation in annotations.values()):
+            logging.debug("Import used in class body annotations: %s", _LazyCode(module, node))
+            continue
+        quoted = {}
+        for ref, annotation in annotations.items():
+            if future or mode == "future" or isinstance(ref, (cst.SimpleString, cst.ConcatenatedString)):
+                continue  # a string already
+            if annotation is None:
+                quoted[ref] = None
+                continue
+            owner = parents[annotation]
+            if isinstance(owner, cst.AnnAssign) and _enclosing_function_scope(scopes[owner]) is not None:
+                continue  # local variable annotations are never evaluated
+            if annotation not in plan.replaced_annotations and annotation not in quoted:
+                quoted[annotation] = _quoted_annotation(annotation, module)
+        if any(value is None for value in quoted.values()):
+            logging.debug("Can't quote the annotations using %s", _LazyCode(module, node))
+            continue
+        plan.replaced_annotations.update(quoted)
+        plan.imports.append(node)
+
+    if not plan.imports:
+        return plan
+    if mode == "future" and not future:
+        plan.header.append(cst.parse_statement("from __future__ import annotations\n"))
+
+    # Define TYPE_CHECKING unless the module binds it before the block
+    positions = wrapper.resolve(cst.metadata.PositionProvider)
+    last = max(plan.imports, key=lambda node: positions[node].start.line)
+    global_scope = scopes[module]
+    bindings = [positions[assignment.node].start.line for assignment in global_scope.assignments['TYPE_CHECKING']
+                if isinstance(assignment, cst.metadata.Assignment)]
+    lines = []
+    if not bindings:
+        lines.append(TYPE_CHECKING_FALLBACK)
+    elif min(bindings) > positions[last].start.line:
+        lines.append("from typing import TYPE_CHECKING")
+    lines.append("if TYPE_CHECKING:")
+    lines.extend(f"    {module.code_for_node(node).strip()}" for node in plan.imports)
+    plan.replacements[last] = list(cst.parse_module("\n".join(lines) + "\n").body)
+    return plan
+
+@dataclass
+class ImportPlan:
+    """What to do with the imports of one module; turned into an ImportRewriteTransformer."""
+    unused_imports: Dict[Union[cst.Import, cst.ImportFrom], Set[str]] = field(default_factory=lambda: defaultdict(set))
+    imports_by_function: Dict[str, List[cst.CSTNode]] = field(default_factory=lambda: defaultdict(list))
+    # Imports that stay global, with the reason why
+    keep_global_imports: Dict[Union[cst.Import, cst.ImportFrom], str] = field(default_factory=dict)
+    removed_imports: Set[Union[cst.Import, cst.ImportFrom]] = field(default_factory=set)
+    replacements: Dict[Union[cst.Import, cst.ImportFrom], List[cst.SimpleStatementLine]] = field(default_factory=dict)
+    replaced_names: Dict[cst.Name, cst.BaseExpression] = field(default_factory=dict)
+    header: List[cst.BaseStatement] = field(default_factory=list)
+    trailer: List[cst.BaseStatement] = field(default_factory=list)
+    # Imports that stay global but are only loaded on first use
+    lazy_imports: List[Union[cst.Import, cst.ImportFrom]] = field(default_factory=list)
+    # Imports moved into an ``if TYPE_CHECKING:`` block
+    type_checking_imports: List[Union[cst.Import, cst.ImportFrom]] = field(default_factory=list)
+    replaced_annotations: Dict[cst.Annotation, cst.Annotation] = field(default_factory=dict)
+
+    def transformer(self, module: cst.Module, keep_old_imports: bool = True) -> ImportRewriteTransformer:
+        return ImportRewriteTransformer(
+            self.imports_by_function,
+            module=module,
+            removed_imports=self.removed_imports,
+            keep_old_imports=keep_old_imports,
+            replacements=self.replacements,
+            replaced_names=self.replaced_names,
+            replaced_annotations=self.replaced_annotations,
+            header=self.header,
+            trailer=self.trailer,
+        )
+
+def plan_imports(
+    wrapper: cst.metadata.MetadataWrapper,
+    index: ImportIndex,
     source_path: Path,
-    log_path: Optional[str],
-    output_path: str,
-    keep_old_imports: bool = True,
     remove_unused_imports: bool = True,
     whitelist_libs: Optional[Set[str]] = None,
-) -> None:
-    """Process a Python file to move imports into functions where they are used."""
-    # Skip __init__.py files by default
-    if source_path.name == "__init__.py":
-        logging.info(f"Skipping __init__.py file: {source_path}")
-        return
+    import_costs: Optional[Dict[str, float]] = None,
+    cost_threshold_ms: float = 0.0,
+    strategy: str = "move",
+    movable_imports: Optional[Set[str]] = None,
+    hot_functions: Optional[Iterable[Tuple[str, int]]] = None,
+    hot_action: str = "keep",
+    hoist: bool = False,
+    type_checking: Optional[str] = None,
+    import_rules: Optional[Dict[str, str]] = None,
+    preloaded_modules: Optional[Set[str]] = None,
+    dependencies: Optional[Set[Path]] = None,
+) -> ImportPlan:
+    """Decide which imports stay global, which are moved into functions and which are unused.
+
+    If ``movable_imports`` is given, only global import statements whose code is in it
+    may be taken out of the module scope.
+
+    ``hot_functions`` are the (name, line) pairs of functions called too often to pay for an
+    import statement on every call (see ``load_call_profile``). Global imports used in them are
+    kept global (``hot_action="keep"``) or become lazily loaded bindings (``"lazy"``), which cost
+    a plain global lookup once loaded.
+
+    ``imports_by_function`` is keyed by qualified function name; with ``hoist``, an import used
+    in several functions nested in the same function goes into their lowest common enclosing
+    function (see ``placement_scopes``).
+
+    With ``type_checking`` (``"quote"`` or ``"future"``), imports only used in annotations go
+    into an ``if TYPE_CHECKING:`` block (see ``plan_type_checking_imports``).
+
+    ``import_rules`` maps module names to one of ``IMPORT_RULE_ACTIONS`` (see ``import_rule``):
+    ``"keep"`` keeps their imports global; ``"defer"``, ``"lazy"`` (a lazily loaded binding
+    whatever the ``strategy``) and ``"type-checking"`` (if only used in annotations, quoted
+    unless ``type_checking`` says otherwise) override the whitelist, the cost threshold, the
+    entry point plan and ``preloaded_modules``, whose imports are otherwise kept global.
+
+    Other files read to plan lazy imports are added to ``dependencies`` (see ``plan_lazy_imports``).
+    """
+    global_imports = {info.node for info in index.global_imports()}
+    logging.debug("Found %s imports, %s of them global", len(index.imports), len(global_imports))
 
-    # Read and parse the source code
-    source_code = source_path.read_text()
-    wrapper = cst.metadata.MetadataWrapper(cst.parse_module(source_code))
-    
-    # Get scope information
-    scopes = set(wrapper.resolve(cst.metadata.ScopeProvider).values())
-    logging.debug(f"Found {len(scopes)} scopes:")
-    for scope in scopes:
-        logging.debug(f"  Scope type: {type(scope).__name__}")
-        if hasattr(scope, 'name'):
-            logging.debug(f"    Name: {scope.name}")
-    
     # Track unused imports and their locations
     unused_imports: Dict[Union[cst.Import, cst.ImportFrom], Set[str]] = defaultdict(set)
     imports_by_function: Dict[str, List[cst.CSTNode]] = defaultdict(list)
-    
-    # Track line numbers of global imports and imports used in class/decorator definitions
-    global_import_lines = []
-    keep_global_imports = set()
-    
+
+    # Imports that stay global, with the first reason found
+    keep_global_imports: Dict[Union[cst.Import, cst.ImportFrom], str] = {}
+
+    # Project rules come first; the imports they defer are exempt from the checks below
+    rules: Dict[Union[cst.Import, cst.ImportFrom], str] = {}
+    if import_rules:
+        for node in global_imports:
+            rule = import_rule(node, import_rules)
+            if rule is not None:
+                rules[node] = rule[0]
+                if rule[0] == "keep":
+                    keep_global_imports.setdefault(node, f"kept by the rule for {rule[1]}")
+    deferred_by_rule = {node for node, action in rules.items() if action != "keep"}
+
+    # Modules loaded at startup anyway cost nothing to import
+    if preloaded_modules:
+        for node in global_imports - deferred_by_rule:
+            if is_preloaded(node, preloaded_modules):
+                keep_global_imports.setdefault(node, "already loaded at startup")
+
     # Keep whitelisted library imports at global scope
     if whitelist_libs:
-        for scope in scopes:
-            if isinstance(scope, cst.metadata.GlobalScope):
-                for assignment in scope.assignments:
-                    if isinstance(assignment.node, (cst.Import, cst.ImportFrom)):
-                        import_str = wrapper.module.code_for_node(assignment.node)
-                        if any(lib in import_str for lib in whitelist_libs):
-                            keep_global_imports.add(assignment.node)
-                            logging.debug(f"Keeping whitelisted import: {import_str}")
-    
-    # First pass: identify imports used in class definitions and decorators
-    for scope in scopes:
-        if isinstance(scope, cst.metadata.ClassScope):
-            # Get the class node
-            class_def = scope.node
-            # Check class bases for imports
-            for base in class_def.bases:
-                if isinstance(base.value, cst.Name):
-                    # Find the import that defines this base class
-                    for assignment in scope.parent.assignments:
-                        if (isinstance(assignment, cst.metadata.Assignment) and 
-                            assignment.name == base.value.value and
-                            isinstance(assignment.node, (cst.Import, cst.ImportFrom))):
-                            keep_global_imports.add(assignment.node)
-                            logging.debug(f"Found import used in class definition: {wrapper.module.code_for_node(assignment.node)}")
-            
-            # Check class decorators
-            for decorator in class_def.decorators:
-                if isinstance(decorator.decorator, cst.Name):
-                    # Find the import that defines this decorator
-                    for assignment in scope.parent.assignments:
-                        if (isinstance(assignment, cst.metadata.Assignment) and 
-                            assignment.name == decorator.decorator.value and
-                            isinstance(assignment.node, (cst.Import, cst.ImportFrom))):
-                            keep_global_imports.add(assignment.node)
-                            logging.debug(f"Found import used in class decorator: {wrapper.module.code_for_node(assignment.node)}")
-        
-        elif isinstance(scope, cst.metadata.FunctionScope):
-            # Get the function node
-            func_def = scope.node
-            # Skip lambda functions as they don't have decorators
-            if isinstance(func_def, cst.Lambda):
-                continue
-            
-            # Check function decorators
-            for decorator in func_def.decorators:
-                if isinstance(decorator.decorator, cst.Name):
-                    # Find the import that defines this decorator
-                    for assignment in scope.parent.assignments:
-                        if (isinstance(assignment, cst.metadata.Assignment) and 
-                            assignment.name == decorator.decorator.value and
-                            isinstance(assignment.node, (cst.Import, cst.ImportFrom))):
-                            keep_global_imports.add(assignment.node)
-                            logging.debug(f"Found import used in function decorator: {wrapper.module.code_for_node(assignment.node)}")
-    
-    # Analyze scopes to find unused imports and function usage
-    for scope in scopes:
-        scope_name = getattr(scope, 'name', 'global')
-        assignments = list(scope.assignments)  # Convert to list
-        logging.debug(f"\nAnalyzing scope: {scope_name}")
-        logging.debug(f"  Found {len(assignments)} assignments")
-        
-        for assignment in assignments:
-            if isinstance(assignment, cst.metadata.Assignment):
-                node = assignment.node
-                if isinstance(node, (cst.Import, cst.ImportFrom)):
-                    # Get the line number of this import
-                    pos = wrapper.resolve(cst.metadata.PositionProvider)[node]
-                    logging.debug(f"  Found import at line {pos.start.line}: {wrapper.module.code_for_node(node)}")
-                    logging.debug(f"    Assignment name: {assignment.name}")
-                    logging.debug(f"    References: {len(assignment.references)}")
-                    
-                    if isinstance(scope, cst.metadata.GlobalScope):
-                        global_import_lines.append(pos.start.line)
-                        logging.debug(f"    Added to global imports")
-                        
-                    # Skip moving imports used in class definitions or decorators
-                    if node in keep_global_imports:
-                        logging.debug(f"    Keeping as global (used in class/decorator)")
-                        continue
-                        
-                    if len(assignment.references) == 0:
-                        unused_imports[node].add(assignment.name)
-                        logging.debug(f"    Marked as unused")
-                    else:
-                        logging.debug(f"    Reference locations:")
-                        for ref in assignment.references:
-                            ref_scope = ref.scope
-                            ref_scope_name = getattr(ref_scope, 'name', 'global')
-                            logging.debug(f"      - In scope: {ref_scope_name} ({type(ref_scope).__name__})")
-                            if isinstance(ref.scope, cst.metadata.scope_provider.FunctionScope):
-                                imports_by_function[ref.scope.name].append(node)
-                                logging.debug(f"        Added to function imports for {ref.scope.name}")
-
-    logging.debug("\nSummary:")
-    logging.debug("Unused imports:")
-    for node, names in unused_imports.items():
-        logging.debug(f"  {wrapper.module.code_for_node(node)}: {names}")
-    
-    logging.debug("\nImports by function:")
-    for func_name, imports in imports_by_function.items():
-        logging.debug(f"  {func_name}:")
-        for imp in imports:
-            logging.debug(f"    {wrapper.module.code_for_node(imp)}")
+        for node in global_imports - deferred_by_rule:
+            if is_whitelisted(node, whitelist_libs):
+                keep_global_imports.setdefault(node, "whitelisted")
+                logging.debug("Keeping whitelisted import: %s", _LazyCode(wrapper.module, node))
+
+    # Keep imports that are too cheap to be worth deferring at global scope
+    if import_costs is not None:
+        for node in global_imports - deferred_by_rule:
+            cost = import_cost(node, import_costs)
+            if cost is not None and cost < cost_threshold_ms:
+                keep_global_imports.setdefault(node, f"cheap ({cost:.2f} ms)")
+                logging.debug("Keeping cheap import (%.2f ms): %s", cost, _LazyCode(wrapper.module, node))
+
+    # Restrict the rewrite to imports known to be worth deferring (see plan_startup_moves)
+    if movable_imports is not None:
+        for node in global_imports - deferred_by_rule:
+            if wrapper.module.code_for_node(node) not in movable_imports:
+                keep_global_imports.setdefault(node, "not deferred by the entry point plan")
+
+    # Keep imports used in hot functions out of the function bodies
+    hot_imports = set()
+    if hot_functions:
+        positions = wrapper.resolve(cst.metadata.PositionProvider)
+        for node in global_imports:
+            hot = [
+                qualified_scope_name(scope) for scope in index.imports[node].function_scopes
+                if _is_hot_function(scope.node, hot_functions, positions)
+            ]
+            if hot:
+                hot_imports.add(node)
+                logging.debug("Import used in hot functions %s: %s", hot, _LazyCode(wrapper.module, node))
+        if hot_action == "lazy":
+            # Imports that can't be made lazy stay global
+            lazifiable = plan_lazy_imports(index, hot_imports, wrapper.module, source_path, dependencies).replacements
+            for node in hot_imports - set(lazifiable):
+                keep_global_imports.setdefault(node, "used in hot functions, can't be made lazy")
+            hot_imports &= set(lazifiable)
+        else:
+            for node in hot_imports:
+                keep_global_imports.setdefault(node, "used in hot functions")
 
-    # Create transformers
-    transformers = []
-    
-    # Add RemoveUnusedImportTransformer if needed
+    # Imports only needed by type checkers aren't executed at all
+    type_checking_plan = TypeCheckingPlan()
+    type_checking_rules = {node for node, action in rules.items() if action == "type-checking"}
+    if type_checking or type_checking_rules:
+        # The block needs TYPE_CHECKING even if nothing else uses it
+        binds_type_checking = {
+            node for (scope, name), node in index.by_name.items()
+            if name == 'TYPE_CHECKING' and isinstance(scope, cst.metadata.GlobalScope)
+        }
+        type_checking_plan = plan_type_checking_imports(
+            wrapper,
+            index,
+            [info.node for info in sorted(index.global_imports(), key=lambda info: info.line)
+             if info.node not in keep_global_imports and info.node not in binds_type_checking
+             and (type_checking or info.node in type_checking_rules)],
+            mode=type_checking or "quote",
+        )
+        if type_checking_plan.imports:
+            for node in binds_type_checking:
+                keep_global_imports.setdefault(node, "binds TYPE_CHECKING")
+        for node in type_checking_plan.imports:
+            logging.debug("Moving annotation-only import under TYPE_CHECKING: %s", _LazyCode(wrapper.module, node))
+
+    # Imports used where code runs at import time (module level, class bodies, class bases,
+    # decorators) must stay global
+    for node in global_imports:
+        if index.imports[node].used_at_module_level and node not in type_checking_plan.imports:
+            keep_global_imports.setdefault(node, "used at module level")
+            logging.debug("Found import used at module level (class/decorator): %s", _LazyCode(wrapper.module, node))
+
+    # Find unused imports and the functions each import is used in
+    for node, info in index.imports.items():
+        logging.debug("Import at line %s: %s", info.line, _LazyCode(wrapper.module, node))
+        # Skip moving imports used in class definitions or decorators
+        if node in keep_global_imports:
+            logging.debug("    Keeping as global (used in class/decorator)")
+            continue
+        if node in type_checking_plan.imports:
+            continue
+
+        if info.unused_names:
+            unused_imports[node].update(info.unused_names)
+            logging.debug("    Marked as unused: %s", info.unused_names)
+        if not isinstance(info.scope, cst.metadata.GlobalScope):
+            continue  # already local to the functions using it
+        for function_scope in placement_scopes(info.function_scopes, hoist=hoist):
+            function_name = qualified_scope_name(function_scope)
+            imports_by_function[function_name].append(node)
+            logging.debug("    Added to function imports for %s", function_name)
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("\nSummary:")
+        logging.debug("Unused imports:")
+        for node, names in unused_imports.items():
+            logging.debug("  %s: %s", _LazyCode(wrapper.module, node), names)
+
+        logging.debug("\nImports by function:")
+        for func_name, imports in imports_by_function.items():
+            logging.debug("  %s:", func_name)
+            for imp in imports:
+                logging.debug("    %s", _LazyCode(wrapper.module, imp))
+
+    # Global imports that are not kept are taken out of the module scope; unused imports are
+    # taken out wherever they are
+    removed_imports = global_imports - keep_global_imports.keys()
     if remove_unused_imports:
-        transformers.append(RemoveUnusedImportTransformer(
-            unused_imports, 
-            keep_old_imports=keep_old_imports,
-            module=wrapper.module
-        ))
-    
-    # Add MoveImportsTransformer
-    transformers.append(MoveImportsTransformer(imports_by_function, module=wrapper.module))
-    
-    # Apply transformations
-    modified_module = wrapper.module
-    for transformer in transformers:
-        modified_module = modified_module.visit(transformer)
-    
-    # Create a temporary file
-    temp_output = Path(output_path).with_suffix('.tmp')
-    try:
-        # Write modified code to temp file
-        temp_output.write_text(modified_module.code)
-        
-        # Read the temp file and modify global imports
-        with temp_output.open('r') as f:
-            lines = f.readlines()
-        
-        # Comment out global imports except those used in class definitions or decorators
-        modified_lines = []
-        for i, line in enumerate(lines, start=1):
-            line_contains_kept_import = any(
-                wrapper.module.code_for_node(imp) in line 
-                for imp in keep_global_imports
-            )
-            
-            if (i in global_import_lines and line.strip() and 
-                not line.strip().startswith('#') and 
-                not line_contains_kept_import):
-                modified_lines.append(f"# {line}")
-                logging.debug(f"Commented out line {i}: {line.strip()}")
-            else:
-                modified_lines.append(line)
-        
-        # Write final output
-        Path(output_path).write_text(''.join(modified_lines))
-        
-        # Clean up temp file
-        temp_output.unlink()
-        
-    except Exception as e:
-        # Clean up temp file if it exists
-        if temp_output.exists():
-            temp_output.unlink()
-        raise e
-    
-    # Log changes if requested
-    if log_path:
-        with open(log_path, 'w') as f:
-            # Log unused imports
-            for node, names in unused_imports.items():
-                for name in names:
-                    f.write(f"Unused import: {name}\n")
-            
-            # Log imports moved to functions
-            for func_name, imports in imports_by_function.items():
-                f.write(f"\nImports moved to function {func_name}:\n")
-                for imp in imports:
-                    # Use module.code_for_node for generating code
-                    f.write(f"  {wrapper.module.code_for_node(imp)}\n")
-
-def main():
-    parser = argparse.ArgumentParser(description='Move global imports into functions where they are used.')
-    parser.add_argument('file', type=str, help='Python file to process')
-    parser.add_argument('--log', type=str, help='Log file to write changes to')
-    parser.add_argument('--log-level', type=str, default='DEBUG',
-                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
-                      help='Set the logging level')
-    parser.add_argument('-o', '--output', type=str, default=None,
-                      help='Modified file path (default is with a suffix "_im")')
-    parser.add_argument('--keep-old-imports', action='store_true', default=True,
-                      help='Keep old imports as comments (default: True)')
-    parser.add_argument('--remove-unused-imports', action='store_true', default=True,
-                      help='Remove unused imports instead of commenting them (default: True)')
-    parser.add_argument('--whitelist', type=str,
-                      help='Comma-separated list of libraries to keep at global scope')
-    parser.add_argument('--ignore-files', type=str,
-                      help='Regular expression pattern for files to ignore')
+        removed_imports |= set(unused_imports)
 
-    args = parser.parse_args()
-    
-    # Process whitelist
-    whitelist_libs = set(lib.strip() for lib in args.whitelist.split(',')) if args.whitelist else None
-    
-    # If the --output flag is not set, create default output path
-    if args.output is None:
-        args.output = str(Path(args.file).with_suffix('')) + '_im.py'
+    # With the lazy strategy, imports that would be moved stay global as lazily loaded
+    # bindings instead; those that can't be made lazy are still moved. Imports of hot
+    # functions to be made lazy were checked to be lazifiable above.
+    lazy_plan = LazyImportPlan()
+    lazy_candidates = {node for imports in imports_by_function.values() for node in imports}
+    if strategy != "lazy":
+        lazy_candidates &= hot_imports | {node for node, action in rules.items() if action == "lazy"}
+    if lazy_candidates:
+        lazy_plan = plan_lazy_imports(
+            index,
+            [node for node in index.imports if node in lazy_candidates and node in global_imports],
+            wrapper.module,
+            source_path,
+            dependencies,
+        )
+        for func_name in list(imports_by_function):
+            imports_by_function[func_name] = [
+                node for node in imports_by_function[func_name] if node not in lazy_plan.replacements
+            ]
+            if not imports_by_function[func_name]:
+                del imports_by_function[func_name]
 
-    # Configure logging
-    logging.basicConfig(
-        level=getattr(logging, args.log_level),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
+    return ImportPlan(
+        unused_imports=unused_imports,
+        imports_by_function=imports_by_function,
+        keep_global_imports=keep_global_imports,
+        removed_imports=removed_imports,
+        replacements={**lazy_plan.replacements, **type_checking_plan.replacements},
+        replaced_names=lazy_plan.replaced_names,
+        header=[*type_checking_plan.header, *lazy_plan.header()],
+        trailer=lazy_plan.trailer(),
+        lazy_imports=list(lazy_plan.replacements),
+        type_checking_imports=type_checking_plan.imports,
+        replaced_annotations=type_checking_plan.replaced_annotations,
     )
-    
+
+
+LAZY_EXPORTS_TEMPLATE = '''
+{type_checking_import}_IM_LAZY_EXPORTS = {table}
+
+if {type_checking}:
+{imports}
+
+
+def __getattr__(name):
+    # Re-exported names are only imported from their submodule on first access
+    if name in _IM_LAZY_EXPORTS:
+        import importlib
+        module_name, attr = _IM_LAZY_EXPORTS[name]
+        module = importlib.import_module(module_name, __name__)
+        if attr is None:
+            value = module
+        else:
+            try:
+                value = getattr(module, attr)
+            except AttributeError:
+                value = importlib.import_module(f"{{module_name}}.{{attr}}", __name__)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {{__name__!r}} has no attribute {{name!r}}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_IM_LAZY_EXPORTS))
+{all}'''
+
+LAZY_EXPORTS_ALL = '''
+
+# What ``from package import *`` exported before the re-exports were made lazy
+__all__ = sorted({name for name in globals() if not name.startswith("_")} | set(_IM_LAZY_EXPORTS))
+'''
+
+def plan_lazy_exports(wrapper: cst.metadata.MetadataWrapper, index: ImportIndex) -> ImportPlan:
+    """Make the relative re-exports of a package ``__init__`` load on first access.
+
+    Top-level ``from .sub import X`` / ``from . import sub`` statements whose names are not
+    used inside the ``__init__`` itself are replaced by a PEP 562 ``__getattr__``/``__dir__``
+    pair backed by a name -> (submodule, attribute) table. The original imports are kept in
+    an ``if TYPE_CHECKING:`` block for static tools. An existing ``__all__`` is left untouched;
+    without one, ``__all__`` is computed at the end of the module from its public names and
+    the table, so that ``from package import *`` still exports the re-exported names.
+    """
+    plan = ImportPlan()
+    module = wrapper.module
+    global_names = {assignment.name for assignment in wrapper.resolve(cst.metadata.ScopeProvider)[module].assignments}
+    if any(isinstance(statement, cst.FunctionDef) and statement.name.value in ('__getattr__', '__dir__')
+           for statement in module.body):
+        logging.info("Not making re-exports lazy: module already defines __getattr__/__dir__")
+        return plan
+
+    exports: Dict[str, Tuple[str, Optional[str]]] = {}
+    for statement in module.body:
+        if not isinstance(statement, cst.SimpleStatementLine):
+            continue
+        for node in statement.body:
+            if not (isinstance(node, cst.ImportFrom) and node.relative and
+                    not isinstance(node.names, cst.ImportStar) and node in index.imports):
+                continue
+            info = index.imports[node]
+            if info.is_used:
+                logging.debug("Keeping re-export used in __init__: %s", _LazyCode(module, node))
+                continue
+            relative = '.' * len(node.relative)
+            from_module = cst.helpers.get_full_name_for_node(node.module) if node.module else ''
+            for alias in node.names:
+                imported = cst.helpers.get_full_name_for_node(alias.name)
+                bound = cst.helpers.get_full_name_for_node(alias.asname.name) if alias.asname else imported
+                if from_module:
+                    exports[bound] = (f"{relative}{from_module}", imported)
+                else:
+                    exports[bound] = (f"{relative}{imported}", None)
+            plan.removed_imports.add(node)
+            plan.lazy_imports.append(node)
+
+    if not exports:
+        return plan
+
+    # A TYPE_CHECKING bound by the module is reused; ours must not become a public name of the package
+    if "TYPE_CHECKING" in global_names:
+        type_checking, type_checking_import = "TYPE_CHECKING", ""
+    else:
+        type_checking, type_checking_import = "_IM_TYPE_CHECKING", f"{TYPE_CHECKING_ALIAS}\n\n"
+    table = "{\n" + "".join(f"    {name!r}: {target!r},\n" for name, target in exports.items()) + "}"
+    imports = "\n".join(f"    {module.code_for_node(node).strip()}" for node in plan.lazy_imports)
+    plan.trailer = list(cst.parse_module(LAZY_EXPORTS_TEMPLATE.format(
+        type_checking=type_checking,
+        type_checking_import=type_checking_import,
+        table=table,
+        imports=imports,
+        all="" if "__all__" in global_names else LAZY_EXPORTS_ALL,
+    )).body)
+    return plan
+
+DEFERRED_CONSTANT_TEMPLATE = '''
+def _im_{name}():
+    """``{name}``, computed on first use."""
+    global {name}
     try:
-        source_path = Path(args.file)
-        if not source_path.exists():
-            raise FileNotFoundError(f"File not found: {args.file}")
-            
-        # Check if file should be ignored
-        if args.ignore_files and re.match(args.ignore_files, str(source_path)):
-            logging.info(f"Skipping ignored file: {source_path}")
-            return
-            
-        process_file(
-            source_path,
-            args.log,
-            args.output,
-            keep_old_imports=args.keep_old_imports,
-            remove_unused_imports=args.remove_unused_imports,
-            whitelist_libs=whitelist_libs,
+        return {name}
+    except NameError:
+        {name} = {value}
+        return {name}
+'''
+
+DEFERRED_GETATTR_TEMPLATE = '''
+_IM_DEFERRED_CONSTANTS = {table}
+
+
+def __getattr__(name):
+    # Deferred module level constants are computed on first access
+    if name in _IM_DEFERRED_CONSTANTS:
+        return _IM_DEFERRED_CONSTANTS[name]()
+    raise AttributeError(f"module {{__name__!r}} has no attribute {{name!r}}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_IM_DEFERRED_CONSTANTS))
+'''
+
+@dataclass
+class DeferredConstantsPlan:
+    """Module level constants to compute on first use, and why the others can't be."""
+    # Name -> its assignment statement, in module order
+    deferred: Dict[str, cst.SimpleStatementLine] = field(default_factory=dict)
+    # Name -> reason, for constants computed from imports that stay as they are
+    kept: Dict[str, str] = field(default_factory=dict)
+
+class DeferConstantsTransformer(cst.CSTTransformer):
+    """Replace deferred constants by memoizing accessors and their in-module uses by accessor calls."""
+    def __init__(self, plan: DeferredConstantsPlan, references: Set[cst.Name], module: cst.Module):
+        self.plan = plan
+        self.references = references
+        self.module = module
+        self.statements = {statement: name for name, statement in plan.deferred.items()}
+        # Original statement -> number of lines its replacement adds
+        self.added_lines: Dict[cst.SimpleStatementLine, int] = {}
+        super().__init__()
+
+    def leave_Name(self, original_node: cst.Name, updated_node: cst.Name) -> cst.BaseExpression:
+        if original_node in self.references:
+            return cst.Call(func=cst.Name(f"_im_{original_node.value}"))
+        return updated_node
+
+    def leave_SimpleStatementLine(
+        self, original_node: cst.SimpleStatementLine, updated_node: cst.SimpleStatementLine
+    ) -> cst.BaseStatement:
+        name = self.statements.get(original_node)
+        if name is None:
+            return updated_node
+        # The annotation of ``NAME: T = value`` is dropped: at module level it is evaluated
+        accessor = cst.parse_statement(DEFERRED_CONSTANT_TEMPLATE.format(
+            name=name, value=self.module.code_for_node(updated_node.body[0].value),
+        ))
+        accessor = accessor.with_changes(leading_lines=updated_node.leading_lines or [cst.EmptyLine(), cst.EmptyLine()])
+        self.added_lines[original_node] = (
+            self.module.code_for_node(accessor).count('\n') - self.module.code_for_node(original_node).count('\n')
         )
-        logging.info(f"Successfully processed {args.file} --> output file: {args.output}")
-        
-    except Exception as e:
-        logging.error(f"Error processing file: {e}")
+        return accessor
+
+    def leave_Module(self, original_node: cst.Module, updated_node: cst.Module) -> cst.Module:
+        body = list(updated_node.body)
+        # Two blank lines after each accessor
+        for i, (original, updated) in enumerate(zip(original_node.body[:-1], updated_node.body[:-1])):
+            following = body[i + 1]
+            if original in self.statements and not following.leading_lines:
+                body[i + 1] = following.with_changes(leading_lines=[cst.EmptyLine(), cst.EmptyLine()])
+                self.added_lines[original] += 2
+        table = "{" + ", ".join(f"{name!r}: _im_{name}" for name in self.plan.deferred) + "}"
+        trailer = list(cst.parse_module(DEFERRED_GETATTR_TEMPLATE.format(table=table)).body)
+        trailer[0] = trailer[0].with_changes(leading_lines=[cst.EmptyLine(), cst.EmptyLine()])
+        return updated_node.with_changes(body=[*body, *trailer])
+
+def _constant_assignment(statement: cst.BaseStatement) -> Optional[Tuple[str, cst.BaseExpression]]:
+    """``(name, value)`` of a module level ``NAME = value`` / ``NAME: T = value`` statement."""
+    if not (isinstance(statement, cst.SimpleStatementLine) and len(statement.body) == 1):
+        return None
+    small = statement.body[0]
+    if isinstance(small, cst.Assign) and len(small.targets) == 1 and isinstance(small.targets[0].target, cst.Name):
+        return small.targets[0].target.value, small.value
+    if isinstance(small, cst.AnnAssign) and small.value is not None and isinstance(small.target, cst.Name):
+        return small.target.value, small.value
+    return None
+
+def _node_within(positions: Mapping[cst.CSTNode, cst.metadata.CodeRange], node: cst.CSTNode, outer: cst.CSTNode) -> bool:
+    """Whether ``node`` lies inside ``outer`` according to the resolved ``positions``."""
+    inner, outer = positions[node], positions[outer]
+    return ((outer.start.line, outer.start.column) <= (inner.start.line, inner.start.column) and
+            (inner.end.line, inner.end.column) <= (outer.end.line, outer.end.column))
+
+
+def plan_deferred_constants(wrapper: cst.metadata.MetadataWrapper, index: ImportIndex) -> Tuple[DeferredConstantsPlan, Set[cst.Name]]:
+    """Find module level constants whose computation is all that pins an import to startup.
+
+    A constant can be deferred if it is assigned once, everything its value depends on is
+    assigned once too, and it is only used in functions or in the values of other deferred
+    constants. It is only worth it if an import then stops being needed at import time.
+    Returns the plan and the in-module references to replace by accessor calls.
+    """
+    plan = DeferredConstantsPlan()
+    module = wrapper.module
+    positions = wrapper.resolve(cst.metadata.PositionProvider)
+    scopes = wrapper.resolve(cst.metadata.ScopeProvider)
+    global_scope = scopes[module]
+
+    def at_import_time(node: cst.CSTNode) -> bool:
+        return _enclosing_function_scope(scopes[node]) is None
+
+    global_names = {assignment.name for assignment in global_scope.assignments}
+    imports = [info for info in index.global_imports() if info.is_used]
+    candidates: Dict[str, Tuple[cst.SimpleStatementLine, cst.BaseExpression, Set[str]]] = {}
+    for statement in module.body:
+        constant = _constant_assignment(statement)
+        if constant is None:
+            continue
+        name, value = constant
+        # Imports used in the statement (the annotation goes too), directly or through earlier candidates
+        uses = {
+            module.code_for_node(info.node) for info in imports
+            if any(_node_within(positions, ref, statement) for refs in info.references.values() for ref in refs)
+        }
+        for other, (_, _, other_uses) in candidates.items():
+            if any(_node_within(positions, ref.node, value)
+                   for assignment in global_scope.assignments[other] for ref in assignment.references):
+                uses |= other_uses
+        if not uses:
+            continue
+        candidates[name] = (statement, value, uses)
+        if any(isinstance(s, cst.FunctionDef) and s.name.value in ('__getattr__', '__dir__') for s in module.body):
+            plan.kept[name] = "the module defines __getattr__/__dir__ itself"
+        elif name.startswith('__') or hasattr(builtins, name):
+            plan.kept[name] = "special or builtin name"
+        elif len(global_scope.assignments[name]) != 1:
+            plan.kept[name] = "assigned more than once"
+        else:
+            for dependency in sorted(global_names - {name}):
+                assignments = global_scope.assignments[dependency]
+                if len(assignments) > 1 and any(
+                        _node_within(positions, ref.node, value) for assignment in assignments for ref in assignment.references):
+                    plan.kept[name] = f"depends on {dependency}, which is assigned more than once"
+                    break
+
+    # Drop constants used at import time outside the values of the remaining ones, until stable
+    deferrable = {name for name in candidates if name not in plan.kept}
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(deferrable):
+            for ref in next(iter(global_scope.assignments[name])).references:
+                if at_import_time(ref.node) and not any(
+                        _node_within(positions, ref.node, candidates[other][1]) for other in deferrable if other != name):
+                    plan.kept[name] = f"used at import time (line {positions[ref.node].start.line})"
+                    deferrable.discard(name)
+                    changed = True
+                    break
+
+    # Imports whose import time uses are all in deferrable constants are no longer needed at startup
+    freed = set()
+    for info in imports:
+        refs = [ref for refs in info.references.values() for ref in refs if at_import_time(ref)]
+        if refs and all(any(_node_within(positions, ref, candidates[name][0]) for name in deferrable) for ref in refs):
+            freed.add(module.code_for_node(info.node))
+    references: Set[cst.Name] = set()
+    for name, (statement, value, uses) in candidates.items():
+        if name in plan.kept:
+            continue
+        if name not in deferrable or not uses & freed:
+            plan.kept[name] = f"{', '.join(sorted(uses))} is still needed at import time"
+            continue
+        plan.deferred[name] = statement
+    for name in plan.deferred:
+        references.update(
+            ref.node for ref in next(iter(global_scope.assignments[name])).references
+            if isinstance(ref.node, cst.Name)
+        )
+    return plan, references
+
+def defer_module_constants(source_code: str) -> Tuple[str, DeferredConstantsPlan, Dict[int, int]]:
+    """Pre-pass turning constants that pin imports to startup into memoized accessors.
+
+    Returns the new source, the plan, and the number of lines added after each original
+    line (see ``shift_line``).
+    """
+    wrapper = cst.metadata.MetadataWrapper(cst.parse_module(source_code))
+    plan, references = plan_deferred_constants(wrapper, build_import_index(wrapper))
+    if not plan.deferred:
+        return source_code, plan, {}
+    transformer = DeferConstantsTransformer(plan, references, wrapper.module)
+    new_code = wrapper.module.visit(transformer).code
+    positions = wrapper.resolve(cst.metadata.PositionProvider)
+    added_lines = {positions[statement].end.line: lines for statement, lines in transformer.added_lines.items()}
+    return new_code, plan, added_lines
+
+def shift_line(line: int, added_lines: Dict[int, int]) -> int:
+    """Line number of an original source line after lines were added (see ``defer_module_constants``)."""
+    return line + sum(lines for end, lines in added_lines.items() if end < line)
+
+def unshift_line(line: int, added_lines: Dict[int, int]) -> int:
+    """Line number in the original source of a line outside the added ones (inverse of ``shift_line``)."""
+    return line - sum(lines for end, lines in added_lines.items() if shift_line(end, added_lines) + lines < line)
+
+LAZY_GROUP_TEMPLATE = '''
+
+class _ImLazyGroup_{group}(type({group})):
+    """``{group}``, importing the module of a subcommand only when it is run or its help is shown."""
+    # Command name -> (module, attribute, short help, help), read from the command definitions
+    lazy_subcommands = {table}
+
+    def list_commands(self, ctx):
+        return sorted({{*super().list_commands(ctx), *self.lazy_subcommands}})
+
+    # Set while click lists the commands for --help
+    _im_listing = False
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            module, attribute, short_help, help = self.lazy_subcommands[cmd_name]
+            if self._im_listing:
+                # A stand-in with the stored help, so that listing the command doesn't import it
+                import click
+                return click.Command(cmd_name, help=help, short_help=short_help)
+            import importlib
+            self.add_command(getattr(importlib.import_module(module, __package__), attribute), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        self._im_listing = True
+        try:
+            super().format_commands(ctx, formatter)
+        finally:
+            self._im_listing = False
+
+
+{group}.__class__ = _ImLazyGroup_{group}
+'''
+
+@dataclass
+class LazySubcommandsPlan:
+    """Subcommands of click groups to import on first use, and why the others can't be."""
+    # Group -> command name -> (module, attribute, short help, help)
+    lazy: Dict[str, Dict[str, Tuple[str, str, Optional[str], Optional[str]]]] = field(default_factory=dict)
+    # ``group.add_command(...)`` statement -> reason, for registrations left as they are
+    kept: Dict[str, str] = field(default_factory=dict)
+    # Import statements of the lazy commands, no longer executed at import time, and their lines
+    imports: Dict[str, int] = field(default_factory=dict)
+
+def _join_module(base: str, name: str) -> str:
+    return f"{base}{name}" if not base or base.endswith('.') else f"{base}.{name}"
+
+def _command_target(
+    node: Union[cst.Import, cst.ImportFrom], bound: str, reference: str
+) -> Optional[Tuple[str, str]]:
+    """``(module, attribute)`` of the object ``reference`` names through the import binding ``bound``.
+
+    The module keeps the leading dots of relative imports.
+    """
+    rest = reference[len(bound) + 1:].split('.') if reference != bound else []
+    if isinstance(node, cst.ImportFrom):
+        base = '.' * len(node.relative) + (cst.helpers.get_full_name_for_node(node.module) if node.module else '')
+        alias = next(alias for alias in node.names
+                     if (cst.helpers.get_full_name_for_node(alias.asname.name) if alias.asname else alias.name.value) == bound)
+        parts = [alias.name.value, *rest]
+        module = base
+    else:
+        alias = next(alias for alias in node.names
+                     if bound in (cst.helpers.get_full_name_for_node(alias.asname.name) if alias.asname else None,
+                                  cst.helpers.get_full_name_for_node(alias.name)))
+        module = cst.helpers.get_full_name_for_node(alias.name) if alias.asname else bound
+        parts = rest
+    if not parts:
+        return None
+    for part in parts[:-1]:
+        module = _join_module(module, part)
+    return module, parts[-1]
+
+def _module_source_path(module: str, source_path: Path, dependencies: Optional[Set[Path]] = None) -> Optional[Path]:
+    """The file of ``module`` (possibly relative to ``source_path``) in the project, if there is one.
+
+    The candidate files are added to ``dependencies``, whichever exists.
+    """
+    root = find_package_root(source_path)
+    stripped = module.lstrip('.')
+    name = resolve_import_module(
+        stripped or None, len(module) - len(stripped),
+        module_name_for_path(source_path, root), source_path.name == '__init__.py',
+    )
+    if not name:
+        return None
+    base = root.joinpath(*name.split('.'))
+    for path in (base.parent / f"{base.name}.py", base / "__init__.py"):
+        if dependencies is not None:
+            dependencies.add(path)
+        if path.is_file():
+            return path
+    return None
+
+def _static_command(path: Path, attribute: str) -> Optional[Dict[str, object]]:
+    """Constant arguments and docstring of the click command defined as ``attribute`` in ``path``.
+
+    Returns None unless ``attribute`` is a module level function decorated with ``command``
+    or ``group`` (of click or of another group) whose decorator arguments are all literals.
+    """
+    try:
+        tree = ast.parse(path.read_bytes())
+    except (OSError, SyntaxError, ValueError):
+        return None
+    for statement in tree.body:
+        if not (isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)) and statement.name == attribute):
+            continue
+        for decorator in statement.decorator_list:
+            call = decorator if isinstance(decorator, ast.Call) else None
+            name = _dotted_name(call.func if call is not None else decorator)
+            if name is None or name.rpartition('.')[2] not in ('command', 'group'):
+                continue
+            try:
+                arguments = {keyword.arg: ast.literal_eval(keyword.value) for keyword in call.keywords} if call else {}
+                if call is not None and call.args:
+                    arguments['name'] = ast.literal_eval(call.args[0])
+            except ValueError:
+                return None
+            if None in arguments:  # **kwargs
+                return None
+            arguments['docstring'] = ast.get_docstring(statement)
+            arguments['function'] = statement.name
+            return arguments
+    return None
+
+def _click_command_name(function: str) -> str:
+    """The name click (8.2 and later) gives a command defined by ``function`` without an explicit name."""
+    name = function.lower().replace('_', '-')
+    left, sep, suffix = name.rpartition('-')
+    return left if sep and suffix in ('command', 'cmd', 'group', 'grp') else name
+
+def plan_lazy_subcommands(
+    wrapper: cst.metadata.MetadataWrapper, index: ImportIndex, source_path: Path,
+    dependencies: Optional[Set[Path]] = None,
+) -> Tuple[LazySubcommandsPlan, Dict[cst.FunctionDef, str], List[cst.SimpleStatementLine]]:
+    """Find ``group.add_command(command)`` registrations whose command can be imported on first use.
+
+    ``group`` must be a module level function decorated with ``click.group`` (or ``rich_click``'s),
+    and ``command`` come from a module level import used for nothing else. The command's
+    name and help are read from its definition in the project without importing it, so
+    that ``--help`` can list it; the files looked at are added to ``dependencies``. Returns the
+    plan, the groups to rewrite and the statements (registrations and imports) to comment out.
+    """
+    import inspect
+    plan = LazySubcommandsPlan()
+    module = wrapper.module
+    positions = wrapper.resolve(cst.metadata.PositionProvider)
+    global_scope = wrapper.resolve(cst.metadata.ScopeProvider)[module]
+
+    click_aliases = set()
+    for info in index.global_imports():
+        if isinstance(info.node, cst.Import):
+            for alias in info.node.names:
+                if cst.helpers.get_full_name_for_node(alias.name) in ('click', 'rich_click'):
+                    click_aliases.add(cst.helpers.get_full_name_for_node(alias.asname.name) if alias.asname else alias.name.value)
+    groups: Dict[str, cst.FunctionDef] = {}
+    for statement in module.body:
+        if isinstance(statement, cst.FunctionDef) and len(global_scope.assignments[statement.name.value]) == 1:
+            for decorator in statement.decorators:
+                expression = decorator.decorator
+                name = cst.helpers.get_full_name_for_node(expression.func if isinstance(expression, cst.Call) else expression)
+                if name in {f"{alias}.group" for alias in click_aliases}:
+                    groups[statement.name.value] = statement
+    if not groups:
+        return plan, {}, []
+
+    # Module level import statement of each import node
+    import_statements = {
+        small: statement for statement in module.body if isinstance(statement, cst.SimpleStatementLine)
+        for small in statement.body if isinstance(small, (cst.Import, cst.ImportFrom))
+    }
+    # Registrations: (group, statement, command expression, explicit name, import, bound name)
+    registrations = []
+    for statement in module.body:
+        if not (isinstance(statement, cst.SimpleStatementLine) and len(statement.body) == 1 and
+                isinstance(statement.body[0], cst.Expr) and isinstance(statement.body[0].value, cst.Call)):
+            continue
+        call = statement.body[0].value
+        if not (isinstance(call.func, cst.Attribute) and call.func.attr.value == 'add_command' and
+                isinstance(call.func.value, cst.Name) and call.func.value.value in groups):
+            continue
+        group = call.func.value.value
+        code = module.code_for_node(statement).strip()
+        explicit_name = None
+        if len(call.args) == 2 and (call.args[1].keyword is None or call.args[1].keyword.value == 'name'):
+            value = call.args[1].value
+            if not isinstance(value, cst.SimpleString):
+                plan.kept[code] = "the command name is not a literal"
+                continue
+            explicit_name = value.evaluated_value
+        elif len(call.args) != 1:
+            plan.kept[code] = "unexpected arguments"
+            continue
+        command = call.args[0]
+        reference = cst.helpers.get_full_name_for_node(command.value)
+        node = index.lookup(global_scope, reference) if reference and command.keyword is None else None
+        if node is None or node not in import_statements:
+            plan.kept[code] = "the command is not imported at module level"
+            continue
+        bound = max((name for name in index.imports[node].names
+                     if reference == name or reference.startswith(f"{name}.")), key=len)
+        registrations.append((group, statement, command, explicit_name, node, bound))
+
+    # Imports used for anything else keep loading their module at startup anyway
+    arguments = [command for _, _, command, _, _, _ in registrations]
+    imports_used_elsewhere = {
+        node for node in {node for _, _, _, _, node, _ in registrations}
+        if any(not any(_node_within(positions, ref, argument) for argument in arguments)
+               for name, refs in index.imports[node].references.items() for ref in refs)
+        or len(import_statements[node].body) != 1
+    }
+    candidates: Dict[Union[cst.Import, cst.ImportFrom], List] = {}
+    for group, statement, command, explicit_name, node, bound in registrations:
+        code = module.code_for_node(statement).strip()
+        if node in imports_used_elsewhere:
+            plan.kept[code] = f"{module.code_for_node(node).strip()} is used for more than the command"
+            continue
+        target = _command_target(node, bound, cst.helpers.get_full_name_for_node(command.value))
+        path = _module_source_path(target[0], source_path, dependencies) if target is not None else None
+        definition = _static_command(path, target[1]) if path is not None else None
+        if definition is None:
+            plan.kept[code] = "the command definition can't be read without importing it"
+            continue
+        if definition.get('hidden') or definition.get('deprecated'):
+            plan.kept[code] = "hidden or deprecated command"
+            continue
+        name = explicit_name or definition.get('name') or _click_command_name(definition['function'])
+        help = definition.get('help') or definition['docstring']
+        short_help = definition.get('short_help')
+        candidates.setdefault(node, []).append((group, statement, code, name, (
+            target[0], target[1],
+            inspect.cleandoc(short_help) if isinstance(short_help, str) else None,
+            inspect.cleandoc(help).partition('\f')[0] if isinstance(help, str) else None,
+        )))
+
+    # All the commands of an import become lazy or none does, since the import goes
+    statements: List[cst.SimpleStatementLine] = []
+    rewritten: Dict[cst.FunctionDef, str] = {}
+    for node, commands in candidates.items():
+        names = [(group, name) for group, _, _, name, _ in commands]
+        if len(set(names)) < len(names) or any(name in plan.lazy.get(group, {}) for group, name in names):
+            for _, _, code, _, _ in commands:
+                plan.kept[code] = "registered under a name used by another lazy command"
+            continue
+        for group, statement, code, name, entry in commands:
+            plan.lazy.setdefault(group, {})[name] = entry
+            rewritten[groups[group]] = group
+            statements.append(statement)
+        statements.append(import_statements[node])
+        plan.imports[module.code_for_node(node)] = positions[node].start.line
+    return plan, rewritten, statements
+
+def lazy_click_subcommands(
+    source_code: str, source_path: Path, dependencies: Optional[Set[Path]] = None,
+) -> Tuple[str, LazySubcommandsPlan, Dict[int, int]]:
+    """Pre-pass making the subcommands of click groups load on first use.
+
+    The registrations and imports found by ``plan_lazy_subcommands`` are commented out
+    line by line and each group's class is swapped for a subclass importing the commands
+    when they are looked up, defined after the group. Returns the new source, the plan, and
+    the number of lines added after each original line (see ``shift_line``). The command
+    definitions read are added to ``dependencies``.
+    """
+    wrapper = cst.metadata.MetadataWrapper(cst.parse_module(source_code))
+    plan, groups, statements = plan_lazy_subcommands(wrapper, build_import_index(wrapper), source_path, dependencies)
+    if not groups:
+        return source_code, plan, {}
+    positions = wrapper.resolve(cst.metadata.PositionProvider)
+    lines = source_code.splitlines(keepends=True)
+    for statement in statements:
+        for line in range(positions[statement].start.line, positions[statement].end.line + 1):
+            lines[line - 1] = f"# {lines[line - 1]}"
+    added_lines = {}
+    for function, group in sorted(groups.items(), key=lambda item: -positions[item[0]].end.line):
+        end = positions[function].end.line
+        if not lines[end - 1].endswith('\n'):
+            lines[end - 1] += '\n'
+        table = "{\n" + "".join(f"        {name!r}: {entry!r},\n" for name, entry in sorted(plan.lazy[group].items())) + "    }"
+        block = LAZY_GROUP_TEMPLATE.format(group=group, table=table)
+        lines.insert(end, block)
+        added_lines[end] = block.count('\n')
+    return "".join(lines), plan, added_lines
+
+def unified_diff(source_code: str, output_code: str, path: Path) -> str:
+    """Unified diff between the source and the rewritten code of a file (empty if equal)."""
+    import difflib
+    return "".join(difflib.unified_diff(
+        source_code.splitlines(keepends=True),
+        output_code.splitlines(keepends=True),
+        fromfile=str(path),
+        tofile=str(path),
+    ))
+
+# Names of the symbol tables of comprehensions, by node type
+COMPREHENSION_TABLES = {ast.ListComp: 'listcomp', ast.SetComp: 'setcomp', ast.DictComp: 'dictcomp', ast.GeneratorExp: 'genexpr'}
+
+@dataclass(eq=False)
+class AstScope:
+    """A ``symtable`` scope, with what the import analysis needs to know about it.
+
+    ``kind`` is ``"module"``, ``"class"``, ``"function"`` (a ``def``) or ``"inline"`` for the scopes
+    whose code runs on behalf of the enclosing one (lambdas, comprehensions, annotation scopes).
+    """
+    table: "symtable.SymbolTable"
+    kind: str
+    parent: Optional["AstScope"] = None
+    qualname: str = ""
+    # The ``def`` of a function scope, for matching profiled functions
+    node: Optional[ast.AST] = None
+    # Child scopes by (table name, line), in source order
+    children: Dict[Tuple[str, int], List["AstScope"]] = field(default_factory=lambda: defaultdict(list))
+
+    @property
+    def owner(self) -> Optional["AstScope"]:
+        """The function whose body code in this scope executes in; None for module/class level code."""
+        scope = self
+        while scope.kind == "inline":
+            scope = scope.parent
+        return scope if scope.kind == "function" else None
+
+    def functions(self) -> List["AstScope"]:
+        """The function scopes enclosing this one, outermost first, this one included."""
+        chain = []
+        scope = self
+        while scope is not None:
+            if scope.kind == "function":
+                chain.append(scope)
+            scope = scope.parent
+        return chain[::-1]
+
+def _ast_scopes(table: "symtable.SymbolTable", parent: Optional[AstScope] = None) -> AstScope:
+    """Wrap a symbol table and its children into AstScopes."""
+    kind = str(table.get_type())
+    name = table.get_name()
+    if kind == "function" and (name == "lambda" or ".0" in table.get_identifiers()):
+        kind = "inline"
+    elif kind not in ("module", "class", "function"):
+        kind = "inline"
+    qualname = ""
+    if kind in ("class", "function"):
+        enclosing = parent
+        while enclosing.kind == "inline":
+            enclosing = enclosing.parent
+        if enclosing.kind == "function":
+            qualname = f"{enclosing.qualname}.<locals>.{name}"
+        elif enclosing.kind == "class":
+            qualname = f"{enclosing.qualname}.{name}"
+        else:
+            qualname = name
+    scope = AstScope(table=table, kind=kind, parent=parent, qualname=qualname)
+    for child in table.get_children():
+        scope.children[(child.get_name(), child.get_lineno())].append(_ast_scopes(child, scope))
+    return scope
+
+def _dotted_name(node: ast.AST) -> Optional[str]:
+    """``a.b.c`` for an attribute chain on a plain name, None for anything else."""
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = _dotted_name(node.value)
+        return f"{base}.{node.attr}" if base else None
+    return None
+
+class AstReferenceCollector(ast.NodeVisitor):
+    """Collect the imports and name references of a module, each with the scope it is in.
+
+    Code is attributed to scopes the way Python runs it: decorators, defaults, annotations and
+    class bases in the enclosing scope, the first iterable of a comprehension too. References
+    are recorded with their full dotted name, like libcst matches ``os.path.join`` against
+    ``import os.path``. Like libcst, the strings in annotations and type hints (``List["X"]``,
+    ``cast("X", ...)``) are parsed for references. ``inexact`` is set to the first construct
+    libcst sees differently.
+    """
+    def __init__(self, module_scope: AstScope):
+        self.scope = module_scope
+        self.imports: List[Tuple[AstScope, Union[ast.Import, ast.ImportFrom]]] = []
+        # (scope, dotted name, position) of each reference
+        self.references: List[Tuple[AstScope, str, Tuple[int, int]]] = []
+        # (scope, name) -> end of the last statement binding the name there
+        self.last_bindings: Dict[Tuple[AstScope, str], Tuple[int, int]] = {}
+        self.statement: Optional[ast.AST] = None
+        self.inexact: Optional[str] = None
+        # Names imported from typing, by their qualified name
+        self.typing_names: Dict[str, str] = {}
+        self.in_annotation = False
+        self.in_type_hint = [False]
+        self.in_literal = 0
+        # Position of the string annotation being visited, for the references inside
+        self.string_position: Optional[Tuple[int, int]] = None
+
+    def visit(self, node: ast.AST) -> None:
+        if not isinstance(node, ast.stmt):
+            return super().visit(node)
+        outer, self.statement = self.statement, node
+        super().visit(node)
+        self.statement = outer
+
+    def _bind(self, name: str, node: Optional[ast.AST] = None) -> None:
+        node = node or self.statement
+        end = (node.end_lineno, node.end_col_offset)
+        key = (self.scope, name)
+        self.last_bindings[key] = max(end, self.last_bindings.get(key, end))
+
+    def _child(self, name: str, lineno: int) -> AstScope:
+        children = self.scope.children.get((name, lineno))
+        # Comprehensions have no table of their own when inlined (PEP 709)
+        return children.pop(0) if children else self.scope
+
+    def _visit_in(self, scope: AstScope, nodes: Iterable[ast.AST]) -> None:
+        outer, self.scope = self.scope, scope
+        for node in nodes:
+            self.visit(node)
+        self.scope = outer
+
+    def _not_exact(self, reason: str) -> None:
+        if self.inexact is None:
+            self.inexact = reason
+
+    def _position(self, node: ast.AST) -> Tuple[int, int]:
+        return self.string_position or (node.lineno, node.col_offset)
+
+    def _qualified_name(self, node: ast.AST) -> Optional[str]:
+        root, dot, rest = (_dotted_name(node) or '').partition('.')
+        qualified = self.typing_names.get(root)
+        return f"{qualified}{dot}{rest}" if qualified else None
+
+    def _visit_annotation(self, annotation: Optional[ast.AST]) -> None:
+        if annotation is None:
+            return
+        outer, self.in_annotation = self.in_annotation, True
+        self.visit(annotation)
+        self.in_annotation = outer
+
+    def _visit_arguments(self, args: ast.arguments, annotations: bool = True) -> None:
+        for default in [*args.defaults, *args.kw_defaults]:
+            if default is not None:
+                self.visit(default)
+        if annotations:
+            for arg in [*args.posonlyargs, *args.args, args.vararg, *args.kwonlyargs, args.kwarg]:
+                if arg is not None:
+                    self._visit_annotation(arg.annotation)
+
+    def visit_FunctionDef(self, node: Union[ast.FunctionDef, ast.AsyncFunctionDef]) -> None:
+        if getattr(node, 'type_params', None):
+            self._not_exact(f"type parameters (line {node.lineno})")
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self._visit_arguments(node.args)
+        self._visit_annotation(node.returns)
+        self._bind(node.name)
+        scope = self._child(node.name, node.lineno)
+        scope.node = node
+        self._visit_in(scope, node.body)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node: ast.Lambda) -> None:
+        self._visit_arguments(node.args, annotations=False)
+        self._visit_in(self._child('lambda', node.lineno), [node.body])
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
+        if getattr(node, 'type_params', None):
+            self._not_exact(f"type parameters (line {node.lineno})")
+        for child in [*node.decorator_list, *node.bases, *node.keywords]:
+            self.visit(child)
+        self._bind(node.name)
+        self._visit_in(self._child(node.name, node.lineno), node.body)
+
+    def _visit_comprehension(self, node: ast.AST) -> None:
+        first, *rest = node.generators
+        self.visit(first.iter)
+        elements = [node.key, node.value] if isinstance(node, ast.DictComp) else [node.elt]
+        # The targets are bound by the comprehension as a whole
+        outer, self.statement = self.statement, node
+        self._visit_in(self._child(COMPREHENSION_TABLES[type(node)], node.lineno), [
+            first.target, *first.ifs,
+            *(part for generator in rest for part in (generator.target, generator.iter, *generator.ifs)),
+            *elements,
+        ])
+        self.statement = outer
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+    def visit_AnnAssign(self, node: ast.AnnAssign) -> None:
+        self.visit(node.target)
+        self._visit_annotation(node.annotation)
+        if node.value is not None:
+            self.visit(node.value)
+
+    def visit_Call(self, node: ast.Call) -> None:
+        # The same arguments as libcst takes for type hints (it skips the name of a TypeVar)
+        qualified = self._qualified_name(node.func)
+        arguments = sorted([*node.args, *node.keywords], key=lambda arg: (arg.lineno, arg.col_offset))
+        self.in_type_hint.append(False)
+        if qualified in ('typing.NewType', 'typing.TypeVar'):
+            self.visit(node.func)
+            self.in_type_hint[-1] = True
+            for arg in arguments[1:]:
+                self.visit(arg)
+        elif qualified == 'typing.cast':
+            self.visit(node.func)
+            for i, arg in enumerate(arguments):
+                self.in_type_hint[-1] = i == 0
+                self.visit(arg)
+        else:
+            self.generic_visit(node)
+        self.in_type_hint.pop()
+
+    def visit_Subscript(self, node: ast.Subscript) -> None:
+        qualified = self._qualified_name(node.value) if isinstance(node.value, ast.Name) else None
+        literal = qualified in ('typing.Literal', 'typing_extensions.Literal')
+        self.in_type_hint.append(bool(qualified) and qualified.startswith(('typing.', 'typing_extensions.')))
+        self.in_literal += literal
+        self.generic_visit(node)
+        self.in_literal -= literal
+        self.in_type_hint.pop()
+
+    def visit_Constant(self, node: ast.Constant) -> None:
+        if not (isinstance(node.value, str) and node.value and (self.in_annotation or self.in_type_hint[-1])
+                and not self.in_literal):
+            return
+        try:
+            parsed = ast.parse(node.value)
+        except (SyntaxError, ValueError):
+            return  # libcst ignores strings that don't parse, like Python
+        if len(parsed.body) != 1 or not isinstance(parsed.body[0], ast.Expr):
+            self._not_exact(f"string annotation with statements (line {node.lineno})")
+            return
+        outer, self.string_position = self.string_position, self.string_position or (node.lineno, node.col_offset)
+        self.visit(parsed.body[0].value)
+        self.string_position = outer
+
+    def visit_JoinedStr(self, node: ast.JoinedStr) -> None:
+        # Only the replacement fields are code; the literal parts are no type hints
+        for value in node.values:
+            if isinstance(value, ast.FormattedValue):
+                self.visit(value)
+
+    def visit_Import(self, node: Union[ast.Import, ast.ImportFrom]) -> None:
+        self.imports.append((self.scope, node))
+        for alias in node.names:
+            self._bind((alias.asname or alias.name).partition('.')[0])
+            if isinstance(node, ast.ImportFrom) and node.module in ('typing', 'typing_extensions') and not node.level:
+                self.typing_names[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+            elif isinstance(node, ast.Import) and alias.name in ('typing', 'typing_extensions'):
+                self.typing_names[alias.asname or alias.name] = alias.name
+
+    visit_ImportFrom = visit_Import
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler) -> None:
+        if node.name:
+            self._bind(node.name, node)
+        self.generic_visit(node)
+
+    def visit_NamedExpr(self, node: ast.NamedExpr) -> None:
+        if self.scope.kind == "inline":
+            # Python binds the target in the enclosing function, libcst in the comprehension
+            self._not_exact(f"assignment expression in a comprehension (line {node.lineno})")
+        self.generic_visit(node)
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if isinstance(node.ctx, ast.Store):
+            self._bind(node.id)
+            return
+        if isinstance(node.ctx, ast.Del) and self.scope.kind != "module":
+            # Python makes a deleted name local, libcst reads ``del`` as a use of the outer one
+            self._not_exact(f"del of {node.id} (line {node.lineno})")
+        self.references.append((self.scope, node.id, self._position(node)))
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        dotted = _dotted_name(node)
+        if dotted is None:
+            self.generic_visit(node)
+        else:
+            self.references.append((self.scope, dotted, self._position(node)))
+
+def _binding_scope(scope: AstScope, name: str) -> AstScope:
+    """The scope ``name`` resolves to when used in ``scope``."""
+    while scope.kind != "module":
+        try:
+            symbol = scope.table.lookup(name)
+        except KeyError:
+            symbol = None
+        if symbol is not None:
+            if symbol.is_global() or symbol.is_declared_global():
+                break
+            if symbol.is_local() and not symbol.is_free():
+                return scope
+        # Free names skip the class bodies around the function using them
+        scope = scope.parent
+        while scope.kind == "class" and symbol is not None and symbol.is_free():
+            scope = scope.parent
+    while scope.parent is not None:
+        scope = scope.parent
+    return scope
+
+@dataclass(eq=False)
+class AstImportInfo:
+    """An import statement found by the ast backend and where its names are referenced."""
+    node: Union[ast.Import, ast.ImportFrom]
+    scope: AstScope
+    code: str
+    names: Set[str] = field(default_factory=set)
+    used_names: Set[str] = field(default_factory=set)
+    function_scopes: List[AstScope] = field(default_factory=list)
+    used_at_module_level: bool = False
+
+    @property
+    def unused_names(self) -> Set[str]:
+        # ``import a.b`` binds both ``a`` and ``a.b``; the package name is used whenever the dotted one is
+        return {
+            name for name in self.names - self.used_names
+            if not any(other.startswith(f"{name}.") for other in self.used_names)
+        }
+
+def _import_code(source_lines: List[bytes], node: ast.AST) -> str:
+    """The code of an import statement as libcst renders it (a following ``;`` included)."""
+    line = source_lines[node.lineno - 1]
+    if node.end_lineno == node.lineno:
+        segment = line[node.col_offset:node.end_col_offset]
+    else:
+        following = [*source_lines[node.lineno:node.end_lineno - 1], source_lines[node.end_lineno - 1][:node.end_col_offset]]
+        if b"(" in line:
+            # libcst renders the lines inside the parentheses without the indentation of the block
+            indent = line[:len(line) - len(line.lstrip(b" \t"))]
+            following = [part[len(indent):] if indent and part.startswith(indent) else part for part in following]
+        segment = b"".join([line[node.col_offset:], *following])
+    semicolon = re.match(rb"[ \t]*;[ \t]*", source_lines[node.end_lineno - 1][node.end_col_offset:])
+    if semicolon:
+        segment += semicolon.group()
+    return segment.decode()
+
+def _hot_ast_scope(scope: AstScope, hot_functions: Iterable[Tuple[str, int]]) -> bool:
+    """Whether a profiled (name, line) pair falls in the function of ``scope`` (decorators included)."""
+    node = scope.node
+    start = min([node.lineno, *(decorator.lineno for decorator in node.decorator_list)])
+    return any(name == node.name and start <= line <= node.end_lineno for name, line in hot_functions)
+
+def analyze_imports_ast(
+    source_code: str,
+    source_path: Path,
+    remove_unused_imports: bool = True,
+    whitelist_libs: Optional[Set[str]] = None,
+    import_costs: Optional[Dict[str, float]] = None,
+    cost_threshold_ms: float = 0.0,
+    strategy: str = "move",
+    movable_imports: Optional[Set[str]] = None,
+    hot_functions: Optional[Iterable[Tuple[str, int]]] = None,
+    hot_action: str = "keep",
+    hoist: bool = False,
+    import_rules: Optional[Dict[str, str]] = None,
+    preloaded_modules: Optional[Set[str]] = None,
+) -> Optional[FileResult]:
+    """The changes ``process_file`` would make, found with the stdlib ``ast`` and ``symtable``.
+
+    Much cheaper than parsing with libcst and resolving its scope metadata; follows the same
+    rules as ``plan_imports``. Returns None when the result could differ from the libcst one:
+    on constructs libcst reads differently (string annotations, ``del`` in functions, ...) and
+    on decisions the libcst planning makes itself (which imports can be made lazy, which
+    are only used in annotations).
+    """
+    import symtable
+    try:
+        tree = ast.parse(source_code, filename=str(source_path))
+        module_scope = _ast_scopes(symtable.symtable(source_code, str(source_path), "exec"))
+    except (SyntaxError, ValueError) as e:
+        logging.debug("Not analysing %s with ast: %s", source_path, e)
+        return None
+    collector = AstReferenceCollector(module_scope)
+    collector.visit(tree)
+    if collector.inexact:
+        logging.debug("Not analysing %s with ast: %s", source_path, collector.inexact)
+        return None
+
+    source_lines = source_code.encode().splitlines(keepends=True)
+    imports: List[AstImportInfo] = []
+    bindings: Dict[Tuple[AstScope, str], List[AstImportInfo]] = defaultdict(list)
+    for scope, node in collector.imports:
+        if isinstance(node, ast.ImportFrom) and (node.module == '__future__' or node.names[0].name == '*'):
+            continue  # compiler directives are never moved; star imports bind nothing libcst tracks
+        info = AstImportInfo(node=node, scope=scope, code=_import_code(source_lines, node))
+        for alias in node.names:
+            if alias.asname or isinstance(node, ast.ImportFrom):
+                info.names.add(alias.asname or alias.name)
+            else:
+                parts = alias.name.split('.')
+                info.names.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        if scope.kind != "module":
+            symbols = [scope.table.lookup(name.partition('.')[0]) for name in info.names]
+            if any(symbol.is_declared_global() or symbol.is_nonlocal() for symbol in symbols):
+                logging.debug("Not analysing %s with ast: import of a global name (line %s)", source_path, node.lineno)
+                return None
+        imports.append(info)
+        for name in info.names:
+            bindings[(scope, name)].append(info)
+
+    # Attach each reference to the imports binding its longest dotted prefix in its scope
+    import_names = {name.partition('.')[0] for info in imports for name in info.names}
+    for scope, dotted, position in collector.references:
+        root = dotted.partition('.')[0]
+        if root in import_names and position < collector.last_bindings.get((scope, root), position):
+            # libcst attributes uses before a later binding in the same scope to the outer binding too
+            logging.debug("Not analysing %s with ast: %s used before it is bound again (line %s)",
+                          source_path, root, position[0])
+            return None
+        binding = _binding_scope(scope, root)
+        name = dotted
+        while name and (binding, name) not in bindings:
+            name = name.rpartition('.')[0]
+        owner = scope.owner
+        for info in bindings.get((binding, name), ()):
+            info.used_names.add(name)
+            if owner is None:
+                info.used_at_module_level = True
+            elif owner not in info.function_scopes:
+                info.function_scopes.append(owner)
+
+    result = FileResult(source_path=str(source_path))
+    global_imports = [info for info in imports if info.scope.kind == "module"]
+    keep_global_imports: Dict[AstImportInfo, str] = {}
+    for info in global_imports:
+        rule = import_rule(info.node, import_rules) if import_rules else None
+        if rule is not None and rule[0] in ("lazy", "type-checking"):
+            return None
+        if rule is not None and rule[0] == "keep":
+            keep_global_imports.setdefault(info, f"kept by the rule for {rule[1]}")
+        if rule is not None:
+            continue  # deferred by a rule whatever the checks below say
+        if preloaded_modules and is_preloaded(info.node, preloaded_modules):
+            keep_global_imports.setdefault(info, "already loaded at startup")
+        if whitelist_libs and is_whitelisted(info.node, whitelist_libs):
+            keep_global_imports.setdefault(info, "whitelisted")
+        if import_costs is not None:
+            cost = import_cost(info.node, import_costs)
+            if cost is not None and cost < cost_threshold_ms:
+                keep_global_imports.setdefault(info, f"cheap ({cost:.2f} ms)")
+        if movable_imports is not None and info.code not in movable_imports:
+            keep_global_imports.setdefault(info, "not deferred by the entry point plan")
+    if hot_functions:
+        for info in global_imports:
+            if any(_hot_ast_scope(scope, hot_functions) for scope in info.function_scopes):
+                if hot_action == "lazy":
+                    return None
+                keep_global_imports.setdefault(info, "used in hot functions")
+    for info in global_imports:
+        if info.used_at_module_level:
+            keep_global_imports.setdefault(info, "used at module level")
+
+    for info in global_imports:
+        result.import_lines.setdefault(info.code, info.node.lineno)
+    result.kept_imports = {info.code: reason for info, reason in keep_global_imports.items()}
+    for info in imports:
+        if info in keep_global_imports:
+            continue
+        result.unused_lines.update(dict.fromkeys(info.unused_names, info.node.lineno))
+        result.unused_imports.extend(sorted(info.unused_names))
+        if info.scope.kind != "module":
+            continue
+        result.deferred_imports.append(info.code)
+        for scope in placement_scopes(info.function_scopes, hoist=hoist, enclosing=AstScope.functions):
+            result.moved_imports.setdefault(scope.qualname, []).append(info.code)
+    if strategy == "lazy" and result.moved_imports:
+        return None  # plan_lazy_imports decides which of them become lazy
+    return result
+
+def process_file(
+    source_path: Path,
+    log_path: Optional[str],
+    output_path: str,
+    keep_old_imports: bool = True,
+    remove_unused_imports: bool = True,
+    whitelist_libs: Optional[Set[str]] = None,
+    import_costs: Optional[Dict[str, float]] = None,
+    cost_threshold_ms: float = 0.0,
+    strategy: str = "move",
+    lazy_init: bool = False,
+    movable_imports: Optional[Set[str]] = None,
+    hot_functions: Optional[List[Tuple[str, int]]] = None,
+    hot_action: str = "keep",
+    hoist: bool = False,
+    type_checking: Optional[str] = None,
+    defer_constants: bool = False,
+    lazy_subcommands: bool = False,
+    dry_run: bool = False,
+    cache: Optional[ResultCache] = None,
+    backend: str = "auto",
+    diff: bool = False,
+    keep_source: bool = False,
+    import_rules: Optional[Dict[str, str]] = None,
+    preloaded_modules: Optional[Set[str]] = None,
+    source_code: Optional[str] = None,
+    return_output: bool = False,
+    parsed_modules: Optional[ParsedModuleCache] = None,
+) -> FileResult:
+    """Process a Python file to move imports into functions where they are used.
+
+    With ``import_costs`` (module name -> cumulative import time in ms, see
+    ``profile_import_costs``), global imports measured below ``cost_threshold_ms``
+    are kept global; imports of modules that were not profiled are moved as usual.
+
+    ``strategy`` is ``"move"`` (copy imports into the functions using them) or ``"lazy"``
+    (keep them at module level as lazily loaded bindings, see ``plan_lazy_imports``).
+
+    ``__init__.py`` files are skipped, unless ``lazy_init`` is set: then their relative
+    re-exports are loaded on first access instead (see ``plan_lazy_exports``).
+
+    ``movable_imports`` restricts which global import statements may be taken out (see
+    ``plan_imports``), ``hot_functions`` and ``hot_action`` keep the imports of often called
+    functions out of their bodies (ditto). With ``dry_run`` nothing is written; only the
+    result is returned. ``hoist`` shares one import between nested functions and
+    ``type_checking`` moves annotation-only imports under ``if TYPE_CHECKING:`` (ditto).
+
+    ``import_rules`` and ``preloaded_modules`` are the project's per-module policy (see
+    ``load_config`` and ``plan_imports``).
+
+    With ``defer_constants``, module level constants that are all that keeps an import at
+    module level are first turned into memoized accessors (see ``defer_module_constants``).
+    With ``lazy_subcommands``, the subcommands registered on click groups with ``add_command``
+    are first made to import on first use (see ``lazy_click_subcommands``).
+
+    When a ``cache`` is given, files whose source and options were seen before are not
+    analysed again; the stored output is written instead. With ``diff``, the result carries
+    a unified diff of the changes (also in dry runs). With ``keep_source``, the result of a
+    changed file carries its original source, to revert to, and with ``return_output`` the
+    rewritten code. ``source_code`` is processed instead of the file's content if given (an
+    editor's unsaved buffer), and ``parsed_modules`` keeps parsed modules for the next calls.
+
+    With ``backend="auto"``, files are first analysed with the stdlib ``ast`` (see
+    ``analyze_imports_ast``): files it finds nothing to change in are written back as they are,
+    and dry runs take its result, without parsing with libcst. ``"libcst"`` always uses libcst.
+    """
+    result = FileResult(source_path=str(source_path), output_path=str(output_path))
+    timer = PhaseTimer()
+    result.timings = timer.timings
+
+    # Skip __init__.py files unless their re-exports are to be made lazy
+    if source_path.name == "__init__.py" and not lazy_init:
+        logging.info("Skipping __init__.py file: %s", source_path)
+        result.skipped = "__init__.py file"
+        return result
+
+    # Read the source code and look it up in the cache
+    if source_code is None:
+        with timer.phase("read"):
+            source_code = source_path.read_text()
+    # Everything that influences the output must be part of the cache key; relative imports
+    # make it depend on where the file is
+    cache_options = dict(
+        source_path=str(source_path.resolve()),
+        keep_old_imports=keep_old_imports,
+        remove_unused_imports=remove_unused_imports,
+        whitelist_libs=whitelist_libs,
+        import_costs=import_costs,
+        cost_threshold_ms=cost_threshold_ms,
+        strategy=strategy,
+        lazy_init=lazy_init,
+        movable_imports=movable_imports,
+        hot_functions=hot_functions,
+        hot_action=hot_action,
+        hoist=hoist,
+        type_checking=type_checking,
+        defer_constants=defer_constants,
+        lazy_subcommands=lazy_subcommands,
+        import_rules=import_rules,
+        preloaded_modules=preloaded_modules,
+    )
+    cache_key = None
+    if cache is not None:
+        with timer.phase("cache"):
+            cache_key = cache.key(source_code, cache_options)
+            entry = cache.get(cache_key)
+        if entry is not None:
+            logging.debug("Cache hit for %s", source_path)
+            output = Path(output_path)
+            if not dry_run and (output.resolve() != source_path.resolve() or entry["output_code"] != source_code):
+                with timer.phase("write"):
+                    output.write_text(entry["output_code"])
+            result.unused_imports = entry["unused_imports"]
+            result.moved_imports = entry["moved_imports"]
+            result.lazy_imports = entry.get("lazy_imports", [])
+            result.type_checking_imports = entry.get("type_checking_imports", [])
+            result.deferred_imports = entry.get("deferred_imports", [])
+            result.deferred_constants = entry.get("deferred_constants", [])
+            result.kept_constants = entry.get("kept_constants", {})
+            result.lazy_subcommands = entry.get("lazy_subcommands", [])
+            result.kept_subcommands = entry.get("kept_subcommands", {})
+            result.kept_imports = entry.get("kept_imports", {})
+            result.import_lines = entry.get("import_lines", {})
+            result.unused_lines = entry.get("unused_lines", {})
+            result.cached = True
+            if diff:
+                result.diff = unified_diff(source_code, entry["output_code"], source_path)
+            if keep_source and not dry_run and entry["output_code"] != source_code:
+                result.original_code = source_code
+            if return_output:
+                result.output_code = entry["output_code"]
+            return result
+
+    # The stdlib analysis answers for the files it can: unchanged ones and dry runs skip libcst
+    analysis = None
+    rewrite_subcommands = lazy_subcommands and source_path.name != "__init__.py" and "add_command" in source_code
+    if backend == "auto" and not (defer_constants or type_checking or rewrite_subcommands or
+                                  source_path.name == "__init__.py"):
+        with timer.phase("ast"):
+            analysis = analyze_imports_ast(
+                source_code,
+                source_path,
+                remove_unused_imports=remove_unused_imports,
+                whitelist_libs=whitelist_libs,
+                import_costs=import_costs,
+                cost_threshold_ms=cost_threshold_ms,
+                strategy=strategy,
+                movable_imports=movable_imports,
+                hot_functions=hot_functions,
+                hot_action=hot_action,
+                hoist=hoist,
+                import_rules=import_rules,
+                preloaded_modules=preloaded_modules,
+            )
+        if analysis is not None and analysis.changed and not (dry_run and not (diff or return_output)):
+            analysis = None  # the rewritten code needs libcst
+
+    # Other files read to decide on the output, for the cache
+    dependencies: Set[Path] = set()
+    if analysis is not None:
+        logging.debug("No libcst pass needed for %s", source_path)
+        # The output is only known if nothing changes
+        output_code = None if analysis.changed else source_code
+        result.unused_imports = analysis.unused_imports
+        result.moved_imports = analysis.moved_imports
+        result.deferred_imports = analysis.deferred_imports
+        result.kept_imports = analysis.kept_imports
+        result.import_lines = analysis.import_lines
+        result.unused_lines = analysis.unused_lines
+        if not dry_run and Path(output_path).resolve() != source_path.resolve():
+            with timer.phase("write"):
+                _write_atomic(Path(output_path), output_code)
+    else:
+        # Make click subcommands lazy and turn constants pinning imports to startup into accessors first
+        code = source_code
+        added_lines: Dict[int, int] = {}
+        subcommand_imports: Dict[str, int] = {}
+        if rewrite_subcommands:
+            with timer.phase("lazy_subcommands"):
+                code, subcommands_plan, added_lines = lazy_click_subcommands(code, source_path, dependencies)
+            result.lazy_subcommands = [
+                f"{group} {name}" for group, commands in subcommands_plan.lazy.items() for name in commands
+            ]
+            result.kept_subcommands = subcommands_plan.kept
+            subcommand_imports = subcommands_plan.imports
+        if defer_constants and source_path.name != "__init__.py":
+            with timer.phase("defer_constants"):
+                code, constants_plan, constant_lines = defer_module_constants(code)
+            result.deferred_constants = list(constants_plan.deferred)
+            result.kept_constants = constants_plan.kept
+            # Both count lines added after original lines
+            for end, lines in constant_lines.items():
+                end = unshift_line(end, added_lines)
+                added_lines[end] = added_lines.get(end, 0) + lines
+        if hot_functions and added_lines:
+            hot_functions = [(name, shift_line(line, added_lines)) for name, line in hot_functions]
+
+        # Parse the source code and index its imports
+        wrapper = parsed_modules.get(code) if parsed_modules is not None else None
+        if wrapper is None:
+            with timer.phase("parse"):
+                wrapper = cst.metadata.MetadataWrapper(cst.parse_module(code))
+            with timer.phase("metadata"):
+                # Resolved once; build_import_index and the planning get the cached results
+                wrapper.resolve(cst.metadata.ScopeProvider)
+                wrapper.resolve(cst.metadata.PositionProvider)
+            if parsed_modules is not None:
+                parsed_modules.put(code, wrapper)
+        with timer.phase("index"):
+            index = build_import_index(wrapper)
+
+        with timer.phase("plan"):
+            if source_path.name == "__init__.py":
+                # Package __init__ files only get their re-exports made lazy
+                plan = plan_lazy_exports(wrapper, index)
+                keep_old_imports = False  # the imports are repeated under TYPE_CHECKING
+            else:
+                plan = plan_imports(
+                    wrapper,
+                    index,
+                    source_path,
+                    remove_unused_imports=remove_unused_imports,
+                    whitelist_libs=whitelist_libs,
+                    import_costs=import_costs,
+                    cost_threshold_ms=cost_threshold_ms,
+                    strategy=strategy,
+                    movable_imports=movable_imports,
+                    hot_functions=hot_functions,
+                    hot_action=hot_action,
+                    hoist=hoist,
+                    type_checking=type_checking,
+                    import_rules=import_rules,
+                    preloaded_modules=preloaded_modules,
+                    dependencies=dependencies,
+                )
+
+        # Apply the transformation in one pass and write the output in one go
+        with timer.phase("rewrite"):
+            output_code = wrapper.module.visit(plan.transformer(wrapper.module, keep_old_imports)).code
+
+        # Record changes for the caller (plain strings so the result can cross process boundaries)
+        for node, names in plan.unused_imports.items():
+            result.unused_imports.extend(sorted(names))
+        for func_name, imports in plan.imports_by_function.items():
+            result.moved_imports[func_name] = [wrapper.module.code_for_node(imp) for imp in imports]
+        result.lazy_imports = [wrapper.module.code_for_node(node) for node in plan.lazy_imports]
+        result.type_checking_imports = [wrapper.module.code_for_node(node) for node in plan.type_checking_imports]
+        result.deferred_imports = list(subcommand_imports) + [
+            wrapper.module.code_for_node(info.node)
+            for info in index.global_imports() if info.node in plan.removed_imports
+        ]
+        result.kept_imports = {
+            wrapper.module.code_for_node(node): reason for node, reason in plan.keep_global_imports.items()
+        }
+        # Lines in the original source, before constants were deferred
+        result.import_lines.update(subcommand_imports)
+        for info in sorted(index.global_imports(), key=lambda info: info.line):
+            result.import_lines.setdefault(wrapper.module.code_for_node(info.node), unshift_line(info.line, added_lines))
+        for node, names in plan.unused_imports.items():
+            result.unused_lines.update(dict.fromkeys(names, unshift_line(index.imports[node].line, added_lines)))
+        if not dry_run:
+            with timer.phase("write"):
+                _write_atomic(Path(output_path), output_code)
+
+    if diff and output_code is not None:
+        result.diff = unified_diff(source_code, output_code, source_path)
+    if keep_source and not dry_run and output_code != source_code:
+        result.original_code = source_code
+    if return_output:
+        result.output_code = output_code
+
+    if cache is not None and output_code is not None:
+        with timer.phase("cache"):
+            cache.put(cache_key, result, output_code, dependencies)
+            if not dry_run and Path(output_path).resolve() == source_path.resolve() and output_code != source_code:
+                # Rewritten in place: the next run sees our own output, which needs no further changes
+                cache.put(cache.key(output_code, cache_options), FileResult(source_path=str(source_path)),
+                          output_code, dependencies)
+
+    # Log changes if requested
+    if log_path:
+        with open(log_path, 'w') as f:
+            write_change_log(f, result)
+
+    return result
+
+def write_change_log(f, result: FileResult) -> None:
+    """Write the unused and moved imports of one processed file to an open log file."""
+    # Log unused imports
+    for name in result.unused_imports:
+        f.write(f"Unused import: {name}\n")
+
+    # Log imports moved to functions
+    for func_name, imports in result.moved_imports.items():
+        f.write(f"\nImports moved to function {func_name}:\n")
+        for imp in imports:
+            f.write(f"  {imp}\n")
+
+    # Log imports turned into lazy bindings
+    if result.lazy_imports:
+        f.write("\nImports made lazy:\n")
+        for imp in result.lazy_imports:
+            f.write(f"  {imp}\n")
+
+    # Log module level constants made lazy, and those that couldn't be
+    if result.deferred_constants:
+        f.write("\nConstants computed on first use:\n")
+        for name in result.deferred_constants:
+            f.write(f"  {name}\n")
+    if result.kept_constants:
+        f.write("\nConstants that could not be deferred:\n")
+        for name, reason in result.kept_constants.items():
+            f.write(f"  {name}: {reason}\n")
+
+    # Log click subcommands made lazy, and the registrations that couldn't be
+    if result.lazy_subcommands:
+        f.write("\nSubcommands imported on first use:\n")
+        for command in result.lazy_subcommands:
+            f.write(f"  {command}\n")
+    if result.kept_subcommands:
+        f.write("\nSubcommands that could not be made lazy:\n")
+        for registration, reason in result.kept_subcommands.items():
+            f.write(f"  {registration}: {reason}\n")
+
+    # Log imports only needed by type checkers
+    if result.type_checking_imports:
+        f.write("\nImports moved under TYPE_CHECKING:\n")
+        for imp in result.type_checking_imports:
+            f.write(f"  {imp}\n")
+
+    # Log global imports left as they are
+    if result.kept_imports:
+        f.write("\nImports kept at module level:\n")
+        for imp, reason in result.kept_imports.items():
+            f.write(f"  {imp.strip()}  ({reason})\n")
+
+def result_record(result: FileResult) -> Dict:
+    """One JSON-serializable record of a processed file, for the ``--check`` stream."""
+    def located(code: str) -> Dict:
+        return {"import": code.strip(), "line": result.import_lines.get(code)}
+
+    moved: Dict[str, List[str]] = {}
+    for func_name, imports in result.moved_imports.items():
+        for imp in imports:
+            moved.setdefault(imp, []).append(func_name)
+    if result.error is not None:
+        status = "error"
+    elif result.skipped is not None:
+        status = "skipped"
+    else:
+        status = "changed" if result.changed else "unchanged"
+    record = {
+        "path": result.source_path,
+        "status": status,
+        "moved": [{**located(imp), "functions": functions} for imp, functions in moved.items()],
+        "unused": [{"name": name, "line": result.unused_lines.get(name)} for name in result.unused_imports],
+        "kept_global": [{**located(imp), "reason": reason} for imp, reason in result.kept_imports.items()],
+        "lazy": [located(imp) for imp in result.lazy_imports],
+        "type_checking": [located(imp) for imp in result.type_checking_imports],
+        "deferred_constants": result.deferred_constants,
+        "lazy_subcommands": result.lazy_subcommands,
+        "cached": result.cached,
+        "elapsed_ms": round(1000 * sum(result.timings.values()), 3),
+    }
+    if result.error is not None:
+        record["error"] = result.error
+    if result.skipped is not None:
+        record["skipped"] = result.skipped
+    return record
+
+def parse_importtime(output: str) -> Dict[str, float]:
+    """Parse ``python -X importtime`` output into module name -> cumulative import time in ms."""
+    costs = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue  # header line
+        costs[parts[2].strip()] = int(parts[1]) / 1000
+    return costs
+
+def startup_modules(python: str = sys.executable) -> Set[str]:
+    """Modules that are already loaded when a bare interpreter starts (and so cost nothing to import)."""
+    proc = subprocess.run(
+        [python, '-c', 'import sys; print("\\n".join(sys.modules))'],
+        capture_output=True, text=True, check=True,
+    )
+    return set(proc.stdout.split())
+
+def _profile_module(
+    module: str,
+    python: str,
+    cwd: Optional[Path] = None,
+    env: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
+) -> Optional[float]:
+    try:
+        proc = subprocess.run(
+            [python, '-X', 'importtime', '-c', 'import sys; __import__(sys.argv[1])', module],
+            capture_output=True, text=True, cwd=cwd, env=env, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        logging.debug("Import of %s timed out after %s s", module, timeout)
+        return None
+    if proc.returncode != 0:
+        logging.debug("Could not profile import of %s: %s", module, proc.stderr.strip().splitlines()[-1:])
+        return None
+    return parse_importtime(proc.stderr).get(module, 0.0)
+
+def profile_import_costs(
+    modules: Optional[Iterable[str]] = None,
+    entry_command: Optional[str] = None,
+    python: str = sys.executable,
+    jobs: Optional[int] = None,
+) -> Dict[str, float]:
+    """Build a module name -> cumulative import time (ms) table by running imports in subprocesses.
+
+    Either runs ``entry_command`` once with ``PYTHONPROFILEIMPORTTIME`` set and records every
+    module it imports, or imports each of ``modules`` in its own fresh interpreter. Modules that
+    are loaded at interpreter startup are recorded with a cost of 0.
+    """
+    import shlex
+    from concurrent.futures import ThreadPoolExecutor
+    if entry_command is not None:
+        env = dict(os.environ, PYTHONPROFILEIMPORTTIME='1')
+        proc = subprocess.run(shlex.split(entry_command), capture_output=True, text=True, env=env)
+        if proc.returncode != 0:
+            logging.warning("Entry point exited with status %s while profiling imports", proc.returncode)
+        costs = parse_importtime(proc.stderr)
+    else:
+        modules = sorted(set(modules or ()))
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            measured = executor.map(lambda module: _profile_module(module, python), modules)
+            costs = {module: cost for module, cost in zip(modules, measured) if cost is not None}
+
+    for module in startup_modules(python):
+        costs[module] = 0.0
+    return costs
+
+def scan_imported_modules(files: Iterable[Path]) -> Set[str]:
+    """Absolute module names imported anywhere in ``files``, found with a quick ``ast`` scan."""
+    modules = set()
+    for path in files:
+        try:
+            tree = ast.parse(path.read_text())
+        except (SyntaxError, UnicodeDecodeError, OSError):
+            continue
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                modules.add(node.module)
+                # The imported names may be submodules that the package does not load by itself
+                modules.update(f"{node.module}.{alias.name}" for alias in node.names if alias.name != '*')
+    return modules
+
+# A frame of a collapsed stack line (py-spy record --format raw, austin, ...): "func (path/file.py:123)"
+COLLAPSED_FRAME_RE = re.compile(r'(?P<name>[^\s;()]+) \((?P<file>[^;()]+?):(?P<line>\d+)\)')
+
+def load_call_profile(path: Union[str, Path]) -> Dict[str, Dict[Tuple[str, int], int]]:
+    """Call counts per function from a profile: real path -> {(function name, line): count}.
+
+    A cProfile/pstats dump gives exact call counts (the line is the ``def`` line). Any other
+    file is read as collapsed stacks (``frame;frame;... count``), where the count is the number
+    of samples a function is on the stack in, and the line is the line being executed.
+    """
+    import pstats
+    counts: Dict[str, Dict[Tuple[str, int], int]] = defaultdict(lambda: defaultdict(int))
+    try:
+        stats = pstats.Stats(str(path)).stats
+    except Exception:
+        stats = None
+    if stats is not None:
+        for (filename, line, name), (_, total_calls, *_) in stats.items():
+            counts[os.path.realpath(filename)][(name, line)] += total_calls
+        return counts
+
+    for text_line in Path(path).read_text().splitlines():
+        stack, _, samples = text_line.rpartition(' ')
+        if not stack or not samples.isdigit():
+            continue
+        frames = {
+            (os.path.realpath(m['file']), m['name'], int(m['line']))
+            for m in COLLAPSED_FRAME_RE.finditer(stack)
+        }
+        for filename, name, line in frames:
+            counts[filename][(name, line)] += int(samples)
+    return counts
+
+def hot_functions_by_file(
+    profile: Dict[str, Dict[Tuple[str, int], int]],
+    files: Iterable[Path],
+    threshold: int,
+) -> Dict[Path, List[Tuple[str, int]]]:
+    """The profiled (function name, line) pairs of each file with a count of at least ``threshold``."""
+    hot = {}
+    for path in files:
+        functions = profile.get(os.path.realpath(path), {})
+        entries = sorted(key for key, count in functions.items() if count >= threshold)
+        if entries:
+            hot[path] = entries
+    return hot
+
+def find_package_root(path: Path) -> Path:
+    """The directory imports are resolved from: the first parent of ``path`` that is not a package."""
+    directory = path.resolve().parent if path.is_file() or path.suffix == '.py' else path.resolve()
+    while (directory / '__init__.py').exists() and directory.parent != directory:
+        directory = directory.parent
+    return directory
+
+def module_name_for_path(path: Path, root: Path) -> str:
+    """Dotted module name of ``path`` relative to the package root ``root``."""
+    parts = list(path.resolve().relative_to(root.resolve()).with_suffix('').parts)
+    if parts and parts[-1] == '__init__':
+        parts.pop()
+    return '.'.join(parts)
+
+def resolve_import_module(module: Optional[str], level: int, importer: str, is_package: bool) -> str:
+    """Absolute name of the module in ``from <level dots><module> import ...`` inside ``importer``."""
+    if not level:
+        return module or ''
+    package = importer.split('.') if is_package else importer.split('.')[:-1]
+    base = package[:len(package) - level + 1]
+    return '.'.join([*base, module] if module else base)
+
+def _is_type_checking_block(node: ast.AST) -> bool:
+    return isinstance(node, ast.If) and (
+        (isinstance(node.test, ast.Name) and node.test.id == 'TYPE_CHECKING') or
+        (isinstance(node.test, ast.Attribute) and node.test.attr == 'TYPE_CHECKING')
+    )
+
+def module_level_imports(tree: ast.Module) -> Iterator[Union[ast.Import, ast.ImportFrom]]:
+    """Import statements executed when the module is imported (not in functions or ``if TYPE_CHECKING:``)."""
+    stack = list(reversed(tree.body))
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)) or _is_type_checking_block(node):
+            continue
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            yield node
+        else:
+            stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+@dataclass
+class ModuleGraph:
+    """Static import graph of a source tree: which modules each module imports at import time."""
+    root: Path
+    # Module name -> file, for the modules of the tree
+    files: Dict[str, Path] = field(default_factory=dict)
+    # Module name -> modules imported at module level, keyed by the import statement's code
+    imports: Dict[str, Dict[str, Set[str]]] = field(default_factory=dict)
+
+    def imported_modules(self, code: str, importer: str) -> Set[str]:
+        """Absolute names of the modules an import statement of ``importer`` loads."""
+        node = ast.parse(code).body[0]
+        is_package = self.files.get(importer, Path()).name == '__init__.py'
+        if isinstance(node, ast.Import):
+            return {alias.name for alias in node.names}
+        base = resolve_import_module(node.module, node.level, importer, is_package)
+        modules = {base}
+        for alias in node.names:
+            if f"{base}.{alias.name}" in self.files:
+                modules.add(f"{base}.{alias.name}")  # a submodule
+        return modules
+
+    def eager_imports(self, module: str, without: Iterable[str] = ()) -> Set[str]:
+        """Modules imported by ``module`` at import time, ignoring the statements in ``without``."""
+        without = set(without)
+        return {
+            target
+            for code, targets in self.imports.get(module, {}).items() if code not in without
+            for target in targets
+        }
+
+    def closure(self, entry: str, deferred: Optional[Dict[str, Set[str]]] = None) -> Set[str]:
+        """Modules loaded when ``entry`` runs, optionally with the ``deferred`` statements of each module removed.
+
+        Importing ``a.b.c`` loads the packages ``a`` and ``a.b`` too. Modules outside the
+        tree are leaves: what they import themselves is not known statically.
+        """
+        deferred = deferred or {}
+        seen: Set[str] = set()
+        stack = [entry]
+        while stack:
+            module = stack.pop()
+            parts = module.split('.')
+            for i in range(1, len(parts) + 1):
+                name = '.'.join(parts[:i])
+                if name in seen:
+                    continue
+                seen.add(name)
+                if name in self.files:
+                    stack.extend(self.eager_imports(name, deferred.get(name, ())))
+        return seen
+
+def build_import_graph(files: Iterable[Path], root: Path) -> ModuleGraph:
+    """Parse ``files`` with ``ast`` and record the imports each one executes at import time."""
+    graph = ModuleGraph(root=root)
+    trees = {}
+    for path in files:
+        try:
+            name = module_name_for_path(path, root)
+        except ValueError:
+            continue  # not below the root
+        try:
+            trees[name] = ast.parse(path.read_text())
+        except (SyntaxError, UnicodeDecodeError) as e:
+            logging.warning("Can't parse %s for the import graph: %s", path, e)
+            continue
+        graph.files[name] = path
+
+    for name, tree in trees.items():
+        graph.imports[name] = {}
+        for node in module_level_imports(tree):
+            code = ast.unparse(node)
+            graph.imports[name].setdefault(code, set()).update(graph.imported_modules(code, name))
+    return graph
+
+def changed_python_files(since: Optional[str] = None, staged: bool = False, cwd: Optional[Path] = None) -> Set[Path]:
+    """Python files git reports as changed, as resolved paths (deleted files excluded).
+
+    With ``staged``, the files staged for commit; otherwise the files changed on the current
+    branch since it forked from ``since``: committed, staged, unstaged and untracked ones.
+    """
+    def git(directory: Optional[Path], *args: str) -> str:
+        proc = subprocess.run(['git', *args], cwd=directory, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"git {' '.join(args)} failed: {proc.stderr.strip()}")
+        return proc.stdout
+
+    # Paths are listed relative to the top level, for the whole repository
+    top = Path(git(cwd, 'rev-parse', '--show-toplevel').strip())
+    if staged:
+        names = git(top, 'diff', '--name-only', '-z', '--cached', '--diff-filter=d').split('\0')
+    else:
+        base = git(top, 'merge-base', since, 'HEAD').strip()
+        names = git(top, 'diff', '--name-only', '-z', '--diff-filter=d', base).split('\0')
+        names += git(top, 'ls-files', '-z', '--others', '--exclude-standard').split('\0')
+    return {(top / name).resolve() for name in names if name.endswith('.py')}
+
+def direct_importers(changed: Iterable[Path], files: Iterable[Path], root: Optional[Path] = None) -> Set[Path]:
+    """The ``files`` importing one of the ``changed`` files at module level (see ``build_import_graph``).
+
+    Module names are resolved from ``root``, or from each file's package root. Only the files
+    mentioning the name of a changed module are parsed, so the cost follows the size of the
+    change rather than the size of the tree.
+    """
+    changed = {path.resolve() for path in changed}
+    package_root = (lambda path: root) if root is not None else find_package_root
+    changed_modules = set()
+    for path in changed:
+        try:
+            changed_modules.add(module_name_for_path(path, package_root(path)))
+        except ValueError:
+            continue  # not below the root
+    names = {module.rpartition('.')[2] for module in changed_modules if module}
+
+    groups: Dict[Path, List[Path]] = defaultdict(list)
+    for path in files:
+        if path.resolve() in changed:
+            continue
+        try:
+            text = path.read_text()
+        except (OSError, UnicodeDecodeError):
+            continue
+        if any(name in text for name in names):
+            groups[package_root(path)].append(path)
+    if not groups:
+        return set()
+    for path in changed:
+        groups[package_root(path)].append(path)  # for telling submodules from other imported names
+
+    importers = set()
+    for group_root, group in groups.items():
+        graph = build_import_graph(group, group_root)
+        for module, statements in graph.imports.items():
+            path = graph.files[module]
+            if path.resolve() not in changed and any(targets & changed_modules for targets in statements.values()):
+                importers.add(path)
+    return importers
+
+@dataclass
+class StartupPlan:
+    """Which import statements to defer so that modules actually leave an entry point's startup closure."""
+    entry: str
+    closure_before: Set[str]
+    closure_after: Set[str]
+    # File -> code of the global import statements worth deferring in it
+    movable_imports: Dict[Path, Set[str]] = field(default_factory=dict)
+
+    @property
+    def removed_modules(self) -> Set[str]:
+        return self.closure_before - self.closure_after
+
+def plan_startup_moves(
+    files: List[Path],
+    entry: Path,
+    options: Dict,
+    root: Optional[Path] = None,
+    jobs: Optional[int] = None,
+    file_options: Optional[Dict[Path, Dict]] = None,
+) -> StartupPlan:
+    """Plan the rewrite of a package around the startup of ``entry``.
+
+    Files outside the entry point's startup closure are not planned at all. For the others,
+    a dry run tells which global imports the rewrite would defer; applying all of them to the
+    import graph gives the closure after the rewrite. A deferred statement is only kept in the
+    plan if its module still loads at startup and it loads a module that no longer does; the
+    rest would churn files for no startup gain (e.g. numpy moved out of A while B still imports
+    it eagerly, or anything moved inside a module that itself stops loading at startup).
+    """
+    root = root or find_package_root(entry)
+    graph = build_import_graph([*files, entry], root)
+    entry_name = module_name_for_path(entry, root)
+    closure_before = graph.closure(entry_name)
+    logging.info("Startup closure of %s: %s modules", entry, len(closure_before))
+
+    in_closure = {graph.files[name]: name for name in closure_before if name in graph.files}
+    dry_run_options = dict(options, dry_run=True, cache=None, movable_imports=None)
+    outputs = {path: path for path in files if path in in_closure}
+    # Module -> {normalized statement: statement as written}; the graph keys statements by ast.unparse
+    deferred: Dict[str, Dict[str, str]] = {}
+    for result in process_paths(outputs, dry_run_options, jobs=jobs, file_options=file_options):
+        if result.error is not None:
+            logging.warning("Error analysing %s: %s", result.source_path, result.error)
+            continue
+        deferred[in_closure[Path(result.source_path)]] = {
+            ast.unparse(ast.parse(code.strip())): code for code in result.deferred_imports
+        }
+    closure_after = graph.closure(entry_name, {module: set(codes) for module, codes in deferred.items()})
+
+    # Keeping a statement global only matters if its module is still loaded and it would load more
+    accepted: Dict[str, Set[str]] = {}
+    plan = StartupPlan(entry=entry_name, closure_before=closure_before, closure_after=closure_after)
+    for module, statements in deferred.items():
+        if module not in closure_after:
+            continue
+        useful = {
+            normalized for normalized in statements
+            if graph.imported_modules(normalized, module) - closure_after
+        }
+        if useful:
+            accepted[module] = useful
+            plan.movable_imports[graph.files[module]] = {statements[normalized] for normalized in useful}
+    # The closure with only the accepted deferrals applied: the ones dropped load nothing new
+    plan.closure_after = graph.closure(entry_name, accepted)
+    return plan
+
+def _default_output_path(source_path: Path) -> Path:
+    return Path(str(source_path.with_suffix('')) + '_im.py')
+
+def collect_python_files(patterns: Iterable[str], ignore_pattern: Optional[str] = None) -> List[Path]:
+    """Expand files, directories and glob patterns into a sorted list of Python files.
+
+    Directories are walked recursively. Files matching ``ignore_pattern`` (matched with
+    ``re.match`` against the path, like ``--ignore-files``) are dropped.
+    """
+    files: Set[Path] = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = [Path(p) for p in glob.glob(pattern, recursive=True)]
+            if not matches:
+                raise FileNotFoundError(f"No files match: {pattern}")
+        else:
+            matches = [Path(pattern)]
+            if not matches[0].exists():
+                raise FileNotFoundError(f"File not found: {pattern}")
+        for path in matches:
+            if path.is_dir():
+                files.update(p for p in path.rglob('*.py') if p.is_file())
+            elif path.suffix == '.py' or not glob.has_magic(pattern):
+                files.add(path)
+
+    if ignore_pattern:
+        ignored = {p for p in files if re.match(ignore_pattern, str(p))}
+        for path in sorted(ignored):
+            logging.info("Skipping ignored file: %s", path)
+        files -= ignored
+    return sorted(files)
+
+def _resolve_output_paths(
+    files: List[Path],
+    output: Optional[str],
+    in_place: bool = False,
+) -> Dict[Path, Path]:
+    """Map every source file to the path its rewritten version is written to."""
+    if in_place:
+        return {path: path for path in files}
+    if output is None:
+        # Don't feed outputs of a previous run back in as inputs
+        outputs = {_default_output_path(path) for path in files}
+        return {path: _default_output_path(path) for path in files if path not in outputs}
+    if len(files) == 1 and not Path(output).is_dir():
+        return {files[0]: Path(output)}
+    # Several inputs: mirror the tree below the common parent into the output directory
+    root = Path(os.path.commonpath([str(p.resolve().parent) for p in files]))
+    return {path: Path(output) / path.resolve().relative_to(root) for path in files}
+
+CONFIG_FILE = "pyproject.toml"
+
+@dataclass
+class ProjectConfig:
+    """The ``[tool.import_mover]`` table of a pyproject.toml (see ``load_config``)."""
+    path: Path
+    # Module name -> action (see IMPORT_RULE_ACTIONS and import_rule)
+    import_rules: Dict[str, str] = field(default_factory=dict)
+    preloaded_modules: Set[str] = field(default_factory=set)
+    # Glob patterns relative to the directory of the pyproject.toml
+    exclude: List[str] = field(default_factory=list)
+    # (path patterns, rules replacing the global ones for their modules), later ones winning
+    overrides: List[Tuple[List[str], Dict[str, str]]] = field(default_factory=list)
+
+    def _relative_path(self, path: Path) -> Optional[str]:
+        try:
+            return path.resolve().relative_to(self.path.resolve().parent).as_posix()
+        except ValueError:
+            return None  # outside the project
+
+    def is_excluded(self, path: Path) -> bool:
+        relative = self._relative_path(path)
+        return relative is not None and any(fnmatch.fnmatch(relative, pattern) for pattern in self.exclude)
+
+    def rules_for(self, path: Path) -> Dict[str, str]:
+        """The import rules of one file: the global ones updated by the overrides matching its path."""
+        relative = self._relative_path(path)
+        rules = self.import_rules
+        for patterns, override in self.overrides:
+            if relative is not None and any(fnmatch.fnmatch(relative, pattern) for pattern in patterns):
+                rules = {**rules, **override}
+        return rules
+
+def _config_rules(table: Dict, where: str) -> Dict[str, str]:
+    rules: Dict[str, str] = {}
+    for action in IMPORT_RULE_ACTIONS:
+        modules = table.get(action, [])
+        if not isinstance(modules, list) or not all(isinstance(module, str) for module in modules):
+            raise ValueError(f"{where}: {action} must be a list of module names")
+        for module in modules:
+            if module in rules:
+                raise ValueError(f"{where}: {module} is both in {rules[module]} and {action}")
+            rules[module] = action
+    return rules
+
+def load_config(path: Path, python: str = sys.executable) -> Optional[ProjectConfig]:
+    """Read the ``[tool.import_mover]`` table of a pyproject.toml; None if it has none.
+
+    ``keep``, ``defer``, ``lazy`` and ``type-checking`` list the modules of each rule (matched by
+    name, see ``import_rule``). ``stdlib`` gives the standard library one of these rules, below
+    the rules naming its modules. ``preloaded`` lists modules loaded at startup anyway, whose
+    imports stay global; ``"startup"`` stands for those of a bare ``python``. ``exclude`` lists
+    files to leave alone and ``[[tool.import_mover.overrides]]`` tables give the files matching
+    their ``paths`` other rules; both are glob patterns relative to the pyproject.toml.
+    """
+    text = path.read_text()
+    if "import_mover" not in text:
+        return None  # not worth parsing (or needing tomli for)
+    try:
+        import tomllib
+    except ModuleNotFoundError:  # Python < 3.11
+        import tomli as tomllib
+    table = tomllib.loads(text).get("tool", {}).get("import_mover")
+    if table is None:
+        return None
+
+    known = {*IMPORT_RULE_ACTIONS, "stdlib", "preloaded", "exclude", "overrides"}
+    unknown = set(table) - known
+    if unknown:
+        raise ValueError(f"{path}: unknown [tool.import_mover] keys: {', '.join(sorted(unknown))}")
+    config = ProjectConfig(path=path, import_rules=_config_rules(table, str(path)))
+
+    stdlib = table.get("stdlib")
+    if stdlib is not None:
+        if stdlib not in IMPORT_RULE_ACTIONS:
+            raise ValueError(f"{path}: stdlib must be one of {', '.join(IMPORT_RULE_ACTIONS)}")
+        for module in sys.stdlib_module_names:
+            config.import_rules.setdefault(module, stdlib)
+
+    for module in table.get("preloaded", []):
+        if module == "startup":
+            config.preloaded_modules |= startup_modules(python)
+        else:
+            config.preloaded_modules.add(module)
+    config.exclude = list(table.get("exclude", []))
+
+    for number, override in enumerate(table.get("overrides", []), 1):
+        where = f"{path}: override {number}"
+        if not override.get("paths"):
+            raise ValueError(f"{where}: paths is missing")
+        unknown = set(override) - {*IMPORT_RULE_ACTIONS, "paths"}
+        if unknown:
+            raise ValueError(f"{where}: unknown keys: {', '.join(sorted(unknown))}")
+        config.overrides.append((list(override["paths"]), _config_rules(override, where)))
+    return config
+
+def find_config(paths: Iterable[Union[str, Path]]) -> Optional[Path]:
+    """The pyproject.toml nearest above the common directory of ``paths`` (like black and ruff)."""
+    directories = [Path(path).resolve() for path in paths]
+    directories = [path if path.is_dir() else path.parent for path in directories]
+    if not directories:
+        return None
+    directory = Path(os.path.commonpath([str(path) for path in directories]))
+    for candidate in (directory, *directory.parents):
+        if (candidate / CONFIG_FILE).is_file():
+            return candidate / CONFIG_FILE
+    return None
+
+def profile_report(results: List[FileResult], run_timings: Dict[str, float], wall_time: float) -> Dict:
+    """Structured timings of a run: the run's own phases, per-phase totals over files, and per file."""
+    file_phases: Dict[str, Dict] = {}
+    for result in results:
+        for name, seconds in result.timings.items():
+            phase = file_phases.setdefault(name, {"total_s": 0.0, "files": 0, "max_ms": 0.0, "max_file": None})
+            phase["total_s"] += seconds
+            phase["files"] += 1
+            if seconds * 1000 > phase["max_ms"]:
+                phase["max_ms"], phase["max_file"] = seconds * 1000, result.source_path
+    for phase in file_phases.values():
+        phase["mean_ms"] = phase["total_s"] * 1000 / phase["files"]
+    return {
+        "wall_time_s": wall_time,
+        "run_phases": run_timings,
+        "file_phases": file_phases,
+        "files": [
+            {"path": result.source_path, "cached": result.cached, "timings": result.timings}
+            for result in results
+        ],
+    }
+
+def _init_worker(log_level: int) -> None:
+    logging.basicConfig(
+        level=log_level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+def _process_file_job(source_path: Path, output_path: Path, options: Dict) -> FileResult:
+    """Worker entry point: process one file and turn any failure into a FileResult."""
+    try:
+        if not options.get("dry_run"):
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+        return process_file(source_path, None, str(output_path), **options)
+    except Exception as e:
+        return FileResult(source_path=str(source_path), output_path=str(output_path), error=f"{type(e).__name__}: {e}")
+
+def process_paths(
+    outputs: Dict[Path, Path],
+    options: Dict,
+    jobs: Optional[int] = None,
+    file_options: Optional[Dict[Path, Dict]] = None,
+) -> Iterator[FileResult]:
+    """Run ``process_file`` over many files, in a pool of worker processes when ``jobs`` > 1.
+
+    ``file_options`` adds per-file keyword arguments on top of ``options``.
+    Results are yielded as files finish, so the order is not the input order.
+    """
+    file_options = file_options or {}
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(outputs) <= 1:
+        for source_path, output_path in outputs.items():
+            yield _process_file_job(source_path, output_path, {**options, **file_options.get(source_path, {})})
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(
+        max_workers=min(jobs, len(outputs)),
+        initializer=_init_worker,
+        initargs=(logging.getLogger().level,),
+    ) as executor:
+        futures = [
+            executor.submit(_process_file_job, source_path, output_path, {**options, **file_options.get(source_path, {})})
+            for source_path, output_path in outputs.items()
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+# An import counts as slower only if it is both this much and --verify-slowdown percent slower
+VERIFY_MIN_SLOWDOWN_MS = 1.0
+
+@dataclass
+class VerifyOutcome:
+    """Import time of a rewritten module before and after, and why it was reverted, if it was."""
+    path: str
+    module: str
+    before_ms: Optional[float] = None
+    after_ms: Optional[float] = None
+    reverted: Optional[str] = None
+
+def _cache_bytecode(prefix: Path, path: Path) -> None:
+    """Compile ``path`` into the ``PYTHONPYCACHEPREFIX`` tree ``prefix``, replacing bytecode of another version.
+
+    Bytecode is validated by the source's mtime in whole seconds and its size, which two versions
+    of a file written in the same second can share.
+    """
+    import py_compile
+    for directory in {path.absolute().parent, path.resolve().parent}:
+        cfile = prefix.joinpath(*directory.parts[1:], f"{path.stem}.{sys.implementation.cache_tag}.pyc")
+        try:
+            py_compile.compile(str(path), cfile=str(cfile), doraise=True)
+        except py_compile.PyCompileError:
+            cfile.unlink(missing_ok=True)
+
+def _measure_imports(
+    modules: Dict[Path, Tuple[str, Path]],
+    env: Dict[str, str],
+    jobs: Optional[int],
+    timeout: Optional[float],
+) -> Dict[Path, Optional[float]]:
+    """Import time (ms) of each module in a fresh interpreter, in parallel; None if it fails."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def measure(path: Path) -> Optional[float]:
+        module, root = modules[path]
+        return _profile_module(module, sys.executable, cwd=root, env=env, timeout=timeout)
+
+    paths = list(modules)
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        return dict(zip(paths, executor.map(measure, paths)))
+
+def _run_test_command(command: str, env: Dict[str, str], timeout: Optional[float]) -> bool:
+    import shlex
+    try:
+        proc = subprocess.run(shlex.split(command), capture_output=True, text=True, env=env, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.debug("%r timed out after %s s", command, timeout)
+        return False
+    if proc.returncode != 0:
+        logging.debug("%r exited with status %s: %s", command, proc.returncode, proc.stdout[-2000:] + proc.stderr[-2000:])
+    return proc.returncode == 0
+
+def verify_rewrites(
+    results: List[FileResult],
+    command: Optional[str] = None,
+    runs: int = 3,
+    slowdown_pct: float = 10.0,
+    jobs: Optional[int] = None,
+    timeout: Optional[float] = 300.0,
+) -> List[VerifyOutcome]:
+    """Import every rewritten module before and after the rewrite, and revert the ones that got worse.
+
+    ``results`` are changed files processed with ``keep_source``. Each module is imported
+    ``runs`` times in fresh interpreters (in parallel over modules) with the rewritten files in
+    place and as many times with the original sources written back, alternating which goes first;
+    a file is reverted if its module imported before but fails to now, or if its fastest import got
+    more than ``slowdown_pct`` percent (and at least ``VERIFY_MIN_SLOWDOWN_MS``) slower. All runs
+    share one bytecode cache, warmed with both versions first, so that they time imports rather than
+    compilation. If ``command`` passes on the original files, the remaining rewrites are applied and
+    the command is run again; if it fails, the files breaking it are found by bisection and reverted.
+    Modules that didn't import before either are not judged by importing.
+    """
+    originals = {Path(result.output_path): result.original_code for result in results}
+    rewritten = {path: path.read_text() for path in originals}
+    modules = {}
+    for path in originals:
+        root = find_package_root(path)
+        modules[path] = (module_name_for_path(path, root), root)
+    outcomes = {path: VerifyOutcome(path=str(path), module=modules[path][0]) for path in originals}
+
+    with tempfile.TemporaryDirectory(prefix="import_mover_verify_") as scratch:
+        prefix = Path(scratch) / "pycache"
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=str(prefix))
+
+        def apply(paths: Iterable[Path]) -> None:
+            paths = set(paths)
+            for path in originals:
+                _write_atomic(path, rewritten[path] if path in paths else originals[path])
+                _cache_bytecode(prefix, path)
+
+        logging.info("Verifying %s rewritten modules...", len(originals))
+        # Compile what either version imports once, outside of the measured runs
+        apply(originals)
+        _measure_imports(modules, env, jobs, timeout)
+        apply(())
+        _measure_imports(modules, env, jobs, timeout)
+
+        times: Dict[str, Dict[Path, List[Optional[float]]]] = {'before': defaultdict(list), 'after': defaultdict(list)}
+        for i in range(runs):
+            # Neither version always runs second, on caches the other one warmed
+            for side in ('before', 'after') if i % 2 == 0 else ('after', 'before'):
+                apply(originals if side == 'after' else ())
+                for path, elapsed in _measure_imports(modules, env, jobs, timeout).items():
+                    times[side][path].append(elapsed)
+        before, after = (
+            {path: None if None in values else min(values) for path, values in times[side].items()}
+            for side in ('before', 'after')
+        )
+        apply(())
+
+        accepted = []
+        for path, outcome in outcomes.items():
+            outcome.before_ms, outcome.after_ms = before[path], after[path]
+            if outcome.before_ms is None:
+                logging.warning("%s doesn't import without the rewrite either; not judged by importing", outcome.module)
+            elif outcome.after_ms is None:
+                outcome.reverted = "fails to import"
+            elif (outcome.after_ms > outcome.before_ms * (1 + slowdown_pct / 100)
+                  and outcome.after_ms - outcome.before_ms >= VERIFY_MIN_SLOWDOWN_MS):
+                outcome.reverted = f"import slower ({outcome.before_ms:.2f} ms -> {outcome.after_ms:.2f} ms)"
+            if outcome.reverted is None:
+                accepted.append(path)
+
+        if command is not None and accepted:
+            if not _run_test_command(command, env, timeout):
+                logging.warning("%r fails without the rewrite too; not judging the rewrite by it", command)
+            else:
+                def breaking(candidates: List[Path], base: List[Path]) -> List[Path]:
+                    """The candidates that make the command fail on top of the (passing) ``base``."""
+                    apply(base + candidates)
+                    if _run_test_command(command, env, timeout):
+                        return []
+                    if len(candidates) == 1:
+                        return candidates
+                    middle = len(candidates) // 2
+                    bad = breaking(candidates[:middle], base)
+                    good = [path for path in candidates[:middle] if path not in bad]
+                    return bad + breaking(candidates[middle:], base + good)
+
+                for path in breaking(accepted, []):
+                    outcomes[path].reverted = f"breaks {command!r}"
+                    accepted.remove(path)
+        apply(accepted)
+    return list(outcomes.values())
+
+BENCH_SITECUSTOMIZE = '''
+import atexit
+import os
+import sys
+
+
+def _im_peak_rss_kb():
+    # VmHWM is the peak of this program only; ru_maxrss may include the parent before exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def _im_report():
+    # Written by hand: importing json here would show up in the numbers
+    modules = len(sys.modules)
+    rss = _im_peak_rss_kb()
+    with open(os.environ["IMPORT_MOVER_PROBE_FILE"], "w") as f:
+        f.write('{"modules": %d, "max_rss_kb": %s}' % (modules, "null" if rss is None else rss))
+
+
+if os.environ.get("IMPORT_MOVER_PROBE_FILE"):
+    atexit.register(_im_report)
+'''
+
+# Two-sided 95% critical values of Student's t distribution by degrees of freedom
+_T_CRITICAL_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+    11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093,
+    20: 2.086, 21: 2.080, 22: 2.074, 23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048,
+    29: 2.045, 30: 2.042,
+}
+
+BENCH_METRICS = ['wall_time_s', 'user_cpu_s', 'sys_cpu_s', 'max_rss_mb', 'modules']
+
+@dataclass
+class RunSample:
+    """Resource usage of one run of the benchmarked command."""
+    returncode: int
+    wall_time_s: float
+    user_cpu_s: Optional[float] = None
+    sys_cpu_s: Optional[float] = None
+    max_rss_mb: Optional[float] = None
+    modules: Optional[int] = None
+
+def _run_command_once(command: str, cwd: Path, env: Dict[str, str], timeout: Optional[float] = None) -> RunSample:
+    """Run ``command`` once and measure wall time, CPU time, peak RSS and ``len(sys.modules)`` at exit.
+
+    Module count and peak RSS come from a ``sitecustomize`` that ``env`` puts on ``PYTHONPATH``
+    (see ``measure_startup``). CPU time needs ``os.wait4`` and is None elsewhere. A run still
+    going after ``timeout`` seconds is killed, giving a nonzero return code.
+    """
+    import shlex
+    import threading
+    fd, probe_file = tempfile.mkstemp(prefix="import_mover_probe_")
+    os.close(fd)
+    env = dict(env, IMPORT_MOVER_PROBE_FILE=probe_file)
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            shlex.split(command), cwd=cwd, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        if hasattr(os, 'wait4'):
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, proc.kill)
+                timer.start()
+            _, status, usage = os.wait4(proc.pid, 0)
+            wall_time = time.perf_counter() - start
+            if timer is not None:
+                timer.cancel()
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            sample = RunSample(
+                returncode=proc.returncode,
+                wall_time_s=wall_time,
+                user_cpu_s=usage.ru_utime,
+                sys_cpu_s=usage.ru_stime,
+            )
+        else:
+            # Like the timer above: a run over ``timeout`` is killed and counts as a failure
+            try:
+                proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            sample = RunSample(returncode=proc.returncode, wall_time_s=time.perf_counter() - start)
+        probe = Path(probe_file).read_text()
+        if probe:
+            probe = json.loads(probe)
+            sample.modules = probe['modules']
+            if probe['max_rss_kb'] is not None:
+                sample.max_rss_mb = probe['max_rss_kb'] / 1024
+        return sample
+    finally:
+        os.unlink(probe_file)
+
+def _purge_bytecode(root: Path) -> None:
+    for cache_dir in root.rglob('__pycache__'):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def measure_startup(
+    command: str,
+    cwd: Path,
+    runs: int = 10,
+    warmup: int = 3,
+    bytecode_root: Optional[Path] = None,
+    timeout: Optional[float] = None,
+) -> Dict[str, List[RunSample]]:
+    """Run ``command`` ``runs`` times cold (no bytecode caches below ``bytecode_root``) and warm."""
+    with tempfile.TemporaryDirectory(prefix="import_mover_probe_") as probe_dir:
+        Path(probe_dir, 'sitecustomize.py').write_text(BENCH_SITECUSTOMIZE)
+        python_path = os.pathsep.join(p for p in (probe_dir, os.environ.get('PYTHONPATH')) if p)
+        env = dict(os.environ, PYTHONPATH=python_path)
+
+        cold = []
+        for _ in range(runs):
+            _purge_bytecode(bytecode_root or cwd)
+            cold.append(_run_command_once(command, cwd, env, timeout))
+        for _ in range(warmup):
+            _run_command_once(command, cwd, env, timeout)
+        warm = [_run_command_once(command, cwd, env, timeout) for _ in range(runs)]
+    return {'cold': cold, 'warm': warm}
+
+def summarize_samples(values: List[float]) -> Dict[str, float]:
+    """Mean, standard deviation and 95% confidence interval half-width of a list of measurements."""
+    import statistics
+    n = len(values)
+    mean = statistics.fmean(values)
+    stdev = statistics.stdev(values) if n > 1 else 0.0
+    t = _T_CRITICAL_95.get(n - 1, 1.96)
+    return {
+        'n': n,
+        'mean': mean,
+        'stdev': stdev,
+        'ci95': t * stdev / n ** 0.5 if n > 1 else 0.0,
+        'min': min(values),
+        'max': max(values),
+    }
+
+def _summarize_runs(samples: List[RunSample]) -> Dict:
+    """Statistics of the successful runs only; a failed run says nothing about startup."""
+    succeeded = [sample for sample in samples if sample.returncode == 0]
+    summary = {'failed_runs': len(samples) - len(succeeded)}
+    for metric in BENCH_METRICS:
+        values = [getattr(sample, metric) for sample in succeeded if getattr(sample, metric) is not None]
+        if values:
+            summary[metric] = summarize_samples(values)
+    return summary
+
+def run_benchmark(
+    source_dir: Path,
+    command: str,
+    options: Dict,
+    runs: int = 10,
+    warmup: int = 3,
+    cwd: Optional[str] = None,
+    jobs: Optional[int] = None,
+    ignore_files: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> Dict:
+    """Measure the startup of ``command`` before and after rewriting a scratch copy of ``source_dir``.
+
+    ``command`` runs inside the copy (in its ``cwd`` subdirectory if given), so the original
+    tree is never modified. Returns a JSON-serialisable report.
+    """
+    with tempfile.TemporaryDirectory(prefix="import_mover_bench_") as scratch:
+        tree = Path(scratch) / source_dir.resolve().name
+        shutil.copytree(source_dir, tree, ignore=shutil.ignore_patterns('__pycache__', '.git', DEFAULT_CACHE_DIR))
+        run_dir = tree / cwd if cwd else tree
+
+        logging.info("Measuring %r before the rewrite...", command)
+        before = measure_startup(command, run_dir, runs, warmup, bytecode_root=tree, timeout=timeout)
+
+        files = collect_python_files([str(tree)], ignore_files)
+        rewrite = list(process_paths({path: path for path in files}, options, jobs=jobs))
+        for result in rewrite:
+            if result.error is not None:
+                logging.warning("Error processing file %s: %s", result.source_path, result.error)
+
+        logging.info("Measuring %r after the rewrite...", command)
+        after = measure_startup(command, run_dir, runs, warmup, bytecode_root=tree, timeout=timeout)
+
+    report = {
+        'command': command,
+        'runs': runs,
+        'warmup': warmup,
+        'rewrite': {
+            'files': len(rewrite),
+            'changed': sum(1 for r in rewrite if r.error is None and r.changed),
+            'failed': sum(1 for r in rewrite if r.error is not None),
+        },
+        'before': {mode: _summarize_runs(samples) for mode, samples in before.items()},
+        'after': {mode: _summarize_runs(samples) for mode, samples in after.items()},
+        'change_pct': {},
+    }
+    for mode in ('cold', 'warm'):
+        report['change_pct'][mode] = {}
+        for metric in BENCH_METRICS:
+            old = report['before'][mode].get(metric)
+            new = report['after'][mode].get(metric)
+            if old and new and old['mean']:
+                report['change_pct'][mode][metric] = (new['mean'] - old['mean']) / old['mean'] * 100
+    return report
+
+def format_benchmark_markdown(report: Dict) -> str:
+    """Render a ``run_benchmark`` report as Markdown tables (mean ± 95% CI)."""
+    lines = [
+        f"## Startup benchmark: `{report['command']}`",
+        "",
+        f"{report['runs']} runs per mode, {report['warmup']} warmup runs before the warm runs. "
+        f"Rewrite: {report['rewrite']['changed']} of {report['rewrite']['files']} files changed, "
+        f"{report['rewrite']['failed']} failed.",
+    ]
+    for mode in ('cold', 'warm'):
+        lines += ["", f"### {mode.capitalize()} start", ""]
+        failed = (report['before'][mode]['failed_runs'], report['after'][mode]['failed_runs'])
+        if report['runs'] in failed:
+            lines.append(f"Every run failed {'before' if failed[0] == report['runs'] else 'after'} the rewrite, "
+                         f"nothing to compare ({failed[0]} failed before, {failed[1]} after).")
+            continue
+        lines += ["| metric | before | after | change |", "|---|---|---|---|"]
+        for metric in BENCH_METRICS:
+            old = report['before'][mode].get(metric)
+            new = report['after'][mode].get(metric)
+            if not old or not new:
+                continue
+            change = report['change_pct'][mode].get(metric)
+            change = f"{change:+.1f}%" if change is not None else "n/a"
+            lines.append(
+                f"| {metric} | {old['mean']:.4g} ± {old['ci95']:.2g} | {new['mean']:.4g} ± {new['ci95']:.2g} | {change} |"
+            )
+        if any(failed):
+            lines += ["", f"Failed runs: {failed[0]} before, {failed[1]} after."]
+    return "\n".join(lines) + "\n"
+
+def bench_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog='import_mover.py bench',
+        description='Measure the startup of a command before and after rewriting a scratch copy of a source tree.',
+    )
+    parser.add_argument('source', type=str, help='Source tree to copy and rewrite')
+    parser.add_argument('--command', type=str, required=True,
+                      help='Command to benchmark, run inside the copy (e.g. "python cli.py --help")')
+    parser.add_argument('--cwd', type=str, default=None,
+                      help='Directory inside the source tree to run the command in (default: its root)')
+    parser.add_argument('--runs', type=int, default=10, help='Runs per mode (default: 10)')
+    parser.add_argument('--warmup', type=int, default=3, help='Warmup runs before the warm runs (default: 3)')
+    parser.add_argument('--timeout', type=float, default=None, help='Timeout of a single run in seconds')
+    parser.add_argument('--format', type=str, default='markdown', choices=['markdown', 'json'],
+                      help='Report format (default: markdown)')
+    parser.add_argument('--report', type=str, default=None, help='Write the report to this file instead of stdout')
+    parser.add_argument('--max-regression', type=float, default=None, metavar='PCT',
+                      help='Exit with status 1 if the warm wall time gets more than PCT percent slower')
+    _add_rewrite_arguments(parser)
+    args = parser.parse_args(argv)
+
+    _configure_logging(args.log_level)
+    source_dir = Path(args.source)
+    if not source_dir.is_dir():
+        logging.error("Not a directory: %s", args.source)
+        sys.exit(1)
+
+    files = collect_python_files([args.source], args.ignore_files)
+    options = _rewrite_options(args, files, _project_config(args, files))
+    report = run_benchmark(
+        source_dir,
+        args.command,
+        options,
+        runs=args.runs,
+        warmup=args.warmup,
+        cwd=args.cwd,
+        jobs=args.jobs,
+        ignore_files=args.ignore_files,
+        timeout=args.timeout,
+    )
+
+    text = json.dumps(report, indent=2) if args.format == 'json' else format_benchmark_markdown(report)
+    if args.report:
+        Path(args.report).write_text(text)
+    else:
+        sys.stdout.write(text)
+
+    # Gate on the result
+    status = 0
+    for mode in ('cold', 'warm'):
+        for side in ('before', 'after'):
+            if report[side][mode]['failed_runs'] == report['runs']:
+                logging.error("Every %s run of the command failed %s the rewrite", mode, side)
+                status = 1
+        if report['after'][mode]['failed_runs'] > report['before'][mode]['failed_runs']:
+            logging.error("The command fails more often after the rewrite (%s runs)", mode)
+            status = 1
+    change = report['change_pct']['warm'].get('wall_time_s')
+    if args.max_regression is not None and change is not None and change > args.max_regression:
+        logging.error("Warm wall time regressed by %.1f%% (allowed: %s%%)", change, args.max_regression)
+        status = 1
+    sys.exit(status)
+
+MEMORY_PROBE = '''
+import sys
+
+startup = set(sys.modules)
+TRACE = sys.argv[3:] == ["trace"]
+# Module -> module executing when it started to execute, and bytes it left allocated (with what it imported)
+parents = {}
+allocated = {}
+
+
+def status_kb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+if TRACE:
+    # The C module: tracemalloc.py imports re, collections, ... which would no longer count
+    import _tracemalloc as tracemalloc
+
+    executing = []
+
+    class MeasuringLoader:
+        """The real loader, recording the importer of each module and what executing it allocates."""
+        def __init__(self, loader, name):
+            self.loader = loader
+            self.name = name
+
+        def __getattr__(self, attr):
+            return getattr(self.loader, attr)
+
+        def create_module(self, spec):
+            create_module = getattr(self.loader, "create_module", None)
+            return create_module(spec) if create_module is not None else None
+
+        def exec_module(self, module):
+            parents[self.name] = executing[-1] if executing else None
+            executing.append(self.name)
+            start = tracemalloc.get_traced_memory()[0]
+            try:
+                self.loader.exec_module(module)
+            finally:
+                allocated[self.name] = tracemalloc.get_traced_memory()[0] - start
+                executing.pop()
+
+    class MeasuringFinder:
+        @classmethod
+        def find_spec(cls, name, path=None, target=None):
+            for finder in sys.meta_path:
+                if finder is cls or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(name, path, target)
+                if spec is not None:
+                    if hasattr(spec.loader, "exec_module"):
+                        spec.loader = MeasuringLoader(spec.loader, name)
+                    return spec
+            return None
+
+    sys.meta_path.insert(0, MeasuringFinder)
+    tracemalloc.start()
+
+rss_before = status_kb("VmRSS")
+__import__(sys.argv[1])
+report = {
+    "modules": sorted(set(sys.modules) - startup),
+    "rss_kb": status_kb("VmRSS"),
+    "import_rss_kb": None if rss_before is None else status_kb("VmRSS") - rss_before,
+    "peak_rss_kb": status_kb("VmHWM"),
+}
+if TRACE:
+    report["traced_bytes"], report["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+    report["parents"] = parents
+    report["allocated"] = allocated
+    tracemalloc.stop()
+elif report["peak_rss_kb"] is None:
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report["peak_rss_kb"] = rss // 1024 if sys.platform == "darwin" else rss
+
+import json
+
+with open(sys.argv[2], "w") as f:
+    json.dump(report, f)
+'''
+
+MEMORY_METRICS = ['rss_kb', 'import_rss_kb', 'peak_rss_kb']
+
+def _probe_memory(
+    module: str, cwd: Path, python: str = sys.executable, trace: bool = False, timeout: Optional[float] = None,
+) -> Dict:
+    """Import ``module`` in a fresh interpreter and report the modules it loads and the memory it takes.
+
+    With ``trace``, tracemalloc runs too and the report has the importer of each module and
+    the bytes executing it left allocated (see ``MEMORY_PROBE``); tracing costs memory itself,
+    so RSS is only meaningful without it.
+    """
+    fd, report_file = tempfile.mkstemp(prefix="import_mover_memory_", suffix=".json")
+    os.close(fd)
+    try:
+        proc = subprocess.run(
+            [python, "-c", MEMORY_PROBE, module, report_file, *(["trace"] if trace else [])],
+            cwd=cwd, capture_output=True, text=True, timeout=timeout,
+        )
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()
+            raise RuntimeError(f"Importing {module} failed with status {proc.returncode}"
+                               + (f": {error[-1]}" if error else ""))
+        return json.loads(Path(report_file).read_text())
+    finally:
+        os.unlink(report_file)
+
+def measure_memory(
+    module: str, cwd: Path, runs: int = 5, python: str = sys.executable, timeout: Optional[float] = None,
+) -> Dict:
+    """Modules loaded by importing ``module``, median RSS figures of ``runs`` imports and one traced import."""
+    import statistics
+    _probe_memory(module, cwd, python, timeout=timeout)  # writes the bytecode caches
+    samples = [_probe_memory(module, cwd, python, timeout=timeout) for _ in range(runs)]
+    traced = _probe_memory(module, cwd, python, trace=True, timeout=timeout)
+    summary = {'modules': samples[0]['modules']}
+    for metric in MEMORY_METRICS:
+        values = [sample[metric] for sample in samples if sample[metric] is not None]
+        summary[metric] = statistics.median(values) if values else None
+    summary.update(
+        traced_bytes=traced['traced_bytes'],
+        traced_peak_bytes=traced['traced_peak_bytes'],
+        parents=traced['parents'],
+        allocated=traced['allocated'],
+    )
+    return summary
+
+def attribute_avoided_modules(
+    avoided: Iterable[str],
+    parents: Dict[str, Optional[str]],
+    statements: Dict[Tuple[str, str], Set[str]],
+) -> Dict[Optional[Tuple[str, str]], List[str]]:
+    """Assign each module no longer loaded to the deferred import statement that loaded it.
+
+    ``parents`` is the first-import tree of the run before the rewrite (module -> the module
+    that was executing when it was first imported) and ``statements`` maps ``(importer,
+    statement)`` to the modules the statement imports. A module goes to the innermost deferred
+    statement on its path from the entry point, or to None if there is none (its importer was
+    made lazy as a whole, a constant was deferred, ...).
+    """
+    edges: Dict[Tuple[str, str], Tuple[str, str]] = {}
+    for (importer, code), targets in statements.items():
+        for target in targets:
+            # ``import a.b`` loads the package ``a`` too
+            parts = target.split('.')
+            for i in range(1, len(parts) + 1):
+                edges.setdefault((importer, '.'.join(parts[:i])), (importer, code))
+    attributed: Dict[Optional[Tuple[str, str]], List[str]] = {}
+    for module in sorted(avoided):
+        owner, node = None, module
+        while node is not None and owner is None:
+            parent = parents.get(node)
+            owner = edges.get((parent, node)) if parent is not None else None
+            node = parent
+        attributed.setdefault(owner, []).append(module)
+    return attributed
+
+def _self_allocated(parents: Dict[str, Optional[str]], allocated: Dict[str, int]) -> Dict[str, int]:
+    """Bytes allocated by executing each module itself, without the modules it imported."""
+    own = dict(allocated)
+    for module, parent in parents.items():
+        if parent in own and module in allocated:
+            own[parent] -= allocated[module]
+    return own
+
+def run_memory_report(
+    source_dir: Path,
+    entry: Path,
+    options: Dict,
+    runs: int = 5,
+    package_root: Optional[Path] = None,
+    python: str = sys.executable,
+    jobs: Optional[int] = None,
+    ignore_files: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> Dict:
+    """Memory taken by importing ``entry`` before and after rewriting a scratch copy of ``source_dir``.
+
+    Each side is measured in fresh interpreters (see ``measure_memory``): the modules loaded,
+    median RSS, and tracemalloc totals. The modules no longer loaded are attributed to the
+    deferred import statements of the rewrite, with the bytes their execution left allocated.
+    Returns a JSON-serialisable report.
+    """
+    source_dir = source_dir.resolve()
+    with tempfile.TemporaryDirectory(prefix="import_mover_memory_") as scratch:
+        tree = Path(scratch) / source_dir.name
+        shutil.copytree(source_dir, tree, ignore=shutil.ignore_patterns('__pycache__', '.git', DEFAULT_CACHE_DIR))
+        entry_copy = tree / entry.resolve().relative_to(source_dir)
+        root = tree / package_root.resolve().relative_to(source_dir) if package_root else find_package_root(entry_copy)
+        module = module_name_for_path(entry_copy, root)
+
+        logging.info("Measuring the import of %s before the rewrite...", module)
+        before = measure_memory(module, root, runs, python, timeout)
+
+        files = collect_python_files([str(tree)], ignore_files)
+        rewrite = list(process_paths({path: path for path in files}, options, jobs=jobs))
+        graph = build_import_graph(files, root)
+        statements: Dict[Tuple[str, str], Set[str]] = {}
+        lines: Dict[Tuple[str, str], Optional[int]] = {}
+        for result in rewrite:
+            if result.error is not None:
+                logging.warning("Error processing file %s: %s", result.source_path, result.error)
+                continue
+            path = Path(result.source_path)
+            try:
+                importer = module_name_for_path(path, root)
+            except ValueError:
+                continue  # outside the package root, not importable by the entry point
+            for code in result.deferred_imports:
+                statements[(importer, code)] = graph.imported_modules(code.strip(), importer)
+                lines[(importer, code)] = result.import_lines.get(code)
+
+        logging.info("Measuring the import of %s after the rewrite...", module)
+        after = measure_memory(module, root, runs, python, timeout)
+
+    avoided = set(before['modules']) - set(after['modules'])
+    own = _self_allocated(before['parents'], before['allocated'])
+    attributed = attribute_avoided_modules(avoided, before['parents'], statements)
+    module_files = {name: str(path.relative_to(tree)) for name, path in graph.files.items()}
+    report = {
+        'entry': module,
+        'runs': runs,
+        'rewrite': {
+            'files': len(rewrite),
+            'changed': sum(1 for r in rewrite if r.error is None and r.changed),
+            'failed': sum(1 for r in rewrite if r.error is not None),
+        },
+        'before': {key: value for key, value in before.items() if key not in ('parents', 'allocated', 'modules')},
+        'after': {key: value for key, value in after.items() if key not in ('parents', 'allocated', 'modules')},
+        'avoided_modules': sorted(avoided),
+        'added_modules': sorted(set(after['modules']) - set(before['modules'])),
+        'statements': [],
+    }
+    report['before']['modules'] = len(before['modules'])
+    report['after']['modules'] = len(after['modules'])
+    for key, modules in attributed.items():
+        entry_record = {
+            'modules': modules,
+            'allocated_bytes': sum(max(own.get(name, 0), 0) for name in modules),
+        }
+        if key is None:
+            report['unattributed'] = entry_record
+        else:
+            importer, code = key
+            report['statements'].append({
+                'file': module_files.get(importer, importer), 'line': lines[key], 'import': code.strip(), **entry_record,
+            })
+    report['statements'].sort(key=lambda record: (-record['allocated_bytes'], record['file'], record['line'] or 0))
+    return report
+
+def format_memory_markdown(report: Dict) -> str:
+    """Render a ``run_memory_report`` report as Markdown tables."""
+    def from_kb(value: Optional[float]) -> str:
+        return "n/a" if value is None else f"{value / 1024:.1f} MB"
+
+    def from_bytes(value: Optional[int]) -> str:
+        return "n/a" if value is None else f"{value / 2**20:.2f} MB"
+
+    before, after = report['before'], report['after']
+    lines = [
+        f"## Memory footprint of importing `{report['entry']}`",
+        "",
+        f"Median of {report['runs']} imports in fresh interpreters; tracemalloc figures from one traced import. "
+        f"Rewrite: {report['rewrite']['changed']} of {report['rewrite']['files']} files changed, "
+        f"{report['rewrite']['failed']} failed.",
+        "",
+        "| metric | before | after |",
+        "|---|---|---|",
+        f"| modules loaded | {before['modules']} | {after['modules']} |",
+        f"| RSS after import | {from_kb(before['rss_kb'])} | {from_kb(after['rss_kb'])} |",
+        f"| RSS added by the import | {from_kb(before['import_rss_kb'])} | {from_kb(after['import_rss_kb'])} |",
+        f"| peak RSS | {from_kb(before['peak_rss_kb'])} | {from_kb(after['peak_rss_kb'])} |",
+        f"| tracemalloc allocated | {from_bytes(before['traced_bytes'])} | {from_bytes(after['traced_bytes'])} |",
+        f"| tracemalloc peak | {from_bytes(before['traced_peak_bytes'])} | {from_bytes(after['traced_peak_bytes'])} |",
+        "",
+        f"{len(report['avoided_modules'])} modules no longer loaded, {len(report['added_modules'])} newly loaded"
+        + (f" ({', '.join(report['added_modules'])})." if report['added_modules'] else "."),
+    ]
+    if report['statements']:
+        lines += ["", "### Savings by deferred import", "",
+                  "| file | line | import | modules avoided | allocated |", "|---|---|---|---|---|"]
+        for record in report['statements']:
+            lines.append(
+                f"| {record['file']} | {record['line'] or ''} | `{record['import']}` | "
+                f"{len(record['modules'])} | {from_bytes(record['allocated_bytes'])} |"
+            )
+    if report.get('unattributed'):
+        unattributed = report['unattributed']
+        lines += ["", f"Not attributed to a single import: {len(unattributed['modules'])} modules, "
+                      f"{from_bytes(unattributed['allocated_bytes'])}."]
+    return "\n".join(lines) + "\n"
+
+def memory_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog='import_mover.py memory',
+        description='Report the memory an entry point saves at import when a scratch copy of its source tree '
+                    'is rewritten, by deferred import.',
+    )
+    parser.add_argument('source', type=str, help='Source tree to copy and rewrite')
+    parser.add_argument('--entry', type=str, required=True,
+                      help='Entry point module file inside the source tree (e.g. src/app/cli.py)')
+    _add_entry_arguments(parser)
+    parser.add_argument('--runs', type=int, default=5, help='Imports per side; RSS is their median (default: 5)')
+    parser.add_argument('--python', type=str, default=sys.executable,
+                      help='Interpreter to import the entry point with (default: this one)')
+    parser.add_argument('--timeout', type=float, default=None, help='Timeout of a single import in seconds')
+    parser.add_argument('--format', type=str, default='markdown', choices=['markdown', 'json'],
+                      help='Report format (default: markdown)')
+    parser.add_argument('--report', type=str, default=None, help='Write the report to this file instead of stdout')
+    _add_rewrite_arguments(parser)
+    args = parser.parse_args(argv)
+
+    _configure_logging(args.log_level)
+    source_dir = Path(args.source)
+    if not source_dir.is_dir():
+        logging.error("Not a directory: %s", args.source)
+        sys.exit(1)
+
+    files = collect_python_files([args.source], args.ignore_files)
+    options = _rewrite_options(args, files, _project_config(args, files))
+    try:
+        report = run_memory_report(
+            source_dir,
+            Path(args.entry),
+            options,
+            runs=args.runs,
+            package_root=Path(args.package_root) if args.package_root else None,
+            python=args.python,
+            jobs=args.jobs,
+            ignore_files=args.ignore_files,
+            timeout=args.timeout,
+        )
+    except (RuntimeError, ValueError, subprocess.TimeoutExpired) as e:
+        logging.error("%s", e)
+        sys.exit(1)
+
+    text = json.dumps(report, indent=2) if args.format == 'json' else format_memory_markdown(report)
+    if args.report:
+        Path(args.report).write_text(text)
+    else:
+        sys.stdout.write(text)
+
+def format_startup_plan(plan: StartupPlan, fmt: str = 'markdown') -> str:
+    """Report of a startup plan: the closure before/after and the statements to defer per file."""
+    removed = sorted(plan.removed_modules)
+    if fmt == 'json':
+        return json.dumps({
+            "entry": plan.entry,
+            "closure_before": sorted(plan.closure_before),
+            "closure_after": sorted(plan.closure_after),
+            "removed_modules": removed,
+            "moves": {str(path): sorted(codes) for path, codes in sorted(plan.movable_imports.items())},
+        }, indent=2) + "\n"
+
+    lines = [
+        f"# Startup import plan for `{plan.entry}`",
+        "",
+        f"Modules loaded at startup: {len(plan.closure_before)} before, {len(plan.closure_after)} after",
+        "",
+        "## Modules removed from the startup closure",
+        "",
+    ]
+    lines.extend(f"- `{module}`" for module in removed)
+    if not removed:
+        lines.append("None: every deferrable import is still loaded eagerly elsewhere.")
+    lines.extend(["", "## Imports to defer", ""])
+    for path, codes in sorted(plan.movable_imports.items()):
+        lines.append(f"### {path}")
+        lines.append("")
+        lines.extend(f"- `{code}`" for code in sorted(codes))
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+def _add_entry_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--package-root', type=str, default=None,
+                      help='Directory module names are resolved from (default: the first parent of the '
+                           'entry point that is not a package)')
+
+def _add_hot_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--hot-profile', type=str, default=None, metavar='PROFILE',
+                      help='cProfile/pstats dump or collapsed stack samples of a representative workload; '
+                           'imports used in functions called at least --hot-threshold times are not moved into them')
+    parser.add_argument('--hot-threshold', type=int, default=1000, metavar='N',
+                      help='Call count (samples for collapsed stacks) from which a function is hot (default: 1000)')
+    parser.add_argument('--hot-action', type=str, default='keep', choices=['keep', 'lazy'],
+                      help='What to do with the imports of hot functions: keep them global, or make them '
+                           'lazily loaded global bindings (default: keep)')
+
+def _add_verify_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--verify', action='store_true',
+                      help='After rewriting, import every changed module in fresh interpreters before and '
+                           'after the rewrite, and revert the files whose module fails to import or imports slower')
+    parser.add_argument('--verify-command', type=str, default=None, metavar='COMMAND',
+                      help='With --verify, also run this command (e.g. "pytest -x -q") on the rewritten files '
+                           'and revert the files that make it fail')
+    parser.add_argument('--verify-runs', type=int, default=3, metavar='N',
+                      help='Imports per module and version; the fastest counts (default: 3)')
+    parser.add_argument('--verify-slowdown', type=float, default=10.0, metavar='PCT',
+                      help=f'Revert a file if its import gets more than PCT percent (and {VERIFY_MIN_SLOWDOWN_MS:g} ms) '
+                           'slower (default: 10)')
+    parser.add_argument('--verify-timeout', type=float, default=300.0, metavar='SECONDS',
+                      help='Time limit of each import and command run, counted as a failure (default: 300)')
+
+def _hot_file_options(args: argparse.Namespace, files: Iterable[Path]) -> Dict[Path, Dict]:
+    """Per-file ``process_file`` options telling the hot functions of each file."""
+    if not args.hot_profile:
+        return {}
+    hot = hot_functions_by_file(load_call_profile(args.hot_profile), files, args.hot_threshold)
+    logging.info("Found %s hot functions in %s files", sum(len(functions) for functions in hot.values()), len(hot))
+    return {path: {'hot_functions': functions, 'hot_action': args.hot_action} for path, functions in hot.items()}
+
+def graph_main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog='import_mover.py graph',
+        description='Report which deferred imports remove modules from the startup closure of an entry point.',
+    )
+    parser.add_argument('paths', type=str, nargs='+', metavar='path',
+                      help='Python files, directories or glob patterns forming the package')
+    parser.add_argument('--entry', type=str, required=True, help='Entry point script or module file (e.g. cli.py)')
+    _add_entry_arguments(parser)
+    parser.add_argument('--format', type=str, default='markdown', choices=['markdown', 'json'],
+                      help='Report format (default: markdown)')
+    parser.add_argument('--report', type=str, default=None, help='Write the report to this file instead of stdout')
+    _add_hot_arguments(parser)
+    _add_rewrite_arguments(parser)
+    args = parser.parse_args(argv)
+
+    _configure_logging(args.log_level)
+    files = collect_python_files(args.paths, args.ignore_files)
+    config = _project_config(args, files)
+    if config is not None:
+        files = [path for path in files if not config.is_excluded(path)]
+    options = _rewrite_options(args, files, config)
+    plan = plan_startup_moves(
+        files,
+        Path(args.entry),
+        options,
+        root=Path(args.package_root) if args.package_root else None,
+        jobs=args.jobs,
+        file_options=_config_file_options(config, files, _hot_file_options(args, files)),
+    )
+    text = format_startup_plan(plan, args.format)
+    if args.report:
+        Path(args.report).write_text(text)
+    else:
+        sys.stdout.write(text)
+
+DEFAULT_SOCKET = os.path.join(DEFAULT_CACHE_DIR, "server.sock")
+
+class JsonRpcError(Exception):
+    """A JSON-RPC error response: ``code`` is one of the JSON-RPC 2.0 error codes."""
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+class ImportMoverServer:
+    """Answers JSON-RPC 2.0 requests to process files, with libcst and recently parsed modules loaded.
+
+    Messages are single lines of JSON, over stdin/stdout (``serve_stdio``) or a Unix socket
+    (``serve_socket``); requests are handled one at a time. Methods:
+
+    - ``process``: ``{"path", "source"?, "write"?, "diff"?, "code"?}`` -> the ``result_record``
+      of the file, with ``"diff"`` and ``"code"`` (the rewritten code) if asked for. Nothing is
+      written unless ``write``; ``source`` (an unsaved buffer) is processed instead of the file.
+    - ``ping`` -> version and process id, ``stats`` -> requests and parsed module LRU usage.
+    - ``shutdown`` -> stops the server once answered.
+    """
+    def __init__(self, options: Dict, config: Optional[ProjectConfig] = None, max_modules: int = 256):
+        self.options = options
+        self.config = config
+        import threading
+        self.parsed_modules = ParsedModuleCache(max_modules)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "ImportMoverServer":
+        """A server with the options of ``import_mover.py serve`` (see ``serve_parser``)."""
+        config = _project_config(args, [Path.cwd()])
+        options = _rewrite_options(args, [], config)
+        if not args.no_cache:
+            options['cache'] = ResultCache(args.cache_dir, max_size=args.cache_size * 2**20)
+        return cls(options, config, max_modules=args.max_modules)
+
+    def rpc_process(self, params: Dict) -> Dict:
+        if not isinstance(params.get("path"), str):
+            raise JsonRpcError(-32602, "path is required")
+        path = Path(params["path"])
+        source = params.get("source")
+        if source is not None and params.get("write"):
+            raise JsonRpcError(-32602, "source can't be written; save it and send the path")
+        if self.config is not None and self.config.is_excluded(path):
+            result = FileResult(source_path=str(path), skipped=f"excluded in {self.config.path}")
+        else:
+            options = dict(
+                self.options,
+                dry_run=not params.get("write"),
+                diff=bool(params.get("diff")),
+                return_output=bool(params.get("code")),
+                source_code=source,
+                parsed_modules=self.parsed_modules,
+            )
+            if self.config is not None:
+                options["import_rules"] = self.config.rules_for(path)
+            result = _process_file_job(path, path, options)
+        record = result_record(result)
+        if params.get("diff"):
+            record["diff"] = result.diff or ""
+        if params.get("code"):
+            record["code"] = result.output_code
+        return record
+
+    def rpc_ping(self, params: Dict) -> Dict:
+        return {"version": __version__, "pid": os.getpid()}
+
+    def rpc_stats(self, params: Dict) -> Dict:
+        return {
+            "requests": self.requests,
+            "parsed_modules": len(self.parsed_modules.entries),
+            "parsed_module_hits": self.parsed_modules.hits,
+            "parsed_module_misses": self.parsed_modules.misses,
+        }
+
+    def rpc_shutdown(self, params: Dict) -> None:
+        self.stopped.set()
+
+    def handle(self, message) -> Optional[Dict]:
+        """The response to one JSON-RPC message; None for notifications."""
+        request_id = message.get("id") if isinstance(message, dict) else None
+        try:
+            if not isinstance(message, dict) or not isinstance(message.get("method"), str):
+                raise JsonRpcError(-32600, "Invalid request")
+            method = getattr(self, f"rpc_{message['method']}", None)
+            if method is None:
+                raise JsonRpcError(-32601, f"Method not found: {message['method']}")
+            params = message.get("params", {})
+            if not isinstance(params, dict):
+                raise JsonRpcError(-32602, "params must be an object")
+            with self.lock:
+                self.requests += 1
+                response = {"jsonrpc": "2.0", "id": request_id, "result": method(params)}
+        except JsonRpcError as e:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": e.code, "message": e.message}}
+        except Exception as e:
+            logging.exception("Error handling %s", message.get("method"))
+            response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": -32603, "message": f"{type(e).__name__}: {e}"}}
+        if isinstance(message, dict) and "id" not in message:
+            return None
+        return response
+
+    def handle_line(self, line: str) -> Optional[str]:
+        try:
+            message = json.loads(line)
+        except ValueError as e:
+            return json.dumps({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": f"Parse error: {e}"}})
+        response = self.handle(message)
+        return json.dumps(response) if response is not None else None
+
+def serve_stdio(server: ImportMoverServer, stdin=None, stdout=None) -> None:
+    """Answer one request per line of ``stdin`` (default: sys.stdin) on ``stdout`` until shut down or EOF."""
+    stdin, stdout = stdin or sys.stdin, stdout or sys.stdout
+    for line in stdin:
+        if not line.strip():
+            continue
+        response = server.handle_line(line)
+        if response is not None:
+            stdout.write(response + "\n")
+            stdout.flush()
+        if server.stopped.is_set():
+            break
+
+def serve_socket(server: ImportMoverServer, path: Union[str, Path] = DEFAULT_SOCKET) -> None:
+    """Answer requests from any number of connections to the Unix socket ``path`` until shut down."""
+    import socket
+    import socketserver
+    import threading
+
+    class UnixSocketServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True  # idle client connections don't keep the server from stopping
+
+    class SocketRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                response = server.handle_line(line.decode())
+                if response is not None:
+                    self.wfile.write(response.encode() + b"\n")
+                    self.wfile.flush()
+                if server.stopped.is_set():
+                    threading.Thread(target=self.server.shutdown).start()
+                    return
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        # Left over from a server that is gone, unless one still answers
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(str(path))
+            raise RuntimeError(f"A server is already listening on {path}")
+        except ConnectionRefusedError:
+            path.unlink()
+        finally:
+            probe.close()
+    with UnixSocketServer(str(path), SocketRequestHandler) as unix_server:
+        logging.info("Listening on %s", path)
+        try:
+            unix_server.serve_forever()
+        finally:
+            path.unlink(missing_ok=True)
+
+def serve_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='import_mover.py serve',
+        description='Keep libcst and parsed modules loaded and process files on request (JSON-RPC 2.0, one '
+                    'message per line), for editors and pre-commit; see import_mover_client.py.',
+    )
+    transport = parser.add_mutually_exclusive_group()
+    transport.add_argument('--socket', type=str, default=DEFAULT_SOCKET,
+                           help=f'Unix socket to listen on (default: {DEFAULT_SOCKET})')
+    transport.add_argument('--stdio', action='store_true',
+                           help='Answer requests from stdin on stdout instead')
+    parser.add_argument('--max-modules', type=int, default=256, metavar='N',
+                        help='Parsed modules to keep in memory, least recently used evicted first (default: 256)')
+    _add_cache_arguments(parser)
+    _add_rewrite_arguments(parser)
+    return parser
+
+def serve_main(argv: List[str]) -> None:
+    args = serve_parser().parse_args(argv)
+    _configure_logging(args.log_level)
+    server = ImportMoverServer.from_args(args)
+    try:
+        if args.stdio:
+            serve_stdio(server)
+        else:
+            serve_socket(server, args.socket)
+    except KeyboardInterrupt:
+        pass
+
+def _add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--no-cache', action='store_true',
+                      help='Do not read or write the result cache')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                      help=f'Directory of the result cache (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                      help=f'Maximum size of the result cache in MB (default: {DEFAULT_CACHE_SIZE_MB})')
+
+def _add_rewrite_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options controlling how files are rewritten, shared by the main command and ``bench``."""
+    parser.add_argument('--log-level', type=str, default='INFO',
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                      help='Set the logging level (default: INFO)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                      help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--strategy', type=str, default='move', choices=['move', 'lazy'],
+                      help='How to defer imports: move them into the functions using them, or keep them '
+                           'global as bindings that import on first attribute access (default: move)')
+    parser.add_argument('--lazy-init', action='store_true',
+                      help='Rewrite relative re-exports in __init__.py files to load on first access '
+                           '(default: __init__.py files are skipped)')
+    parser.add_argument('--hoist', action='store_true',
+                      help='Put an import used by several nested functions once into their lowest common '
+                           'enclosing function instead of into each of them')
+    parser.add_argument('--type-checking', type=str, default=None, choices=['quote', 'future'],
+                      help='Move imports only used in type annotations into an "if TYPE_CHECKING:" block, '
+                           'quoting the annotations evaluated at runtime or adding '
+                           '"from __future__ import annotations" (default: leave them alone)')
+    parser.add_argument('--defer-constants', action='store_true',
+                      help='Turn module level constants that keep an import at module level (e.g. '
+                           '"DEFAULT = np.zeros(3)") into accessors computed on first use')
+    parser.add_argument('--lazy-subcommands', action='store_true',
+                      help='Make the subcommands registered on click groups with add_command() import their '
+                           'module only when they are run or their help is shown')
+    parser.add_argument('--backend', type=str, default='auto', choices=['auto', 'libcst'],
+                      help='auto: analyse with the stdlib ast first and only parse the files with changes to '
+                           'make (and those it can\'t tell for sure) with libcst; libcst: always use libcst '
+                           '(default: auto)')
+    parser.add_argument('--keep-old-imports', action='store_true', default=True,
+                      help='Keep old imports as comments (default: True)')
+    parser.add_argument('--remove-unused-imports', action='store_true', default=True,
+                      help='Remove unused imports instead of commenting them (default: True)')
+    parser.add_argument('--whitelist', type=str,
+                      help='Comma-separated list of modules to keep at global scope, with their submodules')
+    parser.add_argument('--ignore-files', type=str,
+                      help='Regular expression pattern for files to ignore')
+    parser.add_argument('--cost-threshold', type=float, default=None, metavar='MS',
+                      help='Profile import costs and keep imports cheaper than MS milliseconds at global scope')
+    parser.add_argument('--cost-entry', type=str, default=None, metavar='COMMAND',
+                      help='Profile import costs by running this command once (e.g. "python cli.py --help") '
+                           'instead of importing each module separately')
+    parser.add_argument('--import-costs', type=str, default=None, metavar='JSON',
+                      help='Import cost table to reuse; written after profiling if it does not exist yet')
+    parser.add_argument('--config', type=str, default=None, metavar='PYPROJECT',
+                      help='pyproject.toml with a [tool.import_mover] table of import rules (default: the '
+                           'nearest pyproject.toml above the processed files)')
+
+def _configure_logging(log_level: str) -> None:
+    logging.basicConfig(
+        level=getattr(logging, log_level),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+def _project_config(args: argparse.Namespace, files: Iterable[Path]) -> Optional[ProjectConfig]:
+    path = Path(args.config) if args.config else find_config(files)
+    if path is None:
+        return None
+    config = load_config(path)
+    if config is not None:
+        logging.info("Using import rules from %s", path)
+    elif args.config:
+        logging.warning("No [tool.import_mover] table in %s", path)
+    return config
+
+def _config_file_options(config: Optional[ProjectConfig], files: Iterable[Path], file_options: Dict[Path, Dict]) -> Dict[Path, Dict]:
+    """Add the import rules of the files matched by overrides to ``file_options``."""
+    if config is not None and config.overrides:
+        for path in files:
+            rules = config.rules_for(path)
+            if rules is not config.import_rules:
+                file_options.setdefault(path, {})['import_rules'] = rules
+    return file_options
+
+def _rewrite_options(args: argparse.Namespace, files: Iterable[Path], config: Optional[ProjectConfig] = None) -> Dict:
+    """Keyword arguments for ``process_file`` from the parsed rewrite options and project configuration."""
+    # Process whitelist
+    whitelist_libs = {lib.strip() for lib in args.whitelist.split(',') if lib.strip()} if args.whitelist else None
+
+    import_costs = None
+    if args.cost_threshold is not None:
+        if args.import_costs and Path(args.import_costs).exists():
+            import_costs = json.loads(Path(args.import_costs).read_text())
+        else:
+            logging.info("Profiling import costs...")
+            import_costs = profile_import_costs(
+                modules=None if args.cost_entry else scan_imported_modules(files),
+                entry_command=args.cost_entry,
+                jobs=args.jobs,
+            )
+            if args.import_costs:
+                Path(args.import_costs).write_text(json.dumps(import_costs, indent=2, sort_keys=True))
+
+    return dict(
+        keep_old_imports=args.keep_old_imports,
+        remove_unused_imports=args.remove_unused_imports,
+        whitelist_libs=whitelist_libs,
+        import_costs=import_costs,
+        cost_threshold_ms=args.cost_threshold or 0.0,
+        strategy=args.strategy,
+        lazy_init=args.lazy_init,
+        hoist=args.hoist,
+        type_checking=args.type_checking,
+        defer_constants=args.defer_constants,
+        lazy_subcommands=args.lazy_subcommands,
+        backend=args.backend,
+        import_rules=config.import_rules if config is not None else None,
+        preloaded_modules=config.preloaded_modules if config is not None else None,
+    )
+
+def main(argv: Optional[List[str]] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'bench':
+        return bench_main(argv[1:])
+    if argv and argv[0] == 'graph':
+        return graph_main(argv[1:])
+    if argv and argv[0] == 'serve':
+        return serve_main(argv[1:])
+    if argv and argv[0] == 'memory':
+        return memory_main(argv[1:])
+
+    parser = argparse.ArgumentParser(
+        description='Move global imports into functions where they are used.',
+        epilog='Run "%(prog)s bench -h" for the startup benchmark, "%(prog)s graph -h" for the '
+               'startup import plan of an entry point, "%(prog)s memory -h" for the memory saved at '
+               'import and "%(prog)s serve -h" for the server mode.',
+    )
+    parser.add_argument('paths', type=str, nargs='+', metavar='path',
+                      help='Python files, directories (walked recursively) or glob patterns to process')
+    parser.add_argument('--log', type=str, help='Log file to write changes to')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                      help='Modified file path (default is with a suffix "_im"); '
+                           'a directory to mirror the input tree into when processing several files')
+    parser.add_argument('--in-place', action='store_true',
+                      help='Overwrite the processed files')
+    parser.add_argument('--check', nargs='?', const='-', default=None, metavar='NDJSON',
+                      help='Write nothing; report each file as one JSON line (moved, unused and kept imports '
+                           'with line numbers, elapsed time) as soon as it is done, on stdout or to NDJSON, '
+                           'and exit with status 1 if any file would change')
+    parser.add_argument('--diff', action='store_true',
+                      help='Write nothing; print a unified diff of each file that would change on stdout, '
+                           'and exit with status 1 if any file would change')
+    changes = parser.add_mutually_exclusive_group()
+    changes.add_argument('--since', type=str, default=None, metavar='REF',
+                       help='Only process the files changed since the current branch forked from git revision REF '
+                            '(committed, staged, unstaged and untracked), and the files importing them')
+    changes.add_argument('--staged', action='store_true',
+                       help='Only process the files staged for commit, and the files importing them')
+    parser.add_argument('--entry', type=str, default=None,
+                      help='Entry point (e.g. cli.py): only defer imports that remove modules from its '
+                           'startup import closure, and leave files outside the closure alone')
+    _add_entry_arguments(parser)
+    _add_hot_arguments(parser)
+    _add_verify_arguments(parser)
+    _add_rewrite_arguments(parser)
+    parser.add_argument('--profile', type=str, default=None, metavar='JSON',
+                      help='Write the time spent in each phase (per file and in total) to this JSON file')
+    _add_cache_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.check == '-' and args.diff:
+        parser.error("--check and --diff can't both write to stdout; give --check a file")
+    if args.verify and (args.check is not None or args.diff):
+        parser.error("--verify needs the rewritten files; it can't be combined with --check or --diff")
+    check = args.check is not None or args.diff
+
+    # Configure logging
+    _configure_logging(args.log_level)
+    timer = PhaseTimer()
+    start = time.perf_counter()
+
+    try:
+        with timer.phase("collect"):
+            files = collect_python_files(args.paths, args.ignore_files)
+            config = _project_config(args, files)
+            if config is not None:
+                excluded = {path for path in files if config.is_excluded(path)}
+                for path in sorted(excluded):
+                    logging.info("Skipping file excluded in %s: %s", config.path, path)
+                files = [path for path in files if path not in excluded]
+            outputs = _resolve_output_paths(files, args.output, in_place=args.in_place)
+            # The entry point plan needs the whole tree; the selection applies once it is made
+            incremental = None
+            if files and (args.since or args.staged):
+                changed_files = changed_python_files(args.since, args.staged, cwd=files[0].resolve().parent)
+                selected = {path for path in files if path.resolve() in changed_files}
+                importers = direct_importers(selected, files, Path(args.package_root) if args.package_root else None)
+                incremental = selected | importers
+                logging.info("%s changed files %s, %s files importing them",
+                             len(selected), "staged" if args.staged else f"since {args.since}", len(importers))
+                if not args.entry:
+                    outputs = {source: output for source, output in outputs.items() if source in incremental}
+    except Exception as e:
+        logging.error("Error collecting files: %s", e)
+        sys.exit(1)
+
+    with timer.phase("options"):
+        options = _rewrite_options(args, outputs, config)
+    if check:
+        options.update(dry_run=True, diff=args.diff)
+    if args.verify:
+        options['keep_source'] = True
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_dir, max_size=args.cache_size * 2**20)
+        options['cache'] = cache
+
+    file_options = _config_file_options(config, outputs, _hot_file_options(args, outputs))
+    if args.entry:
+        with timer.phase("entry_plan"):
+            plan = plan_startup_moves(
+                list(outputs),
+                Path(args.entry),
+                options,
+                root=Path(args.package_root) if args.package_root else None,
+                jobs=args.jobs,
+                file_options=file_options,
+            )
+        logging.info(
+            "Deferring imports in %s files removes %s modules from the startup of %s",
+            len(plan.movable_imports), len(plan.removed_modules), args.entry,
+        )
+        outputs = {
+            source: output for source, output in outputs.items()
+            if source in plan.movable_imports and (incremental is None or source in incremental)
+        }
+        for path, codes in plan.movable_imports.items():
+            file_options.setdefault(path, {})['movable_imports'] = codes
+
+    # Results are reported as files finish; only what the summary needs is kept
+    log = open(args.log, 'w') if args.log else None
+    records = None
+    if args.check is not None:
+        records = sys.stdout if args.check == '-' else open(args.check, 'w')
+    results = []
+    to_verify = []
+    failed = []
+    changed = skipped = cached = processed = 0
+    with timer.phase("process"):
+        for result in process_paths(outputs, options, jobs=args.jobs, file_options=file_options):
+            processed += 1
+            if result.error is not None:
+                failed.append(result)
+            elif result.skipped is not None:
+                skipped += 1
+            else:
+                changed += result.changed
+                if not check:
+                    logging.info("Successfully processed %s --> output file: %s", result.source_path, result.output_path)
+            cached += result.cached
+            if log is not None:
+                if len(outputs) > 1:
+                    log.write(f"\n=== {result.source_path} ===\n")
+                write_change_log(log, result)
+                log.flush()
+            if result.diff:
+                sys.stdout.write(result.diff)
+                sys.stdout.flush()
+                result.diff = None
+            if records is not None:
+                records.write(json.dumps(result_record(result)) + "\n")
+                records.flush()
+            if result.original_code is not None:
+                to_verify.append(result)
+            if args.profile:
+                results.append(result)
+    reverted = []
+    if to_verify:
+        with timer.phase("verify"):
+            outcomes = verify_rewrites(
+                to_verify,
+                command=args.verify_command,
+                runs=args.verify_runs,
+                slowdown_pct=args.verify_slowdown,
+                jobs=args.jobs,
+                timeout=args.verify_timeout,
+            )
+        reverted = [outcome for outcome in outcomes if outcome.reverted is not None]
+        for outcome in reverted:
+            logging.warning("Reverted %s: %s", outcome.path, outcome.reverted)
+        if log is not None:
+            log.write("\n=== Verification ===\n")
+            for outcome in outcomes:
+                times = " -> ".join("failed" if ms is None else f"{ms:.2f} ms" for ms in (outcome.before_ms, outcome.after_ms))
+                log.write(f"{outcome.path} ({outcome.module}): import {times}"
+                          f"{', reverted: ' + outcome.reverted if outcome.reverted else ''}\n")
+        logging.info("Verified %s changed files: %s kept, %s reverted", len(outcomes), len(outcomes) - len(reverted), len(reverted))
+    for stream in (log, records):
+        if stream is not None and stream is not sys.stdout:
+            stream.close()
+    if cache is not None:
+        with timer.phase("cache_prune"):
+            cache.prune()
+
+    # Summary
+    logging.info(
+        "Processed %s files: %s %s, %s skipped, %s failed, %s from cache",
+        processed, changed - len(reverted), "would change" if check else "changed", skipped, len(failed), cached,
+    )
+    if args.profile:
+        report = profile_report(results, timer.timings, time.perf_counter() - start)
+        Path(args.profile).write_text(json.dumps(report, indent=2) + "\n")
+        for name, phase in sorted(report["file_phases"].items(), key=lambda item: -item[1]["total_s"]):
+            logging.info("Phase %-16s %8.3f s in total, %7.2f ms per file at most (%s)",
+                         name, phase["total_s"], phase["max_ms"], phase["max_file"])
+    for result in sorted(failed, key=lambda r: r.source_path):
+        logging.error("Error processing file %s: %s", result.source_path, result.error)
+    if failed or (check and changed):
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+"""Thin client of ``import_mover.py serve``, for editors and pre-commit.
+
+    python import_mover.py serve &                       # once, in the project directory
+    python import_mover_client.py src/app.py src/cli.py  # one JSON record per file, status 1 if any would change
+    python import_mover_client.py --write src/app.py     # rewrite in place
+    python import_mover_client.py --stdin-filename src/app.py < buffer.py  # rewritten buffer on stdout
+
+Only the standard library is loaded. If no server is listening, import_mover (and libcst) are
+imported and the files are processed in this process, with the default options and the
+project's pyproject.toml.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+# import_mover.DEFAULT_SOCKET, repeated so that the client doesn't import import_mover
+DEFAULT_SOCKET = os.path.join(".import_mover_cache", "server.sock")
+
+
+class SocketTransport:
+    """A connection to a running server."""
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile("rwb")
+
+    def request(self, line):
+        self.file.write(line.encode() + b"\n")
+        self.file.flush()
+        return self.file.readline().decode()
+
+
+class LocalTransport:
+    """The server's request handling, in this process."""
+    def __init__(self):
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import import_mover
+        self.server = import_mover.ImportMoverServer.from_args(import_mover.serve_parser().parse_args(["--log-level", "WARNING"]))
+
+    def request(self, line):
+        return self.server.handle_line(line)
+
+
+def connect(path, fallback=True):
+    try:
+        return SocketTransport(path)
+    except (OSError, AttributeError):  # no server listening, or no Unix sockets on this platform
+        if not fallback:
+            raise
+        return LocalTransport()
+
+
+class Client:
+    def __init__(self, transport):
+        self.transport = transport
+        self.next_id = 0
+
+    def call(self, method, **params):
+        self.next_id += 1
+        message = {"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params}
+        response = json.loads(self.transport.request(json.dumps(message)))
+        if "error" in response:
+            raise RuntimeError(response["error"]["message"])
+        return response["result"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", metavar="path", help="Python files to process")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"server socket (default: {DEFAULT_SOCKET})")
+    parser.add_argument("--no-fallback", action="store_true", help="fail instead of processing in-process without a server")
+    parser.add_argument("--write", action="store_true", help="rewrite the files in place")
+    parser.add_argument("--diff", action="store_true", help="print unified diffs instead of JSON records")
+    parser.add_argument("--stdin-filename", metavar="PATH",
+                        help="process the code on stdin as the file PATH and print the rewritten code")
+    parser.add_argument("--ping", action="store_true", help="print the server's version and process id")
+    parser.add_argument("--stats", action="store_true", help="print the server's request and parsed module counts")
+    parser.add_argument("--shutdown", action="store_true", help="stop the server")
+    args = parser.parse_args(argv)
+
+    try:
+        client = Client(connect(args.socket, fallback=not args.no_fallback))
+    except OSError as e:
+        print(f"No server on {args.socket}: {e}", file=sys.stderr)
+        return 2
+    for method in ("ping", "stats", "shutdown"):
+        if getattr(args, method):
+            print(json.dumps(client.call(method)))
+            return 0
+
+    if args.stdin_filename:
+        source = sys.stdin.read()
+        record = client.call("process", path=os.path.abspath(args.stdin_filename), source=source, code=True)
+        # Hand the buffer back unchanged if it couldn't be processed
+        sys.stdout.write(record.get("code") or source)
+        return 1 if record["status"] == "error" else 0
+
+    failed = changed = False
+    for path in args.paths:
+        try:
+            record = client.call("process", path=os.path.abspath(path), write=args.write, diff=args.diff)
+        except RuntimeError as e:
+            record = {"path": path, "status": "error", "error": str(e)}
+        failed |= record["status"] == "error"
+        changed |= record["status"] == "changed"
+        if args.diff:
+            sys.stdout.write(record.pop("diff", ""))
+            if record["status"] == "error":
+                print(f"{path}: {record['error']}", file=sys.stderr)
+        else:
+            print(json.dumps(record), flush=True)
+    return 1 if failed or (changed and not args.write) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
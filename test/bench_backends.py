@@ -0,0 +1,91 @@
+"""Compare the stdlib ast analysis backend with the libcst one on a corpus of Python files.
+
+Times both on every file (dry runs, nothing is written), checks that the ast backend finds the
+same unused/moved/deferred imports wherever it gives an answer, and lists the files where not.
+
+    python test/bench_backends.py /usr/lib/python3.11 --limit 500 --report backends.json
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import import_mover  # noqa: E402
+
+
+def normalized(result):
+    """The comparable part of a FileResult: order doesn't matter, surrounding whitespace neither."""
+    return {
+        "unused_imports": sorted(result.unused_imports),
+        "moved_imports": {name: sorted(code.strip() for code in codes)
+                          for name, codes in sorted(result.moved_imports.items())},
+        "deferred_imports": sorted(code.strip() for code in result.deferred_imports),
+    }
+
+
+def compare(files, hoist=False):
+    report = {"files": 0, "answered": 0, "changed": 0, "agree": 0, "mismatches": [],
+              "ast_s": 0.0, "libcst_s": 0.0, "auto_s": 0.0, "failed": 0}
+    for path in files:
+        try:
+            source = path.read_text()
+        except (OSError, UnicodeDecodeError):
+            continue
+        start = time.perf_counter()
+        try:
+            expected = import_mover.process_file(path, None, str(path), hoist=hoist, dry_run=True, backend="libcst")
+        except Exception:
+            report["failed"] += 1
+            continue
+        libcst_s = time.perf_counter() - start
+        start = time.perf_counter()
+        analysis = import_mover.analyze_imports_ast(source, path, hoist=hoist)
+        ast_s = time.perf_counter() - start
+
+        report["files"] += 1
+        report["libcst_s"] += libcst_s
+        report["ast_s"] += ast_s
+        # What a rewrite run pays: the ast pass everywhere, libcst where there are changes or no answer
+        report["auto_s"] += ast_s + (libcst_s if analysis is None or analysis.changed else 0.0)
+        report["changed"] += expected.changed
+        if analysis is None:
+            continue
+        report["answered"] += 1
+        if normalized(analysis) == normalized(expected):
+            report["agree"] += 1
+        else:
+            report["mismatches"].append({"file": str(path), "ast": normalized(analysis), "libcst": normalized(expected)})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="Python files, directories or glob patterns")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N files")
+    parser.add_argument("--hoist", action="store_true", help="compare with --hoist placement")
+    parser.add_argument("--report", type=str, default=None, help="write the full report to this JSON file")
+    args = parser.parse_args()
+
+    files = import_mover.collect_python_files(args.paths)
+    files = [path for path in files if path.name != "__init__.py"][:args.limit]
+    report = compare(files, hoist=args.hoist)
+    if args.report:
+        Path(args.report).write_text(json.dumps(report, indent=2) + "\n")
+
+    files = report["files"] or 1
+    print(f"files:            {report['files']} ({report['failed']} failed to parse with libcst)")
+    print(f"with changes:     {report['changed']}")
+    print(f"answered by ast:  {report['answered']} ({100 * report['answered'] / files:.1f}%)")
+    print(f"agreeing:         {report['agree']} of {report['answered']}")
+    print(f"libcst:           {report['libcst_s']:8.2f} s ({1000 * report['libcst_s'] / files:6.2f} ms per file)")
+    print(f"ast:              {report['ast_s']:8.2f} s ({1000 * report['ast_s'] / files:6.2f} ms per file)")
+    print(f"auto (rewrite):   {report['auto_s']:8.2f} s ({1000 * report['auto_s'] / files:6.2f} ms per file)")
+    for mismatch in report["mismatches"][:20]:
+        print(f"mismatch: {mismatch['file']}")
+    return 1 if report["mismatches"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""Measure how process_file scales with module size on generated modules.
+
+Generates modules with hundreds of imports, classes with decorated methods and deeply nested functions,
+measures wall time (fastest of --repeat runs) and the peak memory (RSS) processing each adds, and fits the
+exponent k of time ~ lines**k on a log-log scale. Exits with status 1 if k exceeds --max-exponent, so the
+quick default sizes work as a guardrail:
+
+    python test/bench_scaling.py
+
+Every run is appended to a results file (untracked, under .import_mover_cache/ unless --results is given)
+along with the tool version and git commit, and compared with the previous run stored there, so
+regressions show across versions on one machine. Each size runs in a fresh interpreter; the full libcst
+path takes a few minutes for 100k lines:
+
+    python test/bench_scaling.py --sizes 1000,3000,10000,30000,100000 --results scaling.json
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import import_mover  # noqa: E402
+
+DEFAULT_SIZES = [1000, 2000, 4000]
+DEFAULT_RESULTS = Path(__file__).resolve().parent.parent / import_mover.DEFAULT_CACHE_DIR / "bench_scaling_results.json"
+
+
+def _import_table(count, rng):
+    """``count`` import statements and, for each, an expression using what it binds."""
+    statements = []
+    for i in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            statements.append((f"import mod_{i}", f"mod_{i}.attr_{i}"))
+        elif kind == 1:
+            statements.append((f"import mod_{i} as m_{i}", f"m_{i}.attr_{i}"))
+        elif kind == 2:
+            statements.append((f"from lib_{i} import name_{i}, other_{i}", f"name_{i}"))
+        else:
+            statements.append((f"import pkg_{i}.sub_{i}", f"pkg_{i}.sub_{i}.attr"))
+    return statements
+
+
+def _use(uses, rng, count=2):
+    return " + ".join(rng.choice(uses) for _ in range(count))
+
+
+def _class_unit(n, uses, rng, methods=6):
+    lines = [f"@{rng.choice(uses)}", f"class Class_{n}(Base_{n % 7}):", f"    attr = {_use(uses, rng, 1)}"]
+    for m in range(methods):
+        lines += [
+            f"    @{rng.choice(uses)}" if m % 2 else "    @staticmethod",
+            f"    def method_{m}({'self, ' if m % 2 else ''}x):",
+            f"        def inner(y):",
+            f"            return y + {_use(uses, rng)}",
+            f"        return inner(x)",
+        ]
+    return lines
+
+
+def _nested_unit(n, uses, rng, depth=8):
+    lines = [f"def outer_{n}(a0):"]
+    for level in range(1, depth):
+        lines.append(f"{'    ' * level}def level_{level}(a{level}):")
+    lines.append(f"{'    ' * depth}return {_use(uses, rng)} + a0 + a{depth - 1}")
+    for level in range(depth - 1, 0, -1):
+        lines.append(f"{'    ' * level}return level_{level}(a{level - 1})")
+    return lines
+
+
+def _function_unit(n, uses, rng):
+    return [
+        f"def function_{n}(items, flag=False):",
+        f'    """Function {n}."""',
+        f"    total = [{_use(uses, rng, 1)}(item) for item in items if item]",
+        f"    key = lambda value: {_use(uses, rng, 1)}(value)",
+        "    if flag:",
+        f"        return sorted(total, key=key)",
+        f"    return {_use(uses, rng, 3)}",
+    ]
+
+
+def generate_module(lines, imports=None, seed=0):
+    """Source of a module of about ``lines`` lines, deterministic for a ``seed``."""
+    rng = random.Random(seed)
+    imports = imports if imports is not None else min(max(lines // 200, 50), 500)
+    table = _import_table(imports, rng)
+    # Some imports stay unused
+    uses = [use for _, use in table[: max(1, imports * 9 // 10)]]
+    source = [f'"""Generated module, {lines} lines."""'] + [statement for statement, _ in table] + [""]
+    units = (_class_unit, _nested_unit, _function_unit)
+    n = 0
+    while len(source) < lines:
+        source += units[n % len(units)](n, uses, rng) + [""]
+        if n % 10 == 0:
+            source += [f"CONSTANT_{n} = {_use(uses, rng, 1)}", ""]
+        n += 1
+    return "\n".join(source) + "\n"
+
+
+def _measure_in_child(source, directory, backend, repeat):
+    path = Path(directory) / "generated.py"
+    path.write_text(source)
+    output = Path(directory) / "generated_im.py"
+    # Peak RSS is only ever reported as a high-water mark: count what processing adds to it
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best, timings = math.inf, {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = import_mover.process_file(path, None, str(output), backend=backend, cache=None)
+        elapsed = time.perf_counter() - start
+        if result.error is not None:
+            raise RuntimeError(result.error)
+        if elapsed < best:
+            best, timings = elapsed, result.timings
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    # kB on Linux, bytes on macOS
+    return best, timings, peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def measure(source, directory, backend="libcst", repeat=1):
+    """Fastest wall time (s), per-phase timings and peak memory added (MB) of processing ``source``.
+
+    Runs in a fresh interpreter, so the memory peaks of earlier (larger) modules don't hide this one's.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_measure_in_child, source, directory, backend, repeat).result()
+
+
+def scaling_exponent(sizes, values):
+    """Slope of log(values) over log(sizes): 1 means linear, 2 quadratic."""
+    slope, _ = statistics.linear_regression([math.log(size) for size in sizes], [math.log(value) for value in values])
+    return slope
+
+
+def _git_commit():
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                          cwd=Path(__file__).resolve().parent)
+    return proc.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=str, default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated module sizes in lines (default: %(default)s)")
+    parser.add_argument("--imports", type=int, default=None,
+                        help="import statements per module (default: lines / 200, between 50 and 500)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per size; the fastest counts (default: 1)")
+    parser.add_argument("--backend", choices=["auto", "libcst"], default="libcst",
+                        help="analysis backend (default: libcst, the full rewrite path)")
+    parser.add_argument("--max-exponent", type=float, default=1.3,
+                        help="fail if time grows faster than lines**K (default: %(default)s)")
+    parser.add_argument("--results", type=str, default=str(DEFAULT_RESULTS),
+                        help="JSON file the runs are appended to (default: .import_mover_cache/bench_scaling_results.json)")
+    parser.add_argument("--no-save", action="store_true", help="don't append this run to the results file")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results_path = Path(args.results)
+    runs = json.loads(results_path.read_text()) if results_path.exists() else []
+    previous = {entry["lines"]: entry for entry in runs[-1]["sizes"]} if runs else {}
+
+    measurements = []
+    with tempfile.TemporaryDirectory(prefix="import_mover_scaling_") as directory:
+        for size in sizes:
+            source = generate_module(size, args.imports)
+            wall_s, timings, peak_mb = measure(source, directory, args.backend, args.repeat)
+            measurements.append({
+                "lines": source.count("\n"),
+                "wall_s": wall_s,
+                "peak_mb": peak_mb,
+                "phases_s": timings,
+            })
+            before = previous.get(measurements[-1]["lines"])
+            change = f" ({(wall_s / before['wall_s'] - 1) * 100:+.1f}% vs {runs[-1]['commit']})" if before else ""
+            print(f"{measurements[-1]['lines']:>7} lines: {wall_s:8.3f} s{change}, {peak_mb:8.1f} MB peak, "
+                  f"slowest phase {max(timings, key=timings.get)}", flush=True)
+
+    lines = [m["lines"] for m in measurements]
+    run = {
+        "version": import_mover.__version__,
+        "commit": _git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "sizes": measurements,
+    }
+    if len(sizes) > 1:
+        run["time_exponent"] = scaling_exponent(lines, [m["wall_s"] for m in measurements])
+        run["memory_exponent"] = scaling_exponent(lines, [m["peak_mb"] for m in measurements])
+        print(f"time ~ lines^{run['time_exponent']:.2f}, memory ~ lines^{run['memory_exponent']:.2f}")
+    if not args.no_save:
+        runs.append(run)
+        results_path.parent.mkdir(parents=True, exist_ok=True)
+        results_path.write_text(json.dumps(runs, indent=2) + "\n")
+    if run.get("time_exponent", 0.0) > args.max_exponent:
+        print(f"time grows faster than lines^{args.max_exponent}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -43,14 +43,13 @@ def function2():
     import random
     print(random.randint(1, 10))
 
-    def function3():
+    def some_nested_function3():
         """
         This function prints the current time.
         """
         import time
-        import time
         print(time.time())
-    function3()
+    some_nested_function3()
 
 def main():
     function1()
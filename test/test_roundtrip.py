@@ -0,0 +1,854 @@
+"""Rewrite small fixtures and import or run the result in a fresh interpreter.
+
+    python -m pytest test/
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import libcst as cst
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import import_mover  # noqa: E402
+
+
+def write(path, code):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(textwrap.dedent(code).lstrip())
+    return path
+
+
+def rewrite(path, **options):
+    """Rewrite ``path`` in place with the options of ``process_file``."""
+    result = import_mover.process_file(path, None, str(path), cache=None, **options)
+    assert result.error is None, result.error
+    return result
+
+
+def run(code, cwd):
+    """Run ``code`` in a fresh interpreter in ``cwd``; the value it prints is returned parsed from JSON."""
+    proc = subprocess.run([sys.executable, "-c", textwrap.dedent(code)], cwd=cwd, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def cli(*argv):
+    """Run ``import_mover.main`` with ``argv`` and return its exit status."""
+    try:
+        import_mover.main([str(arg) for arg in argv])
+    except SystemExit as e:
+        return e.code
+    return 0
+
+def test_move_into_function(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        import json
+        import os
+
+
+        def dump(value):
+            return json.dumps(value)
+    """)
+    result = rewrite(path)
+    assert result.moved_imports == {"dump": ["import json"]}
+    assert result.unused_imports == ["os"]
+    assert run("""
+        import sys
+        import mod
+        loaded = 'json' in sys.modules
+        print(mod.dump([loaded, mod.dump(1)]))
+    """, tmp_path) == [False, "1"]
+
+
+
+def test_move_into_one_line_function(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        import json
+
+
+        def dump(value): return json.dumps(value)
+    """)
+    result = rewrite(path)
+    assert result.moved_imports == {"dump": ["import json"]}
+    assert run("""
+        import sys
+        import mod
+        loaded = 'json' in sys.modules
+        print(mod.dump([loaded, mod.dump(1)]))
+    """, tmp_path) == [False, "1"]
+
+
+def test_old_imports_commented_in_the_rewrite(tmp_path):
+    source = """
+        import json
+        import os
+
+        SEP = os.sep
+
+
+        def dump(value):
+            return json.dumps(value)
+    """
+    path = write(tmp_path / "mod.py", source)
+    rewrite(path)
+    assert path.read_text().startswith("# import json\nimport os\n")
+    # Written once, atomically: no temporary files left behind
+    assert [child.name for child in tmp_path.iterdir()] == ["mod.py"]
+    write(path, source)
+    rewrite(path, keep_old_imports=False)
+    assert path.read_text().startswith("import os\n\nSEP")
+    assert run("""
+        import mod
+        print(mod.dump([mod.SEP == mod.os.sep]))
+    """, tmp_path) == [True]
+
+def test_lazy_strategy(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        import decimal
+
+
+        def half(value):
+            return str(decimal.Decimal(value) / 2)
+    """)
+    result = rewrite(path, strategy="lazy")
+    assert result.lazy_imports == ["import decimal"]
+    assert "_im_lazy_import('decimal')" in path.read_text()
+    assert run("""
+        import sys
+        import mod
+        # A lazy module only executes on first attribute access
+        executed = 'Decimal' in object.__getattribute__(sys.modules['decimal'], '__dict__')
+        import json
+        print(json.dumps([executed, mod.half(3)]))
+    """, tmp_path) == [False, "1.5"]
+
+
+
+def test_lazy_submodule_bound_on_parent(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        import xml.etree.ElementTree as ET
+
+
+        def tag(text):
+            return ET.fromstring(text).tag
+    """)
+    result = rewrite(path, strategy="lazy")
+    assert result.lazy_imports == ["import xml.etree.ElementTree as ET"]
+    assert run("""
+        import mod
+        import xml.etree.ElementTree
+        tags = [mod.tag('<a/>'), xml.etree.ElementTree.Element('b').tag]
+        import json
+        print(json.dumps(tags + [xml.etree.ElementTree is mod.ET]))
+    """, tmp_path) == ["a", "b", True]
+
+def test_lazy_init_exports(tmp_path):
+    write(tmp_path / "pkg" / "heavy.py", """
+        import decimal
+
+        VALUE = decimal.Decimal(2)
+    """)
+    init = write(tmp_path / "pkg" / "__init__.py", """
+        from .heavy import VALUE
+
+        __all__ = ["VALUE"]
+    """)
+    result = rewrite(init, lazy_init=True)
+    assert result.lazy_imports == ["from .heavy import VALUE"]
+    assert run("""
+        import sys
+        import pkg
+        before = 'pkg.heavy' in sys.modules
+        from pkg import *
+        import json
+        print(json.dumps([before, str(VALUE)]))
+    """, tmp_path) == [False, "2"]
+
+
+def test_type_checking_quotes_signatures(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        from decimal import Decimal
+
+
+        def double(value: Decimal) -> Decimal:
+            return value * 2
+    """)
+    result = rewrite(path, type_checking="quote")
+    assert result.type_checking_imports == ["from decimal import Decimal"]
+    assert run("""
+        import sys
+        import mod
+        loaded = 'decimal' in sys.modules
+        import json
+        print(json.dumps([loaded, mod.double.__annotations__['value']]))
+    """, tmp_path) == [False, "Decimal"]
+
+
+def test_defer_constants(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        import decimal
+
+        PRECISION = decimal.Decimal("0.01")
+
+
+        def price(amount):
+            return str(PRECISION * amount)
+    """)
+    result = rewrite(path, defer_constants=True)
+    assert result.deferred_constants == ["PRECISION"]
+    assert run("""
+        import sys
+        import mod
+        before = 'decimal' in sys.modules
+        import json
+        print(json.dumps([before, mod.price(3), str(mod.PRECISION)]))
+    """, tmp_path) == [False, "0.03", "0.01"]
+
+
+def test_lazy_subcommands(tmp_path):
+    pytest.importorskip("click")
+    write(tmp_path / "app" / "__init__.py", "")
+    write(tmp_path / "app" / "build.py", """
+        import click
+
+
+        @click.command(short_help="Build it.")
+        def build():
+            click.echo("building")
+    """)
+    cli = write(tmp_path / "app" / "cli.py", """
+        import click
+
+        from .build import build
+
+
+        @click.group()
+        def cli():
+            pass
+
+
+        cli.add_command(build)
+    """)
+    result = rewrite(cli, lazy_subcommands=True)
+    assert result.lazy_subcommands == ["cli build"]
+    assert result.deferred_imports == ["from .build import build"]
+    assert run("""
+        import sys
+        from click.testing import CliRunner
+        from app.cli import cli
+        help = CliRunner().invoke(cli, ["--help"]).output
+        loaded = 'app.build' in sys.modules
+        output = CliRunner().invoke(cli, ["build"]).output
+        import json
+        print(json.dumps([loaded, "Build it." in help, output.strip()]))
+    """, tmp_path) == [False, True, "building"]
+
+
+
+def test_lazy_subcommands_help_matches_click(tmp_path):
+    pytest.importorskip("click")
+    write(tmp_path / "app" / "__init__.py", "")
+    write(tmp_path / "app" / "commands.py", """
+        import click
+
+
+        @click.command()
+        def deploy_cmd():
+            \"\"\"Deploy the application to every configured environment, one region after another.
+
+            Long description.
+            \"\"\"
+
+
+        @click.command(short_help="Show the status.")
+        def status():
+            pass
+    """)
+    cli = write(tmp_path / "app" / "cli.py", """
+        import click
+
+        from .commands import deploy_cmd, status
+
+
+        @click.group()
+        def cli():
+            \"\"\"Manage the application.\"\"\"
+
+
+        cli.add_command(deploy_cmd)
+        cli.add_command(status)
+    """)
+    code = """
+        import sys
+        from click.testing import CliRunner
+        from app.cli import cli
+        help = CliRunner().invoke(cli, ["--help"], terminal_width=60).output
+        import json
+        print(json.dumps([help, "app.commands" in sys.modules]))
+    """
+    help, loaded = run(code, tmp_path)
+    assert loaded
+    rewrite(cli, lazy_subcommands=True)
+    assert run(code, tmp_path) == [help, False]
+
+def test_type_checking_keeps_class_body_annotations(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        from dataclasses import InitVar, dataclass
+        from decimal import Decimal
+        from typing import ClassVar
+
+
+        @dataclass
+        class Config:
+            registry: ClassVar[dict] = {}
+            seed: InitVar[int] = 0
+
+
+        def double(value: Decimal) -> Decimal:
+            return value * 2
+    """)
+    result = rewrite(path, type_checking="quote")
+    assert result.type_checking_imports == ["from decimal import Decimal"]
+    assert run("""
+        import dataclasses
+        import mod
+        config = mod.Config(seed=1)
+        import json
+        print(json.dumps([[field.name for field in dataclasses.fields(config)], mod.Config.registry]))
+    """, tmp_path) == [[], {}]
+
+
+def test_lazy_init_without_all(tmp_path):
+    write(tmp_path / "pkg" / "heavy.py", """
+        import decimal
+
+
+        def fa():
+            return str(decimal.Decimal(1))
+    """)
+    init = write(tmp_path / "pkg" / "__init__.py", """
+        from .heavy import fa
+
+        VERSION = "1.0"
+    """)
+    rewrite(init, lazy_init=True)
+    assert run("""
+        import sys
+        import pkg
+        before = 'pkg.heavy' in sys.modules
+        from pkg import *
+        import json
+        print(json.dumps([before, fa(), VERSION, hasattr(pkg, 'TYPE_CHECKING'), sorted(pkg.__all__)]))
+    """, tmp_path) == [False, "1", "1.0", False, ["VERSION", "fa"]]
+
+
+def test_cache_follows_files_read(tmp_path):
+    pytest.importorskip("click")
+    write(tmp_path / "app" / "__init__.py", "")
+    command = write(tmp_path / "app" / "build.py", """
+        import click
+
+
+        @click.command(help="Build it.")
+        def build():
+            pass
+    """)
+    source = textwrap.dedent("""
+        import click
+
+        from .build import build
+
+
+        @click.group()
+        def cli():
+            pass
+
+
+        cli.add_command(build)
+    """).lstrip()
+    cli = write(tmp_path / "app" / "cli.py", source)
+    cache = import_mover.ResultCache(tmp_path / "cache")
+    output = tmp_path / "cli_im.py"
+
+    def process(path):
+        return import_mover.process_file(path, None, str(output), lazy_subcommands=True, cache=cache)
+
+    assert not process(cli).cached
+    assert process(cli).cached
+    command.write_text(command.read_text().replace("Build it.", "Build everything."))
+    assert not process(cli).cached
+    assert "'Build everything.'" in output.read_text()
+    # The same source elsewhere is another entry
+    write(tmp_path / "other" / "__init__.py", "")
+    assert not process(write(tmp_path / "other" / "cli.py", source)).cached
+
+
+def test_used_in_functions_by_qualified_name():
+    wrapper = cst.metadata.MetadataWrapper(cst.parse_module(textwrap.dedent("""
+        import json
+
+
+        class A:
+            def run(self):
+                return json
+
+
+        class B:
+            def run(self):
+                def helper():
+                    return json
+                return helper
+    """)))
+    [info] = import_mover.build_import_index(wrapper).imports.values()
+    assert sorted(info.used_in_functions) == ["A.run", "B.run.<locals>.helper"]
+
+
+@pytest.mark.parametrize("wait4", [True, False])
+def test_bench_run_timeout(tmp_path, monkeypatch, wait4):
+    if not wait4:
+        monkeypatch.delattr(os, "wait4", raising=False)
+    command = f'"{sys.executable}" -c "import time; time.sleep(30)"'
+    sample = import_mover._run_command_once(command, tmp_path, dict(os.environ), timeout=0.5)
+    assert sample.returncode != 0
+    assert sample.wall_time_s < 10
+
+
+def test_bench_fails_when_every_run_fails(tmp_path, capsys):
+    write(tmp_path / "app" / "main.py", """
+        import missing_package
+
+        missing_package.main()
+    """)
+    with pytest.raises(SystemExit) as exit_info:
+        import_mover.bench_main([
+            str(tmp_path / "app"), "--command", f'"{sys.executable}" main.py', "--runs", "2", "--warmup", "0",
+            "--format", "json", "--log-level", "ERROR",
+        ])
+    assert exit_info.value.code == 1
+    report = json.loads(capsys.readouterr().out)
+    assert report["before"]["warm"] == report["after"]["warm"] == {"failed_runs": 2}
+    assert report["change_pct"] == {"cold": {}, "warm": {}}
+
+
+def test_startup_plan_skips_modules_leaving_startup(tmp_path):
+    write(tmp_path / "app" / "__init__.py", "")
+    write(tmp_path / "app" / "util.py", """
+        import fractions
+
+
+        def half(value):
+            return fractions.Fraction(value, 2)
+    """)
+    cli = write(tmp_path / "app" / "cli.py", """
+        import decimal
+
+        from . import util
+
+        PRECISION = decimal.Decimal(2)
+
+
+        def main():
+            return util.half(1)
+    """)
+    files = import_mover.collect_python_files([str(tmp_path / "app")])
+    plan = import_mover.plan_startup_moves(files, cli, {})
+    assert plan.movable_imports == {cli: {"from . import util"}}
+    assert {"app.util", "fractions"} <= plan.removed_modules
+    assert "decimal" in plan.closure_after
+
+
+def test_verify_reverts_slower_or_broken_rewrites(tmp_path):
+    originals = {"slow": "VALUE = 1\n", "broken": "VALUE = 1\n", "fine": "VALUE = 1\n"}
+    # "fine" keeps the size of the original, so stale bytecode of the other version would go unnoticed
+    rewritten = {"slow": "import time\n\ntime.sleep(0.05)\nVALUE = 1\n", "broken": "from missing import VALUE\n",
+                 "fine": "VALUE = 2\n"}
+    results = []
+    for name, code in rewritten.items():
+        path = write(tmp_path / f"{name}.py", code)
+        results.append(import_mover.FileResult(source_path=str(path), output_path=str(path), original_code=originals[name]))
+    outcomes = {outcome.module: outcome for outcome in import_mover.verify_rewrites(results, runs=2)}
+    assert outcomes["slow"].reverted.startswith("import slower")
+    assert outcomes["broken"].reverted == "fails to import"
+    assert outcomes["fine"].reverted is None
+    assert {name: (tmp_path / f"{name}.py").read_text() for name in originals} == dict(originals, fine="VALUE = 2\n")
+    assert run("""
+        import fine
+        print(fine.VALUE)
+    """, tmp_path) == 2
+
+
+def test_plain_rewrite_leaves_subcommand_modules_unloaded(tmp_path):
+    write(tmp_path / "mod.py", """
+        import json
+
+
+        def dump(value):
+            return json.dumps(value)
+    """)
+    assert run(f"""
+        import sys
+        sys.path.insert(0, {str(Path(import_mover.__file__).parent)!r})
+        import import_mover
+        try:
+            import_mover.main(["mod.py", "--no-cache", "--log-level", "WARNING"])
+        except SystemExit:
+            pass
+        subcommand_modules = ["concurrent.futures.process", "difflib", "pstats", "shlex", "socket", "socketserver",
+                              "statistics"]
+        loaded = [name for name in subcommand_modules if name in sys.modules]
+        import json
+        print(json.dumps(loaded))
+    """, tmp_path) == []
+
+
+@pytest.mark.parametrize("backend", ["auto", "libcst"])
+def test_whitelist_matches_module_names(tmp_path, backend):
+    path = write(tmp_path / "mod.py", """
+        import re
+        import xml.dom.minidom
+        from email import message
+
+
+        def check(value):
+            return re.match(value, "") or xml.dom.minidom or message
+    """)
+    result = rewrite(path, backend=backend, whitelist_libs={"r", "xml.dom", "email.message"})
+    assert result.moved_imports == {"check": ["import re"]}
+    assert result.kept_imports == {"import xml.dom.minidom": "whitelisted", "from email import message": "whitelisted"}
+
+
+def test_cost_threshold_keeps_cheap_imports(tmp_path):
+    path = write(tmp_path / "mod.py", """
+        import decimal
+        import json
+
+
+        def dump(value):
+            return json.dumps(str(decimal.Decimal(value)))
+    """)
+    costs = import_mover.profile_import_costs(["decimal", "json"])
+    assert costs["sys"] == 0.0 and costs["decimal"] > 0.0
+    result = rewrite(path, import_costs={"decimal": 12.0, "json": 0.4}, cost_threshold_ms=1.0)
+    assert result.moved_imports == {"dump": ["import decimal"]}
+    assert result.kept_imports == {"import json": "cheap (0.40 ms)"}
+    assert run("""
+        import sys
+        import mod
+        loaded = ['decimal' in sys.modules, 'json' in sys.modules]
+        print(mod.json.dumps(loaded + [mod.dump(1)]))
+    """, tmp_path) == [False, True, '"1"']
+
+
+def test_import_index():
+    wrapper = cst.metadata.MetadataWrapper(cst.parse_module(textwrap.dedent("""
+        import functools
+        import os.path
+        from collections import OrderedDict, abc
+
+
+        class Registry(abc.Mapping):
+            @functools.lru_cache
+            def get(self, key):
+                return os.path.join(key)
+
+
+        def ordered(items):
+            return [OrderedDict(item) for item in items]
+    """)))
+    index = import_mover.build_import_index(wrapper)
+    infos = {wrapper.module.code_for_node(node).strip(): info for node, info in index.imports.items()}
+    # Decorators and bases run at import time; comprehensions count for their function
+    assert {code: (info.used_at_module_level, sorted(info.used_in_functions)) for code, info in infos.items()} == {
+        "import functools": (True, []),
+        "import os.path": (False, ["Registry.get"]),
+        "from collections import OrderedDict, abc": (True, ["ordered"]),
+    }
+    assert infos["from collections import OrderedDict, abc"].references.keys() == {"OrderedDict", "abc"}
+    global_scope = wrapper.resolve(cst.metadata.ScopeProvider)[wrapper.module]
+    assert index.lookup(global_scope, "os.path.join") is infos["import os.path"].node
+    assert index.lookup(global_scope, "json") is None
+
+
+@pytest.mark.parametrize("hot_action", ["keep", "lazy"])
+def test_hot_functions_keep_their_imports_global(tmp_path, hot_action):
+    path = write(tmp_path / "mod.py", """
+        import decimal
+        import json
+
+
+        def hot(value):
+            return decimal.Decimal(value)
+
+
+        def cold(value):
+            return json.dumps(value)
+    """)
+    workload = "import cProfile, mod; cProfile.run('for _ in range(2000): mod.hot(1)', 'calls.prof')"
+    proc = subprocess.run([sys.executable, "-c", workload], cwd=tmp_path, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    profile = import_mover.load_call_profile(tmp_path / "calls.prof")
+    hot = import_mover.hot_functions_by_file(profile, [path], threshold=1000)
+    assert hot == {path: [("hot", 5)]}
+    result = rewrite(path, hot_functions=hot[path], hot_action=hot_action)
+    assert result.moved_imports == {"cold": ["import json"]}
+    if hot_action == "keep":
+        assert result.kept_imports == {"import decimal": "used in hot functions"}
+    else:
+        assert result.lazy_imports == ["import decimal"]
+    assert run("""
+        import mod
+        values = [str(mod.hot(2)), mod.cold(3)]
+        import json
+        print(json.dumps(values))
+    """, tmp_path) == ["2", "3"]
+
+
+def test_profile_phases_and_lazy_logging(tmp_path, monkeypatch, caplog):
+    path = write(tmp_path / "mod.py", """
+        import json
+        import os
+
+
+        def dump(value):
+            return json.dumps(value, indent=os.sep)
+    """)
+    profile = tmp_path / "times.json"
+    import_mover.main([str(path), "--in-place", "--backend", "libcst", "--no-cache", "--log-level", "WARNING",
+                           "--profile", str(profile)])
+    report = json.loads(profile.read_text())
+    assert {"collect", "options", "process"} <= report["run_phases"].keys()
+    assert {"read", "parse", "metadata", "index", "plan", "rewrite", "write"} <= report["file_phases"].keys()
+    assert [entry["path"] for entry in report["files"]] == [str(path)]
+
+    # Node code is only rendered for log messages that are emitted
+    rendered = []
+    monkeypatch.setattr(import_mover._LazyCode, "__str__", lambda self: rendered.append(self) or "code")
+    write(path, "import os\n\n\ndef sep():\n    return os.sep\n")
+    caplog.set_level(logging.WARNING)
+    rewrite(path, whitelist_libs={"os"}, backend="libcst")
+    assert rendered == []
+    caplog.set_level(logging.DEBUG)
+    rewrite(path, whitelist_libs={"os"}, backend="libcst")
+    assert rendered
+
+
+def test_check_and_diff_write_nothing(tmp_path, capsys):
+    source = textwrap.dedent("""
+        import json
+        import os
+
+
+        def dump(value):
+            return json.dumps(value)
+    """).lstrip()
+    path = write(tmp_path / "mod.py", source)
+    clean = write(tmp_path / "clean.py", "import os\n\nSEP = os.sep\n")
+    options = ["--no-cache", "--log-level", "WARNING", "-j", "1"]
+
+    assert cli(path, clean, "--check", *options) == 1
+    records = {Path(record["path"]).name: record for record in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert records["mod.py"]["status"] == "changed"
+    assert records["mod.py"]["moved"] == [{"import": "import json", "line": 1, "functions": ["dump"]}]
+    assert records["mod.py"]["unused"] == [{"name": "os", "line": 2}]
+    assert records["mod.py"]["elapsed_ms"] >= 0
+    assert records["clean.py"]["status"] == "unchanged"
+
+    assert cli(path, "--diff", *options) == 1
+    diff = capsys.readouterr().out
+    assert f"--- {path}" in diff and "+    import json\n" in diff
+
+    assert cli(clean, "--check", tmp_path / "records.ndjson", "--diff", *options) == 0
+    assert capsys.readouterr().out == ""
+    assert json.loads((tmp_path / "records.ndjson").read_text())["status"] == "unchanged"
+    assert path.read_text() == source
+    assert sorted(child.name for child in tmp_path.iterdir()) == ["clean.py", "mod.py", "records.ndjson"]
+
+
+def test_pyproject_rules_overrides_and_exclude(tmp_path, capsys):
+    write(tmp_path / "pyproject.toml", """
+        [tool.import_mover]
+        keep = ["json"]
+        lazy = ["decimal"]
+        exclude = ["src/generated_*.py"]
+
+        [[tool.import_mover.overrides]]
+        paths = ["src/cli/*.py"]
+        defer = ["json"]
+    """)
+    write(tmp_path / "src" / "jsonish.py", "VALUE = 1\n")
+    write(tmp_path / "src" / "app.py", """
+        import decimal
+        import fractions
+        import json
+        import jsonish
+
+
+        def value():
+            return json.dumps([str(decimal.Decimal(1)), str(fractions.Fraction(1, 2)), jsonish.VALUE])
+    """)
+    write(tmp_path / "src" / "cli" / "main.py", """
+        import json
+
+
+        def main():
+            return json.dumps(1)
+    """)
+    generated = write(tmp_path / "src" / "generated_table.py", "import json\n")
+
+    assert cli(tmp_path / "src", "--check", "--no-cache", "--log-level", "WARNING", "-j", "1") == 1
+    records = {Path(record["path"]).name: record for record in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert sorted(records) == ["app.py", "jsonish.py", "main.py"]
+    app = records["app.py"]
+    assert app["kept_global"] == [{"import": "import json", "line": 3, "reason": "kept by the rule for json"}]
+    assert [entry["import"] for entry in app["lazy"]] == ["import decimal"]
+    assert [entry["import"] for entry in app["moved"]] == ["import fractions", "import jsonish"]
+    assert [entry["import"] for entry in records["main.py"]["moved"]] == ["import json"]
+
+    assert cli(tmp_path / "src", "--in-place", "--no-cache", "--log-level", "WARNING", "-j", "1") == 0
+    assert generated.read_text() == "import json\n"
+    assert run("""
+        import sys
+        import app
+        loaded = [name in sys.modules for name in ('json', 'fractions', 'jsonish')]
+        print(app.json.dumps(loaded + [app.value()]))
+    """, tmp_path / "src") == [True, False, False, '["1", "1/2", 1]']
+
+
+def test_server_answers_json_rpc_over_stdio(tmp_path, monkeypatch):
+    import io
+
+    monkeypatch.chdir(tmp_path)
+    app = write(tmp_path / "app.py", """
+        import json
+
+
+        def dump(value):
+            return json.dumps(value)
+    """)
+    saved = app.read_text()
+    buffer = saved.replace("json.dumps(value)", "json.dumps(value, indent=2)")
+    server = import_mover.ImportMoverServer.from_args(
+        import_mover.serve_parser().parse_args(["--stdio", "--no-cache", "--log-level", "WARNING"]))
+    requests = [
+        {"jsonrpc": "2.0", "id": 1, "method": "ping"},
+        {"jsonrpc": "2.0", "id": 2, "method": "process", "params": {"path": str(app), "source": buffer, "code": True}},
+        {"jsonrpc": "2.0", "id": 3, "method": "process", "params": {}},
+        {"jsonrpc": "2.0", "id": 4, "method": "shutdown"},
+        {"jsonrpc": "2.0", "id": 5, "method": "ping"},
+    ]
+    stdout = io.StringIO()
+    import_mover.serve_stdio(server, io.StringIO("".join(json.dumps(r) + "\n" for r in requests)), stdout)
+
+    responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert [response["id"] for response in responses] == [1, 2, 3, 4]  # nothing answered after shutdown
+    assert responses[0]["result"]["pid"] == os.getpid()
+    record = responses[1]["result"]
+    assert record["status"] == "changed"
+    assert [entry["import"] for entry in record["moved"]] == ["import json"]
+    assert "json.dumps(value, indent=2)" in record["code"]
+    assert app.read_text() == saved  # buffers are never written
+    assert responses[2]["error"]["code"] == -32602
+
+
+def test_client_falls_back_to_processing_in_process(tmp_path):
+    client = Path(__file__).parent.parent / "import_mover_client.py"
+    app = write(tmp_path / "app.py", """
+        import json
+
+
+        def dump(value):
+            return json.dumps(value)
+    """)
+    original = app.read_text()
+
+    def run_client(*args):
+        return subprocess.run([sys.executable, str(client), *args], cwd=tmp_path, capture_output=True, text=True)
+
+    # No server is listening on the project's socket
+    assert run_client("--no-fallback", "app.py").returncode == 2
+    checked = run_client("app.py")
+    assert checked.returncode == 1, checked.stderr
+    record = json.loads(checked.stdout)
+    assert (record["status"], record["moved"][0]["import"]) == ("changed", "import json")
+    assert app.read_text() == original
+    assert run_client("--write", "app.py").returncode == 0
+    assert app.read_text() != original
+    assert json.loads(run_client("app.py").stdout)["status"] == "unchanged"
+
+
+def test_since_and_staged_select_changed_files_and_importers(tmp_path, capsys):
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+                       cwd=tmp_path, check=True, capture_output=True)
+
+    def checked(*args):
+        cli(tmp_path / "pkg", "--check", *args, "--no-cache", "--log-level", "WARNING", "-j", "1")
+        return sorted(Path(json.loads(line)["path"]).name for line in capsys.readouterr().out.splitlines())
+
+    source = """
+        import json
+
+
+        def dump(value):
+            return json.dumps(value)
+    """
+    write(tmp_path / "pkg" / "__init__.py", "")
+    a = write(tmp_path / "pkg" / "a.py", source)
+    write(tmp_path / "pkg" / "b.py", """
+        from pkg import a
+
+
+        def dump(value):
+            return a.dump(value)
+    """)
+    c = write(tmp_path / "pkg" / "c.py", source)
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+
+    assert checked("--since", "HEAD") == []
+    a.write_text(a.read_text() + "\nVALUE = 1\n")
+    assert checked("--since", "HEAD") == ["a.py", "b.py"]
+    c.write_text(c.read_text() + "\nVALUE = 1\n")
+    git("add", "pkg/c.py")
+    assert checked("--staged") == ["c.py"]
+    assert checked("--since", "HEAD") == ["a.py", "b.py", "c.py"]
+
+
+def test_memory_report_attributes_avoided_modules(tmp_path):
+    write(tmp_path / "proj" / "app" / "__init__.py", "")
+    cli_source = write(tmp_path / "proj" / "app" / "cli.py", """
+        import decimal
+        from app import helpers
+
+
+        def main():
+            return helpers.dump(decimal.Decimal(1))
+    """).read_text()
+    write(tmp_path / "proj" / "app" / "helpers.py", """
+        import json
+
+
+        def dump(value):
+            return json.dumps(str(value))
+    """)
+    report_file = tmp_path / "report.json"
+    assert cli("memory", tmp_path / "proj", "--entry", tmp_path / "proj" / "app" / "cli.py", "--runs", "1",
+               "--format", "json", "--report", report_file, "--log-level", "WARNING") == 0
+
+    report = json.loads(report_file.read_text())
+    assert report["entry"] == "app.cli"
+    assert report["after"]["modules"] < report["before"]["modules"]
+    statements = {(record["file"], record["import"]): record for record in report["statements"]}
+    assert set(statements) == {("app/cli.py", "import decimal"), ("app/cli.py", "from app import helpers"),
+                               ("app/helpers.py", "import json")}
+    assert {"decimal", "_decimal"} <= set(statements[("app/cli.py", "import decimal")]["modules"])
+    assert statements[("app/cli.py", "from app import helpers")]["modules"] == ["app.helpers"]
+    assert {"json", "json.decoder"} <= set(statements[("app/helpers.py", "import json")]["modules"])
+    assert all(record["allocated_bytes"] > 0 for record in report["statements"])
+    assert (tmp_path / "proj" / "app" / "cli.py").read_text() == cli_source  # only the scratch copy is rewritten